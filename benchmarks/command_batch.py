@@ -0,0 +1,76 @@
+"""
+Compares running a list of commands on a client as one CMD request per command, each waiting for its reply like the
+cmd command of the CLI, with running them as a single BATCH request. The client runs in its own process, like it would
+on a remote host. Reports the time taken and the number of messages the client answered with.
+
+Usage: python benchmarks/command_batch.py [--commands N] [--command CMD]
+"""
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config  # noqa: E402
+from src.core.command_batch import BatchCommand, encode_batch  # noqa: E402
+from src.core.message import Message, MessageType  # noqa: E402
+from src.server.rce_server import RCEServer  # noqa: E402
+
+
+CLIENT = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from src.client.rce_client import RCEClient
+RCEClient("127.0.0.1", int(sys.argv[2])).run()
+"""
+
+
+def received_messages(server: RCEServer) -> int:
+    return sum(server.metrics_snapshot().traffic.received_messages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', '-n', type=int, default=50)
+    parser.add_argument('--command', '-c', default="uname -a", help="the diagnostic command that is run")
+    parser.add_argument('--port', '-p', type=int, default=config.PORT + 300)
+    args = parser.parse_args()
+
+    server = RCEServer("127.0.0.1", args.port)
+    server.observers = [server.metrics]
+    server.start()
+    client_process = subprocess.Popen([sys.executable, "-c", CLIENT, str(Path(__file__).resolve().parent.parent),
+                                       str(args.port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not any(client.batch for client in server.get_clients()):
+            time.sleep(0.01)
+
+        messages = received_messages(server)
+        start = time.perf_counter()
+        for _ in range(args.commands):
+            if server.fan_out(Message(MessageType.CMD, args.command.encode())).failed:
+                raise RuntimeError(f"Command '{args.command}' failed")
+        one_by_one = (time.perf_counter() - start, received_messages(server) - messages)
+
+        messages = received_messages(server)
+        start = time.perf_counter()
+        results = server.fan_out(Message(MessageType.BATCH,
+                                         encode_batch([BatchCommand(args.command)] * args.commands)))
+        if results.failed:
+            raise RuntimeError(f"Batch of '{args.command}' failed")
+        batched = (time.perf_counter() - start, received_messages(server) - messages)
+    finally:
+        server.stop()
+        client_process.wait()
+
+    print(f"{args.commands} x '{args.command}'")
+    print(f"{'mode':<10} {'round trips':>12} {'seconds':>8} {'replies':>8}")
+    for mode, round_trips, (elapsed, replies) in (("cmd", args.commands, one_by_one), ("batch", 1, batched)):
+        print(f"{mode:<10} {round_trips:>12} {elapsed:>8.2f} {replies:>8}")
+    print(f"speedup: {one_by_one[0] / batched[0]:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Compares sending a directory of many small files file by file with sending it as a streamed tar archive.
+The client runs in its own process, like it would on a remote host.
+
+Usage: python benchmarks/directory_transfer.py [--files N] [--size BYTES] [--compression]
+"""
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config  # noqa: E402
+from src.core.message import Message, MessageType  # noqa: E402
+from src.core.observer import RCEEventObserver  # noqa: E402
+from src.server.rce_server import RCEServer  # noqa: E402
+
+
+CLIENT = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import config
+from src.client.rce_client import RCEClient
+if sys.argv[3] == "off":
+    config.COMPRESSION_ALGORITHMS = ()
+RCEClient("127.0.0.1", int(sys.argv[2])).run()
+"""
+
+
+class EchoObserver(RCEEventObserver):
+    """
+    Observer that signals when a given ECHO message comes back. The client handles messages in order, so once the
+    echo of a marker sent after a transfer is back, the client has received the whole transfer.
+    """
+
+    overflow_policy = "block"  # Every message has to be seen
+
+    def __init__(self):
+        self.marker = None
+        self.echoed = threading.Event()
+
+    def on_connect(self, client_address: str):
+        pass
+
+    def on_disconnect(self, client_address: str):
+        pass
+
+    def on_message(self, sender: str, message: bytes):
+        if message.decode() == self.marker:
+            self.echoed.set()
+
+    def on_info(self, message: str, prefix=""):
+        pass
+
+    def on_debug(self, message: str, prefix=""):
+        pass
+
+    def on_error(self, error: str, prefix=""):
+        print(f"{prefix}{error}")
+
+
+def create_tree(root: Path, files: int, size: int):
+    """
+    Creates `files` files of `size` bytes, spread over directories of 100 files each.
+    """
+    for index in range(files):
+        directory = root / f"dir{index // 100:04}"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"file{index:05}.txt").write_bytes((f"line {index}\n" * size).encode()[:size])
+
+
+def wait_for_client(client, observer: EchoObserver, marker: str):
+    observer.marker = marker
+    observer.echoed.clear()
+    client.send_message(Message(MessageType.ECHO, marker.encode()))
+    if not observer.echoed.wait(600):
+        raise TimeoutError("Timed out while waiting for the client")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', '-n', type=int, default=10_000)
+    parser.add_argument('--size', '-s', type=int, default=1024)
+    parser.add_argument('--compression', '-c', action='store_true', help="negotiate compression (zlib)")
+    parser.add_argument('--port', '-p', type=int, default=config.PORT + 200)
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="rce-bench-"))
+    source = workdir / "tree"
+    create_tree(source, args.files, args.size)
+    files = sorted(path for path in source.rglob("*") if path.is_file())
+
+    observer = EchoObserver()
+    server = RCEServer("127.0.0.1", args.port)
+    server.observers = [observer]
+    server.start()
+    client_process = subprocess.Popen([sys.executable, "-c", CLIENT, str(Path(__file__).resolve().parent.parent),
+                                       str(args.port), "on" if args.compression else "off"],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not server.get_clients():
+            time.sleep(0.01)
+        client = server.get_clients()[0]
+        wait_for_client(client, observer, "ready")
+
+        start = time.perf_counter()
+        for path in files:
+            destination = workdir / "per-file" / path.parent.relative_to(source)
+            client.send_file(str(path), str(destination))
+        wait_for_client(client, observer, "per-file")
+        per_file = time.perf_counter() - start
+
+        start = time.perf_counter()
+        client.send_directory(str(source), str(workdir / "tar"))
+        wait_for_client(client, observer, "tar")
+        tar = time.perf_counter() - start
+
+        received = sum(1 for path in (workdir / "tar" / source.name).rglob("*") if path.is_file())
+        if received != len(files):
+            raise RuntimeError(f"Only {received} of {len(files)} files were extracted")
+    finally:
+        server.stop()
+        client_process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    total = len(files) * args.size
+    print(f"{len(files)} files of {args.size} bytes ({total / config.MB:.1f} MB), "
+          f"compression: {'zlib' if args.compression else 'off'}")
+    print(f"{'mode':<10} {'seconds':>8} {'files/s':>10} {'MB/s':>8}")
+    for mode, elapsed in (("per-file", per_file), ("tar", tar)):
+        print(f"{mode:<10} {elapsed:>8.2f} {len(files) / elapsed:>10.0f} {total / config.MB / elapsed:>8.1f}")
+    print(f"speedup: {per_file / tar:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Compares receiving files with synchronous disk writes, as the receive path did before, with receiving them through
+IncomingFile, whose DiskWriter writes them on a thread of its own. The network is simulated: every transfer receives
+its chunks at a fixed rate on a thread of its own, so that the time spent waiting for the disk shows up as transfer
+time. Several transfers run concurrently and share the disk and the buffer pool.
+
+Usage: python benchmarks/disk_writer.py [--transfers N] [--size MB] [--rate MB/S] [--chunk KB] [--durability MODE]
+                                        [--directory DIR]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config  # noqa: E402
+from src.core.compression import StreamDecompressor  # noqa: E402
+from src.core.file_transfer import IncomingFile  # noqa: E402
+
+
+class SynchronousFile:
+    """
+    The previous receive path: the chunks are written on the receiving thread, the file is synced at the end unless
+    the durability mode is "none".
+    """
+
+    def __init__(self, file_path: Path, durability: str):
+        self.__file = open(file_path, "wb")
+        self.__durability = durability
+
+    def write(self, data: bytes):
+        self.__file.write(data)
+
+    def finish(self):
+        self.__file.flush()
+        if self.__durability != "none":
+            os.fsync(self.__file.fileno())
+        self.__file.close()
+
+
+def receive(open_file, file_path: Path, size: int, chunk: bytes, rate: float):
+    """
+    Receives a file of `size` bytes in chunks arriving at `rate` bytes per second.
+    """
+    incoming = open_file(file_path)
+    started = time.perf_counter()
+    received = 0
+    while received < size:
+        received += len(chunk)
+        delay = started + received / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)  # Waiting for the network
+        incoming.write(chunk)
+    incoming.finish()
+
+
+def measure(open_file, directory: Path, transfers: int, size: int, chunk: bytes, rate: float) -> float:
+    """
+    :return: The seconds taken to receive every file.
+    """
+    threads = [threading.Thread(target=receive, args=(open_file, directory / f"file-{index}", size, chunk, rate))
+               for index in range(transfers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transfers', '-n', type=int, default=8)
+    parser.add_argument('--size', '-s', type=int, default=64, help="size of the files in MB")
+    parser.add_argument('--rate', '-r', type=float, default=200, help="network rate of each transfer in MB/s")
+    parser.add_argument('--chunk', '-c', type=int, default=64, help="size of the received chunks in KB")
+    parser.add_argument('--durability', '-d', choices=config.FILE_DURABILITY_MODES, default="eof")
+    parser.add_argument('--directory', help="directory the files are written to, a temporary directory by default")
+    args = parser.parse_args()
+
+    size = args.size * config.MB
+    chunk = os.urandom(args.chunk * config.KB)
+    rate = args.rate * config.MB
+
+    def synchronous(file_path: Path):
+        return SynchronousFile(file_path, args.durability)
+
+    def buffered(file_path: Path):
+        incoming = IncomingFile(file_path, StreamDecompressor(None), config.MAX_MESSAGE_SIZE, args.durability)
+        incoming.preallocate(size)
+        return incoming
+
+    network = size / rate
+    print(f"{args.transfers} transfers of {args.size}MB at {args.rate:g}MB/s, durability {args.durability}, "
+          f"{network:.2f}s on the network alone")
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        for name, open_file in (("synchronous", synchronous), ("disk writer", buffered)):
+            elapsed = measure(open_file, Path(directory), args.transfers, size, chunk, rate)
+            total = args.transfers * size / config.MB
+            print(f"{name:<12} {elapsed:>7.2f}s {total / elapsed:>9.1f}MB/s  ({elapsed - network:.2f}s waiting for the "
+                  f"disk)")
+            for file in Path(directory).iterdir():
+                file.unlink()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Compares the per-connection memory and the ECHO message throughput of the thread and async server engines.
+
+Usage: python benchmarks/engine_comparison.py [--clients N] [--messages M] [--senders S]
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config  # noqa: E402
+from src.core.message import Message, MessageType  # noqa: E402
+from src.core.observer import RCEEventObserver  # noqa: E402
+from src.server.rce_server import RCEServer  # noqa: E402
+
+
+class CountingObserver(RCEEventObserver):
+    """
+    Observer that only counts the received messages, so that logging does not dominate the measurements.
+    """
+
+    overflow_policy = "block"  # Every message has to be seen
+
+    def __init__(self):
+        self.messages = 0
+        self.lock = threading.Lock()
+
+    def on_connect(self, client_address: str):
+        pass
+
+    def on_disconnect(self, client_address: str):
+        pass
+
+    def on_message(self, sender: str, message: bytes):
+        with self.lock:
+            self.messages += 1
+
+    def on_info(self, message: str, prefix=""):
+        pass
+
+    def on_debug(self, message: str, prefix=""):
+        pass
+
+    def on_error(self, error: str, prefix=""):
+        pass
+
+
+def rss_bytes():
+    """
+    :return: The resident set size of this process in bytes (Linux only, 0 elsewhere).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def wait_until(predicate, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Timed out while waiting for the server")
+        time.sleep(0.01)
+
+
+def frame(message: Message):
+    data = message.to_bytes()
+    return len(data).to_bytes(4, byteorder="little") + data
+
+
+def run_engine(engine: str, port: int, clients: int, messages: int, senders: int):
+    observer = CountingObserver()
+    server = RCEServer("127.0.0.1", port, engine=engine)
+    server.observers = [observer]
+    server.start()
+
+    sockets = []
+    try:
+        rss_before = rss_bytes()
+        threads_before = threading.active_count()
+        for _ in range(clients):
+            sockets.append(socket.create_connection(("127.0.0.1", port)))
+        wait_until(lambda: len(server.clients) == clients)
+        rss_per_connection = (rss_bytes() - rss_before) / clients
+        threads_per_connection = (threading.active_count() - threads_before) / clients
+
+        payload = frame(Message(MessageType.ECHO, b"x" * 64))
+        per_sender = messages // senders
+        start = time.perf_counter()
+        for sock in sockets[:senders]:
+            sock.sendall(payload * per_sender)
+        wait_until(lambda: observer.messages >= per_sender * senders, timeout=120)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+        for sock in sockets:
+            sock.close()
+
+    return {
+        "engine": engine,
+        "rss_per_connection_kb": rss_per_connection / config.KB,
+        "threads_per_connection": threads_per_connection,
+        "echo_messages_per_sec": per_sender * senders / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', '-c', type=int, default=200)
+    parser.add_argument('--messages', '-n', type=int, default=100_000)
+    parser.add_argument('--senders', '-s', type=int, default=10)
+    parser.add_argument('--port', '-p', type=int, default=config.PORT + 100)
+    args = parser.parse_args()
+
+    print(f"{'engine':<8} {'RSS/conn (KB)':>14} {'threads/conn':>13} {'ECHO msgs/s':>12}")
+    for index, engine in enumerate(config.SERVER_ENGINES):
+        result = run_engine(engine, args.port + index, args.clients, args.messages, args.senders)
+        print(f"{result['engine']:<8} {result['rss_per_connection_kb']:>14.1f} "
+              f"{result['threads_per_connection']:>13.2f} {result['echo_messages_per_sec']:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
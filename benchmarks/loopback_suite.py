@@ -0,0 +1,347 @@
+"""
+Loopback benchmark suite: starts an RCEServer on localhost and connects a swarm of simulated clients to it (see
+swarm.py), which run in their own processes so that the server's memory can be measured on its own. For every server
+engine it measures:
+  - the server RSS per connection and the time the swarm took to connect.
+  - the ECHO messages/sec the server receives from a number of senders.
+  - the latency percentiles of broadcast ECHO messages, from the broadcast until every client received them.
+  - the CMD round trip percentiles of requests sent to random clients, until the server reported their exit status.
+  - the file transfer MB/s of files pushed to a tagged subset of the clients.
+The results are written as JSON, so that runs can be compared across commits with --compare.
+
+Usage: python benchmarks/loopback_suite.py [--clients N] [--processes P] [--engine ENGINE] [--output FILE]
+                                           [--compare BASELINE]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import config  # noqa: E402
+from src.core.message import Message, MessageType  # noqa: E402
+from src.core.observer import RCEEventObserver  # noqa: E402
+from src.server.rce_server import RCEServer  # noqa: E402
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from swarm import BROADCAST_PREFIX, raise_file_limit  # noqa: E402
+
+TRANSFER_TAG = "transfer"
+REQUEST_PREFIX = re.compile(r"#(\d+)\s*$")
+# Metrics where a lower value is better, for the comparison with a baseline
+LOWER_IS_BETTER = ("rss_per_connection_kb", "connect_seconds", "_ms.")
+
+
+class ExitObserver(RCEEventObserver):
+    """
+    Observer that signals when the server reports the exit status of a CMD request.
+    """
+
+    events = frozenset(("on_info",))
+    overflow_policy = "block"  # Every exit has to be seen
+
+    def __init__(self):
+        self.__exits: dict[int, threading.Event] = {}
+        self.__lock = threading.Lock()
+
+    def expect(self, request_id: int) -> threading.Event:
+        with self.__lock:
+            return self.__exits.setdefault(request_id, threading.Event())
+
+    def on_info(self, message: str, prefix=""):
+        if message.startswith("Command exited") and (match := REQUEST_PREFIX.search(prefix)):
+            self.expect(int(match.group(1))).set()
+
+    def on_connect(self, client_address: str):
+        pass
+
+    def on_disconnect(self, client_address: str):
+        pass
+
+    def on_message(self, sender: str, message: bytes):
+        pass
+
+    def on_debug(self, message: str, prefix=""):
+        pass
+
+    def on_error(self, error: str, prefix=""):
+        pass
+
+
+class Swarm:
+    """
+    The processes of a swarm of simulated clients, see swarm.py.
+    """
+
+    def __init__(self, port: int, clients: int, processes: int, tagged: int):
+        self.__processes = []
+        for index in range(processes):
+            count = clients // processes + (index < clients % processes)
+            self.__processes.append(subprocess.Popen(
+                [sys.executable, str(Path(__file__).resolve().parent / "swarm.py"), "--port", str(port),
+                 "--clients", str(count), "--tagged", str(tagged if index == 0 else 0), "--tag", TRANSFER_TAG],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True))
+
+    def wait_ready(self) -> float:
+        """
+        :return: The number of seconds the slowest process took to connect its clients.
+        """
+        return max(self.__receive(process, "ready")["seconds"] for process in self.__processes)
+
+    def send_echoes(self, messages: int, senders: int):
+        self.__send(self.__processes[0], command="echo", messages=messages, senders=senders)
+
+    def report(self) -> list[dict]:
+        for process in self.__processes:
+            self.__send(process, command="report")
+        return [self.__receive(process, "report") for process in self.__processes]
+
+    def close(self):
+        for process in self.__processes:
+            if process.poll() is None:
+                self.__send(process, command="exit")
+        for process in self.__processes:
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    @staticmethod
+    def __send(process: subprocess.Popen, **command):
+        process.stdin.write(json.dumps(command) + "\n")
+        process.stdin.flush()
+
+    @staticmethod
+    def __receive(process: subprocess.Popen, expected: str) -> dict:
+        """
+        :return: The next event of the expected kind written by the process, other events are skipped.
+        :raises RuntimeError: If the process failed or exited.
+        """
+        while line := process.stdout.readline():
+            event = json.loads(line)
+            if event["event"] == "error":
+                raise RuntimeError(f"Swarm failed: {event['error']}")
+            if event["event"] == expected:
+                return event
+        raise RuntimeError(f"Swarm exited with status {process.wait()}")
+
+
+def rss_bytes():
+    """
+    :return: The resident set size of this process in bytes (Linux only, 0 elsewhere).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def wait_until(predicate, timeout=60.0, interval=0.01):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Timed out while waiting for the server")
+        time.sleep(interval)
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """
+    :return: The nearest-rank percentiles, mean and maximum of the samples, rounded to 3 decimals.
+    """
+    if not samples:
+        return {}
+
+    samples = sorted(samples)
+    result = {f"p{p}": samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in (50, 90, 99)}
+    result.update(mean=statistics.fmean(samples), max=samples[-1])
+    return {key: round(value, 3) for key, value in result.items()}
+
+
+def received_echoes(server: RCEServer) -> int:
+    return server.metrics.traffic().received_messages[MessageType.ECHO.value]
+
+
+def measure_echo(server: RCEServer, swarm: Swarm, messages: int, senders: int) -> float:
+    """
+    :return: The ECHO messages/sec the server received.
+    """
+    expected = received_echoes(server) + messages // senders * senders
+    start = time.perf_counter()
+    swarm.send_echoes(messages, senders)
+    wait_until(lambda: received_echoes(server) >= expected, timeout=300, interval=0.005)
+    return messages // senders * senders / (time.perf_counter() - start)
+
+
+def measure_broadcast(server: RCEServer, rounds: int, interval: float):
+    """
+    Broadcasts ECHO messages carrying the time they were broadcast at, the swarm records their latency.
+    """
+    for _ in range(rounds):
+        server.broadcast_message(Message(MessageType.ECHO, BROADCAST_PREFIX + str(time.monotonic_ns()).encode()))
+        time.sleep(interval)
+
+
+def measure_cmd(server: RCEServer, observer: ExitObserver, rounds: int) -> list[float]:
+    """
+    :return: The round trip in milliseconds of CMD requests sent one after the other to random clients.
+    """
+    clients = server.get_clients()
+    round_trips = []
+    for _ in range(rounds):
+        request_id = server.next_request_id()
+        exited = observer.expect(request_id)
+        start = time.perf_counter()
+        random.choice(clients).send_message(Message(MessageType.CMD, b"true", request_id=request_id))
+        if not exited.wait(30):
+            raise TimeoutError(f"CMD request #{request_id} did not complete")
+        round_trips.append((time.perf_counter() - start) * 1000)
+    return round_trips
+
+
+def measure_transfer(server: RCEServer, size: int, transfers: int) -> float:
+    """
+    :return: The MB/s pushed to the tagged clients, summed over the clients.
+    """
+    with tempfile.NamedTemporaryFile(delete=False) as file:
+        file.write(os.urandom(size))
+    try:
+        total = 0
+        start = time.perf_counter()
+        for _ in range(transfers):
+            report = server.push_file(file.name, selector=f"tag={TRANSFER_TAG}")
+            total += size * sum(error is None for error in report.values())
+        return total / config.MB / (time.perf_counter() - start)
+    finally:
+        os.unlink(file.name)
+
+
+def run_engine(engine: str, port: int, args) -> dict:
+    observer = ExitObserver()
+    server = RCEServer("127.0.0.1", port, engine=engine)
+    server.observers = [server.metrics, observer]  # Without the Logger, the terminal is not benchmarked
+    server.start()
+
+    swarm = None
+    try:
+        rss_before = rss_bytes()
+        swarm = Swarm(port, args.clients, args.processes, args.transfer_clients)
+        connect_seconds = swarm.wait_ready()
+        wait_until(lambda: len(server.clients) == args.clients)
+        rss_per_connection = (rss_bytes() - rss_before) / args.clients
+
+        echo_rate = measure_echo(server, swarm, args.messages, args.senders)
+        measure_broadcast(server, args.broadcasts, args.broadcast_interval)
+        cmd_round_trips = measure_cmd(server, observer, args.commands)
+        transfer_rate = measure_transfer(server, args.transfer_size, args.transfers)
+        wait_until(lambda: sum(len(report["broadcast_latencies_ms"]) for report in swarm.report())
+                   >= args.broadcasts * args.clients, timeout=60, interval=0.5)
+        latencies = [latency for report in swarm.report() for latency in report["broadcast_latencies_ms"]]
+    finally:
+        if swarm:
+            swarm.close()
+        server.stop()
+
+    return {
+        "connect_seconds": round(connect_seconds, 3),
+        "rss_per_connection_kb": round(rss_per_connection / config.KB, 2),
+        "echo_messages_per_sec": round(echo_rate),
+        "broadcast_latency_ms": percentiles(latencies),
+        "cmd_round_trip_ms": percentiles(cmd_round_trips),
+        "file_transfer_mb_per_sec": round(transfer_rate, 2),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: dict, prefix="") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Prints the change of every metric relative to a baseline run, improvements are marked with a +.
+    """
+    current, previous = flatten(results["engines"]), flatten(baseline["engines"])
+    print(f"\nCompared to {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp')}):")
+    if baseline.get("parameters") != results["parameters"]:
+        print("  The runs used different parameters, their results may not be comparable")
+    for key, value in current.items():
+        if not (old := previous.get(key)):
+            continue
+        change = (value - old) / old * 100
+        better = change < 0 if any(marker in f"{key}." for marker in LOWER_IS_BETTER) else change > 0
+        print(f"  {key:<45} {old:>12} -> {value:>12} {change:>+8.1f}% {'+' if better else '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', '-c', type=int, default=2000)
+    parser.add_argument('--processes', type=int, default=2, help="number of swarm processes")
+    parser.add_argument('--engine', '-e', type=str, choices=config.SERVER_ENGINES,
+                        help="benchmark a single engine instead of all of them")
+    parser.add_argument('--messages', '-n', type=int, default=200_000, help="number of ECHO messages to send")
+    parser.add_argument('--senders', '-s', type=int, default=20, help="number of clients sending ECHO messages")
+    parser.add_argument('--broadcasts', type=int, default=20)
+    parser.add_argument('--broadcast-interval', type=float, default=0.05)
+    parser.add_argument('--commands', type=int, default=200, help="number of CMD round trips")
+    parser.add_argument('--transfer-clients', type=int, default=10)
+    parser.add_argument('--transfer-size', type=int, default=20 * config.MB)
+    parser.add_argument('--transfers', type=int, default=3)
+    parser.add_argument('--port', '-p', type=int, default=config.PORT + 200)
+    parser.add_argument('--output', '-o', type=str, help="file to write the results to as JSON")
+    parser.add_argument('--compare', type=str, help="results of a previous run to compare with")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    engines = [args.engine] if args.engine else list(config.SERVER_ENGINES)
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "engines": {},
+    }
+    for index, engine in enumerate(engines):
+        results["engines"][engine] = run_engine(engine, args.port + index, args)
+        print(f"{engine}: {json.dumps(results['engines'][engine])}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Measures the time and memory per million small messages of the Message class and FrameDecoder compared to the previous
+Message class, which had an instance dictionary and looked message types up through the Enum, and to the previous
+receive path, which read the length and the body of every frame separately. Nothing touches a socket: the frames are
+received from an in-memory stream of pre-framed messages.
+
+  decode: receiving and decoding the frames.
+  decode memory: the memory held per decoded message, measured with tracemalloc while all of them are kept alive.
+  encode: framing a batch of messages for one send, with a to_bytes() frame per message for the previous class and
+      pack_into() into one preallocated buffer for the current one. pack_into() trades some time for not allocating.
+  encode memory: the memory held by the framed batch.
+
+Usage: python benchmarks/message_codec.py [--messages N] [--size BYTES]
+"""
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Optional, Union
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.core.message import (COMPRESSED_FLAG, FRAME_HEADER, REQUEST_ID, REQUEST_ID_FLAG,  # noqa: E402
+                              TAGGED_FRAME_HEADER, FrameDecoder, Message, MessageType)
+
+
+class LegacyMessage:
+    """
+    The v1 decoding and encoding of the previous Message class.
+    """
+
+    def __init__(self, message_type: MessageType = None, data: Union[bytes, memoryview] = None, compressed=False,
+                 request_id: Optional[int] = None):
+        self.__type = message_type
+        self.__data = data if data else b''
+        self.__compressed = compressed
+        self.__request_id = request_id
+
+    @staticmethod
+    def from_bytes(data: Union[bytes, bytearray, memoryview]):
+        type_byte = data[0]
+        packet_data = b''
+        request_id = None
+        offset = 1
+        packet_type = MessageType(type_byte & ~(COMPRESSED_FLAG | REQUEST_ID_FLAG))
+        if type_byte & REQUEST_ID_FLAG:
+            request_id = REQUEST_ID.unpack_from(data, offset)[0]
+            offset += REQUEST_ID.size
+        if len(data) > offset:
+            packet_data = memoryview(data)[offset:]
+        return LegacyMessage(message_type=packet_type, data=packet_data, compressed=bool(type_byte & COMPRESSED_FLAG),
+                             request_id=request_id)
+
+    def to_bytes(self):
+        type_byte = self.__type.value | (COMPRESSED_FLAG if self.__compressed else 0)
+        if self.__request_id is None:
+            header = FRAME_HEADER.pack(len(self.__data) + 1, type_byte)
+        else:
+            header = TAGGED_FRAME_HEADER.pack(len(self.__data) + 1 + REQUEST_ID.size, type_byte | REQUEST_ID_FLAG,
+                                              self.__request_id)
+        return header[FRAME_HEADER.size - 1:] + self.__data
+
+
+class Stream:
+    """
+    In-memory stand-in for a socket, receives the frames in reads of at most the requested size.
+    """
+
+    def __init__(self, data: bytes):
+        self.__data = memoryview(data)
+        self.__position = 0
+
+    def recv_into(self, buffer: memoryview) -> int:
+        size = min(len(buffer), len(self.__data) - self.__position)
+        buffer[:size] = self.__data[self.__position:self.__position + size]
+        self.__position += size
+        return size
+
+    def receive_exactly(self, size: int) -> bytes:
+        data = bytes(self.__data[self.__position:self.__position + size])
+        self.__position += size
+        return data
+
+
+def legacy_decode(stream: Stream, count: int, keep: Optional[list]):
+    """
+    The previous receive path: one read for the length and one for the body of every frame.
+    """
+    for _ in range(count):
+        size = int.from_bytes(stream.receive_exactly(4), byteorder="little")
+        message = LegacyMessage.from_bytes(stream.receive_exactly(size))
+        if keep is not None:
+            keep.append(message)
+
+
+def bulk_decode(stream: Stream, count: int, keep: Optional[list]):
+    decoder = FrameDecoder()
+    while count:
+        decoder.fill(stream.recv_into)
+        frames = decoder.decode()
+        count -= len(frames)
+        if keep is not None:
+            keep.extend(message for message, _ in frames)
+
+
+def measure_decode(decode, frames: bytes, count: int) -> float:
+    start = time.perf_counter()
+    decode(Stream(frames), count, None)
+    return time.perf_counter() - start
+
+
+def measure_memory(decode, frames: bytes, count: int) -> float:
+    """
+    :return: The megabytes held per million decoded messages, the buffers the payloads point into included.
+    """
+    gc.collect()
+    tracemalloc.start()
+    keep = []
+    decode(Stream(frames), count, keep)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return held / count * 1_000_000 / 2 ** 20
+
+
+def encode(messages: list, pack: bool):
+    if not pack:
+        return [message.to_bytes() for message in messages]
+
+    batch = bytearray(sum(message.frame_size() for message in messages))
+    offset = 0
+    for message in messages:
+        offset += message.pack_into(batch, offset)
+    return batch
+
+
+def measure_encode(messages: list, pack: bool) -> tuple[float, float]:
+    """
+    :return: The seconds taken and the megabytes held per million messages.
+    """
+    start = time.perf_counter()
+    encode(messages, pack)
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    batch = encode(messages, pack)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del batch
+    return elapsed, held / len(messages) * 1_000_000 / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', '-n', type=int, default=1_000_000)
+    parser.add_argument('--size', '-s', type=int, default=32, help="payload size of the messages in bytes")
+    args = parser.parse_args()
+
+    payload = b"x" * args.size
+    frames = b"".join(bytes(header) + payload
+                      for header, _ in (Message(MessageType.ECHO, payload, request_id=index + 1).to_buffers()
+                                        for index in range(args.messages)))
+    per_million = 1_000_000 / args.messages
+
+    print(f"{args.messages} messages of {args.size} bytes, figures per million messages")
+    print(f"{'':<14} {'previous':>12} {'current':>12}")
+    legacy, current = (measure_decode(decode, frames, args.messages) for decode in (legacy_decode, bulk_decode))
+    print(f"{'decode':<14} {legacy * per_million:>11.3f}s {current * per_million:>11.3f}s  ({legacy / current:.2f}x)")
+    legacy, current = (measure_memory(decode, frames, args.messages) for decode in (legacy_decode, bulk_decode))
+    print(f"{'decode memory':<14} {legacy:>10.0f}MB {current:>10.0f}MB  ({legacy / current:.2f}x)")
+
+    legacy, legacy_held = measure_encode([LegacyMessage(MessageType.ECHO, payload, request_id=index + 1)
+                                          for index in range(args.messages)], pack=False)
+    current, current_held = measure_encode([Message(MessageType.ECHO, payload, request_id=index + 1)
+                                            for index in range(args.messages)], pack=True)
+    print(f"{'encode':<14} {legacy * per_million:>11.3f}s {current * per_million:>11.3f}s  ({legacy / current:.2f}x)")
+    print(f"{'encode memory':<14} {legacy_held:>10.0f}MB {current_held:>10.0f}MB  ({legacy_held / current_held:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
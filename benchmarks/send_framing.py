@@ -0,0 +1,78 @@
+"""
+Measures the messages/sec of ECHO-sized messages sent with the vectored send_message compared to the previous
+framing, which concatenated the type and payload and issued one sendall for the length and one for the body.
+
+Usage: python benchmarks/send_framing.py [--messages N] [--size BYTES]
+"""
+import argparse
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.core.base_client import BaseClientThread  # noqa: E402
+from src.core.message import Message, MessageType  # noqa: E402
+
+
+def legacy_send_message(sock: socket.socket, message: Message):
+    data = message.to_bytes()
+    data_size = len(data).to_bytes(4, byteorder="little")
+    sock.sendall(data_size)
+    sock.sendall(data)
+
+
+def drain(sock: socket.socket, total: int):
+    received = 0
+    buffer = bytearray(1 << 20)
+    while received < total:
+        if not (size := sock.recv_into(buffer)):
+            break
+        received += size
+
+
+def measure(vectored: bool, messages: int, size: int, nodelay: bool):
+    listener = socket.create_server(("127.0.0.1", 0))
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    if vectored:
+        client = BaseClientThread()
+        client.init(sender, sender.getpeername())
+        send = client.send_message
+    else:
+        def send(message: Message):
+            legacy_send_message(sender, message)
+    sender.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+    message = Message(MessageType.ECHO, b"x" * size)
+    drainer = threading.Thread(target=drain, args=(receiver, messages * (size + 5)))
+    drainer.start()
+    start = time.perf_counter()
+    for _ in range(messages):
+        send(message)
+    drainer.join()
+    elapsed = time.perf_counter() - start
+
+    for sock in (sender, receiver, listener):
+        sock.close()
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', '-n', type=int, default=200_000)
+    parser.add_argument('--size', '-s', type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'framing':<26} {'msgs/s':>10}")
+    for nodelay in (False, True):
+        legacy = measure(False, args.messages, args.size, nodelay)
+        vectored = measure(True, args.messages, args.size, nodelay)
+        print(f"{f'2x sendall (nodelay={nodelay})':<26} {legacy:>10.0f}")
+        print(f"{f'sendmsg (nodelay={nodelay})':<26} {vectored:>10.0f}  ({vectored / legacy:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
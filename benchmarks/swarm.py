@@ -0,0 +1,213 @@
+"""
+Swarm of lightweight simulated clients, thousands per process, which speak the real wire protocol over asyncio
+streams instead of running an RCEClient (and its threads) each. It is driven by loopback_suite.py through JSON lines:
+commands are read from stdin, events are written to stdout.
+
+The simulated clients:
+  - negotiate the protocol in their HELLO message, without compression, and report the tags they were given.
+  - record the latency of ECHO messages whose payload starts with BROADCAST_PREFIX and carries the time.monotonic_ns()
+    they were broadcast at, the monotonic clock is shared by the processes of a host.
+  - answer CMD requests with an OUTPUT and an EXIT message, without running anything.
+  - answer the heartbeats of the server.
+  - receive and discard file and directory transfers.
+
+Commands:
+  {"command": "echo", "messages": M, "senders": S}: the first S clients send M ECHO messages between them, answered
+      by {"event": "sent"} once they are written.
+  {"command": "report"}: answered by {"event": "report", ...} with the broadcast latencies and transfer counters.
+  {"command": "exit"}: closes the connections and exits.
+
+Usage: python benchmarks/swarm.py --port PORT [--host HOST] [--clients N] [--tagged K] [--tag TAG]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.core.message import (FILE_SIZE, OUTPUT_STDOUT, PROTOCOL_V1, PROTOCOL_V2, Message,  # noqa: E402
+                              MessageType)
+
+BROADCAST_PREFIX = b"broadcast:"
+CONNECT_CONCURRENCY = 64  # Stays within the listen backlog of the server (config.LISTEN_BACKLOG)
+CONNECT_TIMEOUT = 60.0
+ECHO_BATCH = 256
+FILE_BODY_TYPES = (MessageType.FILE, MessageType.END_OF_FILE)
+
+
+def raise_file_limit():
+    """
+    Raises the soft limit of open file descriptors to the hard limit, every connection needs one.
+    """
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class SwarmStats:
+    """
+    Measurements shared by the simulated clients of a process.
+    """
+
+    def __init__(self):
+        self.broadcast_latencies_ms: list[float] = []
+        self.transfers = 0
+        self.transfer_bytes = 0
+        self.commands = 0
+
+
+class SimulatedClient:
+    """
+    A connection speaking the client side of the protocol, see the module docstring for its behaviour.
+    """
+
+    def __init__(self, tags: list[str], stats: SwarmStats):
+        self.tags = tags
+        self.stats = stats
+        self.protocol_version = PROTOCOL_V1
+        self.ready = asyncio.Event()
+        self.__reader: asyncio.StreamReader = None
+        self.__writer: asyncio.StreamWriter = None
+
+    async def connect(self, host: str, port: int):
+        self.__reader, self.__writer = await asyncio.open_connection(host, port)
+        self.send(Message(MessageType.HELLO, json.dumps({
+            "compression": [],
+            "protocol": [PROTOCOL_V1, PROTOCOL_V2],
+            "payload_cache": False,
+            "tags": self.tags,
+            "hostname": "swarm",
+            "heartbeat": True,
+        }).encode()))
+
+    def send(self, message: Message):
+        self.__writer.writelines(message.to_buffers(self.protocol_version))
+
+    async def send_echoes(self, count: int):
+        """
+        Sends ECHO messages as fast as the connection takes them, in batches of pre-framed messages.
+        """
+        header, payload = Message(MessageType.ECHO, b"x" * 64).to_buffers(self.protocol_version)
+        batch = (bytes(header) + bytes(payload)) * ECHO_BATCH
+        while count > 0:
+            if count < ECHO_BATCH:
+                batch = batch[:len(batch) // ECHO_BATCH * count]
+            self.__writer.write(batch)
+            await self.__writer.drain()
+            count -= ECHO_BATCH
+
+    async def run(self):
+        try:
+            while True:
+                data = await self.__reader.readexactly(int.from_bytes(await self.__reader.readexactly(4), "little"))
+                await self.__handle(Message.from_bytes(data))
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__writer and not self.__writer.is_closing():
+            self.send(Message(MessageType.DISCONNECT))
+            self.__writer.close()
+
+    async def __handle(self, message: Message):
+        message_type = message.get_type()
+        if message_type == MessageType.HELLO:
+            self.protocol_version = json.loads(message.decode()).get("protocol", PROTOCOL_V1)
+            self.ready.set()
+        elif message_type == MessageType.ECHO:
+            if bytes(message.data[:len(BROADCAST_PREFIX)]) == BROADCAST_PREFIX:
+                sent_at = int(bytes(message.data[len(BROADCAST_PREFIX):]))
+                self.stats.broadcast_latencies_ms.append((time.monotonic_ns() - sent_at) / 1e6)
+        elif message_type == MessageType.PING:
+            self.send(Message(MessageType.PONG, bytes(message.data)))
+        elif message_type == MessageType.CMD:
+            self.stats.commands += 1
+            self.send(Message(MessageType.OUTPUT, bytes([OUTPUT_STDOUT]) + b"ok\n", request_id=message.request_id))
+            self.send(Message(MessageType.EXIT, b'{"status": 0, "truncated": false}', request_id=message.request_id))
+        elif message_type in FILE_BODY_TYPES:
+            self.stats.transfer_bytes += len(message.data)
+            if message_type == MessageType.END_OF_FILE:
+                self.stats.transfers += 1
+        elif message_type == MessageType.FILE_STREAM:
+            remaining = FILE_SIZE.unpack(message.data)[0]
+            while remaining:
+                remaining -= len(await self.__reader.readexactly(min(remaining, 1 << 20)))
+            self.stats.transfer_bytes += FILE_SIZE.unpack(message.data)[0]
+            self.stats.transfers += 1
+
+
+def emit(event: str, **fields):
+    print(json.dumps({"event": event, **fields}), flush=True)
+
+
+async def read_commands():
+    """
+    Yields the commands read from stdin, without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while line := await loop.run_in_executor(None, sys.stdin.readline):
+        yield json.loads(line)
+
+
+async def swarm(host: str, port: int, clients: int, tagged: int, tag: str):
+    stats = SwarmStats()
+    swarm_clients = [SimulatedClient([tag] if index < tagged else [], stats) for index in range(clients)]
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    tasks: set[asyncio.Task] = set()
+
+    async def connect(client: SimulatedClient):
+        async with semaphore:
+            await client.connect(host, port)
+            tasks.add(asyncio.create_task(client.run()))
+            await client.ready.wait()
+
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(connect(client) for client in swarm_clients)), CONNECT_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        emit("error", error=repr(e))
+        return
+    emit("ready", clients=clients, seconds=time.perf_counter() - started)
+
+    async for command in read_commands():
+        if command["command"] == "echo":
+            senders = swarm_clients[:command["senders"]]
+            per_sender = command["messages"] // len(senders)
+            await asyncio.gather(*(client.send_echoes(per_sender) for client in senders))
+            emit("sent", messages=per_sender * len(senders))
+        elif command["command"] == "report":
+            emit("report", broadcast_latencies_ms=stats.broadcast_latencies_ms, transfers=stats.transfers,
+                 transfer_bytes=stats.transfer_bytes, commands=stats.commands)
+        elif command["command"] == "exit":
+            break
+
+    for client in swarm_clients:
+        client.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', '-p', type=int, required=True)
+    parser.add_argument('--clients', '-c', type=int, default=1000)
+    parser.add_argument('--tagged', type=int, default=0, help="number of clients that report --tag")
+    parser.add_argument('--tag', type=str, default="bench")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    asyncio.run(swarm(args.host, args.port, args.clients, args.tagged, args.tag))
+
+
+if __name__ == '__main__':
+    main()
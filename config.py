@@ -1,10 +1,10 @@
-import re
 from pathlib import Path
 
 HOST = "localhost"
 PORT = 6000
 
-IPV4_PATTERN = re.compile(r'^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}):(\d{1,5})$')
+# Tags a client reports to the server when it connects, servers select groups of clients by them (e.g. "tag=web")
+CLIENT_TAGS = ()
 
 BASE_DIR = Path(__file__).resolve().parent
 DOWNLOAD_DIR = BASE_DIR / "Downloads"
@@ -16,3 +16,154 @@ if not DOWNLOAD_DIR.exists():
 KB = 1024
 MB = KB ** 2
 FILE_CHUNK_SIZE = 5 * MB
+
+# File transfer modes: "chunked" sends one FILE message per chunk, "sendfile" sends the raw file body with the
+# kernel's zero-copy sendfile after a FILE_STREAM header carrying the file size (peers that did not announce FILE_STREAM
+# support in their HELLO message are sent files chunked instead), "delta" only sends the blocks the receiver's version
+# of the file lacks (protocol v2 and a request ID only, otherwise "sendfile" is used), "striped" sends large files over
+# several data connections in parallel (see below, otherwise "sendfile" is used). Receivers accept all of them.
+FILE_TRANSFER_MODES = ("chunked", "sendfile", "delta", "striped")
+FILE_TRANSFER_MODE = "sendfile"
+
+# Striped transfers split a file into FILE_STRIPES byte ranges (stripes) that are sent in parallel, each over an
+# additional data connection to the same peer, so that the window of a single TCP connection does not bound the
+# throughput of high-latency links. The receiver writes the stripes in place with positioned writes. Data connections
+# are always opened by the client to the server's port, they have to come up within FILE_STRIPE_TIMEOUT seconds and
+# fail once they stall for that long. The "striped" mode only stripes files of at least FILE_STRIPE_MIN_SIZE bytes,
+# it needs protocol v2, a request ID and peers that announced striping support (sharded servers do not).
+FILE_STRIPES = 4
+FILE_STRIPE_MIN_SIZE = 64 * MB
+FILE_STRIPE_TIMEOUT = 30.0
+# Connections are only registered as clients, and reported to the observers and metrics, once their HELLO message
+# shows that they are not data connections of a striped transfer. Connections that send no HELLO message within
+# HELLO_TIMEOUT seconds, e.g. of clients that predate it, are registered regardless.
+HELLO_TIMEOUT = 1.0
+
+# Server engines
+SERVER_ENGINES = ("thread", "async")
+SERVER_ENGINE = "thread"
+
+# Length of the queue of connections waiting to be accepted, large enough to absorb reconnect storms. The kernel caps
+# it at net.core.somaxconn.
+LISTEN_BACKLOG = 1024
+# A sharded server runs SERVER_SHARDS server processes that share the port with SO_REUSEPORT, the kernel spreads the
+# incoming connections over them (see ShardedServer). 1 runs a single server in the current process.
+SERVER_SHARDS = 1
+
+# File pushes and payload sources are sent to the clients concurrently by a bounded pool of workers, each send is
+# aborted after the timeout (seconds). Other broadcasts are posted to the outbound queues of the clients.
+BROADCAST_WORKERS = 64
+BROADCAST_SEND_TIMEOUT = 30.0
+# Pushes to protocol v1 clients and striped pushes hold a worker for the whole transfer to every client, they run on a
+# pool of their own so that they never starve the sends of the broadcast workers.
+TRANSFER_WORKERS = 64
+
+# Every connection queues the messages posted to it without blocking (e.g. broadcasts) and writes them from its own
+# writer. Once OUTBOUND_HIGH_WATER bytes are queued the connection is congested and refuses new messages until the
+# queue has drained to OUTBOUND_LOW_WATER bytes. Connections that stay congested for OUTBOUND_STALL_TIMEOUT seconds
+# are dropped.
+OUTBOUND_HIGH_WATER = 4 * MB
+OUTBOUND_LOW_WATER = 1 * MB
+OUTBOUND_STALL_TIMEOUT = 30.0
+
+# Framing. Peers negotiate the highest common protocol version at connect time: v1 frames carry the message type,
+# v2 frames also carry a stream ID, so that several file transfers and command streams can share a connection.
+PROTOCOL_VERSIONS = (1, 2)
+RECEIVE_BUFFER_SIZE = 64 * KB
+MAX_MESSAGE_SIZE = FILE_CHUNK_SIZE + MB
+TCP_NODELAY = True
+
+# Heartbeats. The server sends a PING message every HEARTBEAT_INTERVAL seconds to the clients that announced heartbeat
+# support, which answer with a PONG message, the round trip gives the RTT of the connection. Peers that have received
+# nothing from the other side for HEARTBEAT_TIMEOUT seconds consider it dead and close the connection. Connections of
+# clients without heartbeat support are probed by TCP keepalive instead, with the same interval and timeout.
+# A HEARTBEAT_INTERVAL of None disables heartbeats and keepalive probes.
+HEARTBEAT_INTERVAL = 15.0
+HEARTBEAT_TIMEOUT = 45.0
+
+# Compression, negotiated at connect time. Algorithms are listed in order of preference.
+COMPRESSION_ALGORITHMS = ("zlib", "lzma")
+COMPRESSION_LEVEL = 6
+# Bodies smaller than this are never compressed
+COMPRESSION_MIN_SIZE = 512
+# Data is considered already compressed if a sample of it does not shrink below this ratio
+COMPRESSION_SAMPLE_SIZE = 4 * KB
+COMPRESSION_MAX_RATIO = 0.9
+
+# Command output is streamed in OUTPUT messages of up to COMMAND_OUTPUT_CHUNK_SIZE bytes as it is produced. Commands
+# whose output exceeds COMMAND_OUTPUT_LIMIT bytes are killed and their output is reported as truncated.
+COMMAND_OUTPUT_CHUNK_SIZE = 64 * KB
+COMMAND_OUTPUT_LIMIT = 64 * MB
+# Batches (BATCH messages) carry a list of commands that the client runs one after the other, it answers with the
+# results of all of them in a single BATCH_RESULT message. The output of the commands of a batch is limited to
+# BATCH_OUTPUT_LIMIT bytes in total, so that the results fit in one frame (JSON escaping at most sextuples it), the
+# output beyond it is discarded. Commands of a command file without a timeout option run for at most
+# BATCH_COMMAND_TIMEOUT seconds, None lets them run until they exit.
+BATCH_OUTPUT_LIMIT = 512 * KB
+BATCH_COMMAND_TIMEOUT = 60.0
+
+# Directories are streamed as a tar archive in FILE chunks and extracted while they arrive. At most this many chunks
+# are queued for extraction, receiving waits if extraction falls behind.
+DIRECTORY_EXTRACT_QUEUE_SIZE = 4
+
+# Incoming files are written to disk by a writer thread per transfer, so that a slow disk does not stall the connection
+# the file is received on. Received data is copied into buffers of DISK_WRITE_BUFFER_SIZE bytes taken from a pool of
+# at most DISK_WRITE_BUFFERS buffers shared by all transfers, receiving waits for a free buffer when the disks fall
+# behind. FILE_DURABILITY decides when received files are flushed to stable storage: "none" leaves it to the operating
+# system, "eof" syncs every file before it is moved to its destination and "periodic" also syncs it every
+# FILE_DURABILITY_INTERVAL seconds while it is written.
+DISK_WRITE_BUFFER_SIZE = 1 * MB
+DISK_WRITE_BUFFERS = 64
+FILE_DURABILITY_MODES = ("none", "eof", "periodic")
+FILE_DURABILITY = "none"
+FILE_DURABILITY_INTERVAL = 5.0
+
+# Delta transfers ("delta" transfer mode) compare the file block by block with the receiver's version of it and only
+# send the blocks that differ. Blocks are DELTA_BLOCK_SIZE bytes, doubled until the file has at most DELTA_MAX_BLOCKS,
+# but never larger than a FILE_BLOCK message of at most MAX_MESSAGE_SIZE bytes can carry.
+# The sender waits up to FILE_SYNC_TIMEOUT seconds for the receiver to hash its version of the file.
+DELTA_BLOCK_SIZE = 256 * KB
+DELTA_MAX_BLOCKS = 64 * KB
+FILE_SYNC_TIMEOUT = 300.0
+
+# Payloads are identified by the hash of their source. The server offers the hash first and only sends the source to
+# clients that do not have it cached, it waits up to PAYLOAD_OFFER_TIMEOUT seconds for their answer. Clients keep the
+# compiled form of the PAYLOAD_CACHE_SIZE most recently used payloads.
+PAYLOAD_CACHE_SIZE = 16
+PAYLOAD_OFFER_TIMEOUT = 10.0
+
+# Server events are delivered to every observer by a dispatcher thread of its own, through a queue of at most
+# OBSERVER_QUEUE_SIZE events. When an observer falls behind, its overflow_policy (OBSERVER_OVERFLOW_POLICY by default)
+# decides whether the oldest or the newest event is dropped, or whether the publisher waits.
+OBSERVER_QUEUE_SIZE = 10_000
+OBSERVER_OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+OBSERVER_OVERFLOW_POLICY = "drop_oldest"
+# Maximum number of seconds the server waits on stop for each observer to receive the events still queued for it
+OBSERVER_FLUSH_TIMEOUT = 5.0
+
+# Metrics of the server (see MetricsObserver): the bucket bounds of the CMD/EXECUTE/BATCH round trip latency histograms
+# in seconds and of the file transfer throughput histogram in bytes per second, and the window in seconds over which
+# connect and disconnect rates are computed. Round trips are timed for at most METRICS_PENDING_REQUESTS requests per
+# client, requests that never get a reply (e.g. payloads without output on older clients) are forgotten beyond that.
+# If METRICS_FILE is set, the metrics are written to it in the Prometheus text format every METRICS_EXPORT_INTERVAL
+# seconds, e.g. for the textfile collector of the node exporter.
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_THROUGHPUT_BUCKETS = (1 * MB, 5 * MB, 10 * MB, 25 * MB, 50 * MB, 100 * MB, 250 * MB, 500 * MB, 1024 * MB)
+METRICS_RATE_WINDOW = 60.0
+METRICS_PENDING_REQUESTS = 1024
+METRICS_FILE = None
+METRICS_EXPORT_INTERVAL = 15.0
+
+# Requests fanned out with RCEServer.fan_out wait up to GATHER_TIMEOUT seconds for the clients to complete them, the
+# progress of the gathering is reported every GATHER_PROGRESS_INTERVAL seconds.
+GATHER_TIMEOUT = 60.0
+GATHER_PROGRESS_INTERVAL = 0.5
+
+# Maximum number of requests of each message type that a client runs concurrently, requests beyond that are queued
+CLIENT_CONCURRENCY = {
+    "CMD": 4,
+    "EXECUTE": 2,
+    "BATCH": 2,
+    "FILE_DOWNLOAD": 2,
+    "FILE_SYNC": 2,
+}
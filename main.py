@@ -4,11 +4,25 @@ import config
 from src.client.rce_client import RCEClient
 from src.console.server_cli import ServerCLI
 from src.server.rce_server import RCEServer
+from src.server.sharded_server import ShardedServer
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument('--mode', '-m', type=str, default='server', choices=['server', 'client'])
 arg_parser.add_argument('--host', '-H', type=str, default=config.HOST)
 arg_parser.add_argument('--port', '-p', type=int, default=config.PORT)
+arg_parser.add_argument('--engine', '-e', type=str, default=config.SERVER_ENGINE, choices=config.SERVER_ENGINES)
+arg_parser.add_argument('--shards', type=int, default=config.SERVER_SHARDS,
+                        help="number of server processes sharing the port, the CLI controls all of them")
+arg_parser.add_argument('--backlog', type=int, default=config.LISTEN_BACKLOG,
+                        help="length of the queue of connections waiting to be accepted")
+arg_parser.add_argument('--tags', '-t', type=str, default=','.join(config.CLIENT_TAGS),
+                        help="comma-separated tags the client reports to the server")
+arg_parser.add_argument('--metrics-file', type=str, default=config.METRICS_FILE,
+                        help="file the server writes its metrics to in the Prometheus text format")
+arg_parser.add_argument('--heartbeat-interval', type=float, default=config.HEARTBEAT_INTERVAL,
+                        help="seconds between two heartbeats of a client, 0 disables heartbeats")
+arg_parser.add_argument('--heartbeat-timeout', type=float, default=config.HEARTBEAT_TIMEOUT,
+                        help="seconds after which the server reaps a client it has received nothing from")
 arg_parser.add_argument('--debug', '-d', action='store_true', default=0)
 args = arg_parser.parse_args()
 
@@ -20,14 +34,21 @@ def main():
     if args.mode == 'client':
         client = None
         try:
-            client = RCEClient(host=args.host, port=args.port, debug=args.debug)
+            tags = [tag for tag in args.tags.split(',') if tag]
+            client = RCEClient(host=args.host, port=args.port, debug=args.debug, tags=tags)
             client.start()
         except KeyboardInterrupt:
             client.close()
     elif args.mode == 'server':
         server_cli = None
         try:
-            server = RCEServer(args.host, args.port, args.debug)
+            options = {"engine": args.engine, "metrics_file": args.metrics_file,
+                       "heartbeat_interval": args.heartbeat_interval or None,
+                       "heartbeat_timeout": args.heartbeat_timeout, "backlog": args.backlog}
+            if args.shards > 1:
+                server = ShardedServer(args.host, args.port, args.shards, args.debug, **options)
+            else:
+                server = RCEServer(args.host, args.port, args.debug, **options)
             server_cli = ServerCLI(server)
             ServerCLI(server).cmdloop()
         except KeyboardInterrupt:
@@ -1,23 +1,47 @@
+import json
 import os
+import signal
+import socket
 import subprocess
-import sys
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Optional
 
+import config
 from src.core.base_client import BaseClientThread
+from src.core.command_batch import CommandResult, decode_batch, encode_results
+from src.core.compression import Compression
 from src.core.exception import MessageTypeError, FileWriteError, FileReadError
+from src.core.file_transfer import FILE_BODY_TYPES
 from src.core.logger import Logger
-from src.core.message import MessageType, Message
+from src.core.message import OUTPUT_STDERR, OUTPUT_STDOUT, PROTOCOL_V1, MessageType, Message
+from src.core.payload_cache import PayloadCache, payload_digest
+from src.core.striped_transfer import HAS_PWRITE
 
 
 class RCEClient(BaseClientThread):
     """
     A client thread that connects to a remote server and performs actions based on incoming messages from the server.
+    Commands, batches of commands, payload executions and file downloads are run as jobs by a bounded pool of workers
+    per message type (config.CLIENT_CONCURRENCY), so the receiving thread stays free for control messages. The results
+    of a job are tagged with the request ID of the message that started it.
     """
 
-    def __init__(self, host='localhost', port=6000, debug=False):
+    def __init__(self, host='localhost', port=6000, debug=False, tags=config.CLIENT_TAGS):
+        """
+        :param host: The hostname or IP of the server.
+        :param port: The port number the server listens on.
+        :param debug: Whether debug messages are logged.
+        :param tags: The tags reported to the server, which selects groups of clients by them.
+        """
         super().__init__()
         self.cwd = Path.cwd()
+        self.tags = list(tags)
+        self.__executors: dict[MessageType, ThreadPoolExecutor] = {}
+        self.__payload_cache = PayloadCache()
+        self.__payload_offers: dict[Optional[int], tuple[str, str]] = {}
         self.__logger = Logger(self.__class__.__name__, debug)
         try:
             self.connect_to_server(host, port)
@@ -33,6 +57,18 @@ class RCEClient(BaseClientThread):
         message type.
         """
         self.__logger.on_info("Listening for messages...")
+        self.send_message(Message(MessageType.HELLO, json.dumps({
+            "compression": list(config.COMPRESSION_ALGORITHMS),
+            "protocol": list(config.PROTOCOL_VERSIONS),
+            "payload_cache": True,
+            "tags": self.tags,
+            "hostname": socket.gethostname(),
+            "heartbeat": True,
+            "stripes": HAS_PWRITE,
+            "batch": True,
+            "file_stream": True,
+            "request_ids": True,
+        }).encode()))
         while self.is_connected():
             try:
                 message = self.receive_message()
@@ -40,29 +76,58 @@ class RCEClient(BaseClientThread):
                     raise OSError("RECEIVED DISCONNECT")
 
                 if message.is_type(MessageType.ECHO):
-                    self.__logger.on_info(message.data.decode())
+                    self.__logger.on_info(message.decode())
                     self.send_message(message)
                 elif message.is_type(MessageType.CMD):
                     self.__logger.on_debug(f"Executing command:\n\t{message}")
-                    self.execute_command(message)
+                    self.__dispatch(message, self.execute_command)
+                elif message.is_type(MessageType.BATCH):
+                    self.__logger.on_debug("Executing batch...")
+                    self.__dispatch(message, self.execute_batch)
                 elif message.is_type(MessageType.FILE_UPLOAD):
                     self.__logger.on_debug("Receiving file...")
-                    file_path = Path(message.data.decode())
-                    self.receive_file(file_path.name, file_path.parent)
-                    self.__logger.on_info(f"File '{file_path}' received")
+                    file_path = self.cwd / message.decode()
+                    if self.receive_file(file_path.name, file_path.parent, message.request_id):
+                        self.__logger.on_info(f"{'Directory' if file_path.is_dir() else 'File'} '{file_path}' received")
+                elif message.is_type(MessageType.DIRECTORY_UPLOAD):
+                    self.__logger.on_debug("Receiving directory...")
+                    dir_path = self.cwd / message.decode()
+                    if self.receive_directory(dir_path.name, dir_path.parent, message.request_id):
+                        self.__logger.on_info(f"Directory '{dir_path}' received")
+                elif message.get_type() in FILE_BODY_TYPES:
+                    if file_path := self.receive_file_message(message):
+                        self.__logger.on_info(f"{'Directory' if file_path.is_dir() else 'File'} '{file_path}' received")
                 elif message.is_type(MessageType.FILE_DOWNLOAD):
-                    self.__logger.on_debug("Sending file...")
-                    filename = message.data.decode()
-                    self.send_file(filename)
-                    self.__logger.on_debug(f"File '{filename}' sent")
+                    self.__dispatch(message, self.__send_requested_file)
+                elif message.is_type(MessageType.FILE_SYNC):
+                    self.__dispatch(message, self.__receive_file_sync)
+                elif message.is_type(MessageType.FILE_SIGNATURE):
+                    if not self.pending_replies.resolve(message):
+                        self.__logger.on_debug(f"Unexpected signature for request #{message.request_id}")
+                elif message.is_type(MessageType.PAYLOAD_OFFER):
+                    self.offer_payload(message)
                 elif message.is_type(MessageType.INJECT):
                     self.__logger.on_debug(f"injecting:\n\t{message}")
                     self.inject_payload(message)
                 elif message.is_type(MessageType.EXECUTE):
                     self.__logger.on_debug(f"executing:\n\t{message}")
-                    self.execute_payload()
+                    self.__dispatch(message, self.execute_payload)
+                elif message.is_type(MessageType.PING):
+                    self.post_message(Message(MessageType.PONG, bytes(message.data)))
+                elif message.is_type(MessageType.HELLO):
+                    capabilities = json.loads(message.decode())
+                    self.compression = Compression(capabilities.get("compression"))
+                    self.protocol_version = capabilities.get("protocol", PROTOCOL_V1)  # v1 servers do not answer it
+                    self.striping = bool(capabilities.get("stripes"))
+                    self.file_stream = bool(capabilities.get("file_stream"))
+                    self.request_ids = bool(capabilities.get("request_ids"))
+                    if heartbeat := capabilities.get("heartbeat"):  # The server pings, its silence means it is gone
+                        self.set_receive_timeout(heartbeat["timeout"])
+                    self.__logger.on_debug(f"Negotiated compression: {self.compression.algorithm}, "
+                                           f"protocol: v{self.protocol_version}")
                 elif message.is_type(MessageType.ERROR):
-                    self.__logger.on_debug(f"error:\n\t{message}")
+                    if not self.pending_replies.resolve(message):
+                        self.__logger.on_debug(f"error:\n\t{message}")
                 else:
                     self.__logger.on_debug(f"Unknown message type: {message.get_type()}")
             except (FileNotFoundError, MessageTypeError, FileWriteError, FileReadError) as e:
@@ -74,6 +139,51 @@ class RCEClient(BaseClientThread):
                 self.__logger.on_debug(f"[REASON] {e}")
                 break
 
+        for executor in self.__executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.abort_file_transfers()
+        self.pending_replies.fail_all(OSError("Connection closed"))
+
+    def __dispatch(self, message: Message, job: Callable[[Message], None]):
+        """
+        Queues a job on the worker pool of the message's type.
+        :param message: The message that requests the job.
+        :param job: The function running the job.
+        """
+        message_type = message.get_type()
+        if not (executor := self.__executors.get(message_type)):
+            executor = ThreadPoolExecutor(max_workers=config.CLIENT_CONCURRENCY.get(message_type.name, 1),
+                                          thread_name_prefix=message_type.name.lower())
+            self.__executors[message_type] = executor
+        executor.submit(self.__run_job, job, message.copy())  # The payload must outlive the receive buffer
+
+    def __run_job(self, job: Callable[[Message], None], message: Message):
+        try:
+            job(message)
+        except (FileNotFoundError, MessageTypeError, FileWriteError, FileReadError) as e:
+            self.__logger.on_error(e)
+            try:
+                self.send_message(Message(MessageType.ERROR, traceback.format_exc().encode(),
+                                          request_id=message.request_id))
+            except OSError:
+                self.__logger.on_error("Connection closed by peer")
+        except OSError as e:
+            self.__logger.on_debug(f"Job {message.get_type()} #{message.request_id} failed: {e}")
+
+    def __send_requested_file(self, message: Message):
+        self.__logger.on_debug("Sending file...")
+        filename = str(self.cwd / message.decode())
+        if Path(filename).is_dir():
+            self.send_directory(filename, request_id=message.request_id)
+        elif throughput := self.send_file(filename, request_id=message.request_id):
+            self.__logger.on_info(f"File '{filename}' sent in stripes at {throughput / config.MB:.1f} MB/s")
+            return
+        self.__logger.on_debug(f"File '{filename}' sent")
+
+    def __receive_file_sync(self, message: Message):
+        self.__logger.on_debug("Receiving file delta...")
+        self.receive_file_sync(message, self.cwd)
+
     # noinspection PyMethodMayBeStatic
     def payload(self):
         """
@@ -81,85 +191,280 @@ class RCEClient(BaseClientThread):
         """
         return "No payload has been injected"
 
+    def offer_payload(self, message: Message):
+        """
+        Answers the server's offer of a payload with whether the payload is cached. A cached payload is bound to the
+        offered name right away, otherwise the server follows up with an INJECT message carrying the source.
+        :param message: The PAYLOAD_OFFER message carrying the name and content hash of the payload as JSON.
+        :raises MessageTypeError: If the offer is malformed.
+        """
+        try:
+            offer = json.loads(message.decode())
+            name, digest = offer["name"], offer["hash"]
+        except (ValueError, KeyError):
+            raise MessageTypeError("Received malformed payload offer")
+
+        cached = self.__payload_cache.bind(name, digest)
+        if cached:
+            self.__use_payload(self.__payload_cache.get(name))
+            self.__logger.on_debug(f"Payload '{name}' ({digest[:12]}) is cached")
+        else:
+            self.__payload_offers[message.request_id] = (name, digest)
+        self.send_message(Message(MessageType.PAYLOAD_STATUS, json.dumps({"cached": cached}).encode(),
+                                  request_id=message.request_id))
+
     def inject_payload(self, message: Message):
         """
         Injects the payload from the received message.
 
         The payload is:
-          - Decoded from the message data.
-          - Executed using the built-in exec() function with local and global scope.
-          - Assigned as an attribute of the RCEClient class.
+          - Compiled from the message data and executed in a copy of this module's namespace.
+          - Cached under the name and hash it was offered with, if the server offered it first (see offer_payload).
+          - Assigned as the payload attribute of the RCEClient class.
 
         :param message: The message containing the payload to be injected.
         """
-        received_payload = message.data
+        received_payload = bytes(message.data)
+        name, digest = self.__payload_offers.pop(message.request_id, (None, None))
         self.__logger.on_debug("Injecting payload:\n" + received_payload.decode())
         try:
-            exec(received_payload, locals(), globals())
-            setattr(RCEClient, "payload", getattr(sys.modules[__name__], "payload"))
+            if digest and payload_digest(received_payload) != digest:
+                raise MessageTypeError(f"Payload '{name}' does not match the offered hash {digest[:12]}")
+
+            namespace = dict(globals())
+            exec(compile(received_payload, f"<payload {name or ''}>", "exec"), namespace)
+            if not callable(payload := namespace.get("payload")):
+                raise AttributeError("The injected code does not define a payload function")
+
+            if name:
+                self.__payload_cache.add(name, digest, payload)
+            self.__use_payload(payload)
             self.__logger.on_debug("Injected payload")
-            self.send_message(Message(message_type=MessageType.ECHO, data=b"Payload injected"))
-        except AttributeError as e:
+            self.send_message(Message(message_type=MessageType.ECHO, data=b"Payload injected",
+                                      request_id=message.request_id))
+        except (AttributeError, SyntaxError, MessageTypeError) as e:
             self.__logger.on_error(e)
-            self.send_message(Message(MessageType.ERROR, traceback.format_exc().encode()))
+            self.send_message(Message(MessageType.ERROR, traceback.format_exc().encode(),
+                                      request_id=message.request_id))
         except OSError:
             self.__logger.on_error("Connection closed by peer")
 
-    def execute_payload(self):
+    @staticmethod
+    def __use_payload(payload: Callable):
+        """
+        Makes the payload the one executed by EXECUTE messages that do not name a payload.
         """
-        Executes the payload and sends its output back to the server.
+        setattr(RCEClient, "payload", payload)
+
+    def execute_payload(self, message: Message):
+        """
+        Executes the payload and sends its output back to the server. A payload without output is answered with an EXIT
+        message instead, so that the server knows it has completed.
+        :param message: The EXECUTE message, whose request ID the output is tagged with. It carries the name of a
+            cached payload, or nothing to execute the last injected one.
         :raises: OSError: If an error occurs while sending the output back to the server.
         """
         # noinspection PyBroadException
         try:
-            if not (output := self.payload()):
+            if name := message.decode():
+                if not (payload := self.__payload_cache.get(name)):
+                    raise LookupError(f"Payload '{name}' is not cached, it has to be injected again")
+                output = payload(self)
+            else:
+                output = self.payload()
+            if not output:
+                self.send_message(Message(MessageType.EXIT, json.dumps({"status": 0, "truncated": False}).encode(),
+                                          request_id=message.request_id))
                 return
 
             output = str(output)
             self.__logger.on_debug(f"Output from payload execution:\n{output}")
             self.send_message(
-                Message(message_type=MessageType.ECHO, data=output.encode()))
+                Message(message_type=MessageType.ECHO, data=output.encode(), request_id=message.request_id))
         except OSError:
             self.__logger.on_error("Connection closed by peer")
         except Exception:
             self.__logger.on_debug(traceback.format_exc())
             self.send_message(
-                Message(message_type=MessageType.ERROR, data=traceback.format_exc().encode()))
+                Message(message_type=MessageType.ERROR, data=traceback.format_exc().encode(),
+                        request_id=message.request_id))
 
     def execute_command(self, message: Message):
         """
-        Executes the shell command and sends its output back to the server.
+        Executes the shell command and streams its output back to the server.
+        The stdout and stderr of the command are forwarded in OUTPUT messages as they are produced, followed by an
+        EXIT message carrying the exit status once the command has finished.
         :param message: The message containing the command to be executed.
         :raises: OSError: If an error occurs while sending the output back to the server.
         """
         # noinspection PyBroadException
         try:
-            if message.data.decode().startswith("cd"):
-                working_dir = message.data.decode().removeprefix("cd").strip()
-                working_dir = Path.home() if working_dir in ["", "~"] else working_dir
+            if message.decode().startswith("cd"):
+                working_dir = message.decode().removeprefix("cd").strip()
+                working_dir = Path.home() if working_dir in ["", "~"] else self.cwd / Path(working_dir).expanduser()
 
-                if not os.path.exists(working_dir):
+                if not working_dir.is_dir():
                     err = f"{working_dir} does not exist"
                     self.__logger.on_error(err)
-                    self.send_message(Message(message_type=MessageType.ERROR, data=err.encode()))
+                    self.send_message(Message(message_type=MessageType.ERROR, data=err.encode(),
+                                              request_id=message.request_id))
                     return
 
-                os.chdir(working_dir)
-                self.cwd = Path.cwd().absolute()
+                # Jobs run concurrently, so the working directory is the client's own rather than the process's
+                self.cwd = working_dir.resolve()
 
                 success_msg = f"Changed directory to {self.cwd}"
                 self.__logger.on_debug(success_msg)
-                self.send_message(Message(message_type=MessageType.ECHO, data=success_msg.encode()))
+                self.send_message(Message(message_type=MessageType.ECHO, data=success_msg.encode(),
+                                          request_id=message.request_id))
             else:
-                cmd = subprocess.run(message.data.decode(), stdout=subprocess.PIPE, shell=True)
-                if not (output := cmd.stdout.decode()):
-                    return
-
-                output = "\n" + output
-                self.__logger.on_debug(f"Output from command execution:\n{output}")
-                self.send_message(Message(message_type=MessageType.ECHO, data=output.encode()))
+                self.__stream_command(message.decode(), message.request_id)
         except OSError:
             self.__logger.on_error("Connection closed by peer")
         except Exception:
             self.__logger.on_error(traceback.format_exc())
-            self.send_message(Message(message_type=MessageType.ERROR, data=traceback.format_exc().encode()))
+            self.send_message(Message(message_type=MessageType.ERROR, data=traceback.format_exc().encode(),
+                                      request_id=message.request_id))
+
+    def __stream_command(self, command: str, request_id: Optional[int]):
+        """
+        Runs the command and forwards its stdout and stderr in OUTPUT messages while it is running.
+        Once more than COMMAND_OUTPUT_LIMIT bytes were forwarded, the command is killed and the output is reported as
+        truncated in the EXIT message.
+        :param command: The shell command to be executed.
+        :param request_id: The request ID the output is tagged with.
+        :raises: OSError: If an error occurs while sending the output back to the server.
+        """
+        forwarded = 0
+
+        def send(stream: int, chunk: bytes):
+            nonlocal forwarded
+            self.send_message(Message(MessageType.OUTPUT, bytes([stream]) + chunk, request_id=request_id))
+            forwarded += len(chunk)
+
+        result = self.__run_process(command, send, config.COMMAND_OUTPUT_LIMIT, working_dir=self.cwd)
+        self.__logger.on_debug(f"Command exited with status {result.status} after {forwarded} bytes of output")
+        self.send_message(Message(MessageType.EXIT, json.dumps({"status": result.status,
+                                                                 "truncated": result.truncated}).encode(),
+                                  request_id=request_id))
+
+    def execute_batch(self, message: Message):
+        """
+        Runs the commands of a batch one after the other and sends their results back in a single BATCH_RESULT message.
+        The output of all commands together is limited to BATCH_OUTPUT_LIMIT bytes, the output beyond it is discarded
+        and reported as truncated. Once a command that stops the batch on errors fails, the commands after it are
+        skipped. A "cd" command changes the working directory of the commands after it in the batch, not the one of the
+        client.
+        :param message: The BATCH message carrying the commands and their options as JSON.
+        :raises MessageTypeError: If the batch is malformed.
+        :raises: OSError: If an error occurs while sending the results back to the server.
+        """
+        commands = decode_batch(message.data)
+        working_dir = self.cwd
+        budget = config.BATCH_OUTPUT_LIMIT
+        results: list[CommandResult] = []
+        for command in commands:
+            name, _, argument = command.command.partition(" ")
+            if name == "cd":
+                argument = argument.strip()
+                target = Path.home() if argument in ("", "~") else working_dir / Path(argument).expanduser()
+                if target.is_dir():
+                    working_dir = target.resolve()
+                    result = CommandResult(status=0)
+                else:
+                    result = CommandResult(error=f"{target} does not exist")
+            else:
+                output: dict[int, list[bytes]] = {OUTPUT_STDOUT: [], OUTPUT_STDERR: []}
+                try:
+                    result = self.__run_process(command.command, lambda stream, chunk: output[stream].append(chunk),
+                                                budget, command.timeout, working_dir, kill_on_limit=False)
+                except OSError as e:  # The command could not be started
+                    result = CommandResult(error=str(e))
+                for stream, attribute in ((OUTPUT_STDOUT, "stdout"), (OUTPUT_STDERR, "stderr")):
+                    data = b"".join(output[stream])
+                    budget -= len(data)
+                    setattr(result, attribute, data.decode(errors="replace"))
+            results.append(result)
+            if result.failed and command.stop_on_error:
+                break
+
+        skipped = len(commands) - len(results)
+        self.__logger.on_debug(f"Batch of {len(commands)} commands completed, {skipped} skipped")
+        self.send_message(Message(MessageType.BATCH_RESULT, encode_results(results, skipped),
+                                  request_id=message.request_id))
+
+    def __run_process(self, command: str, on_output: Callable[[int, bytes], None], limit: int,
+                      timeout: Optional[float] = None, working_dir: Optional[Path] = None,
+                      kill_on_limit=True) -> CommandResult:
+        """
+        Runs a shell command and passes its stdout and stderr on while it is running.
+        :param command: The shell command to be executed.
+        :param on_output: Called with the stream (OUTPUT_STDOUT or OUTPUT_STDERR) and every chunk of output, from the
+            threads reading the streams.
+        :param limit: The maximum number of bytes of output passed on, the output beyond it is reported as truncated.
+        :param timeout: The number of seconds after which the command is killed, None for no limit.
+        :param working_dir: The working directory of the command, the one of the client by default.
+        :param kill_on_limit: Whether the command is killed once its output exceeds the limit, otherwise the rest of
+            its output is discarded.
+        :return: The exit status of the command and whether its output was truncated or it timed out.
+        :raises OSError: If the command can not be started.
+        """
+        # The command runs in its own process group, so that killing it also kills the processes the shell spawned
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+                                   cwd=working_dir, start_new_session=os.name == "posix")
+        budget_lock = threading.Lock()
+        forwarded = 0
+        truncated = False
+        timed_out = threading.Event()
+
+        def forward(pipe, stream: int):
+            nonlocal forwarded, truncated
+            try:
+                while chunk := pipe.read1(config.COMMAND_OUTPUT_CHUNK_SIZE):
+                    with budget_lock:
+                        if forwarded + len(chunk) > limit:
+                            chunk = chunk[:max(0, limit - forwarded)]
+                            truncated = True
+                        forwarded += len(chunk)
+
+                    if chunk:
+                        on_output(stream, chunk)
+                    if truncated and kill_on_limit:
+                        self.__kill(process)
+                        break
+            except OSError:  # The connection is gone while streaming, sending the EXIT message reports it
+                self.__kill(process)
+
+        def expire():
+            timed_out.set()
+            self.__kill(process)
+
+        timer = threading.Timer(timeout, expire) if timeout is not None else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+        stderr_forwarder = threading.Thread(target=forward, args=(process.stderr, OUTPUT_STDERR), daemon=True)
+        stderr_forwarder.start()
+        try:
+            forward(process.stdout, OUTPUT_STDOUT)
+        finally:
+            stderr_forwarder.join()
+            status = process.wait()
+            if timer:
+                timer.cancel()
+            process.stdout.close()
+            process.stderr.close()
+        return CommandResult(status, truncated=truncated, timed_out=timed_out.is_set())
+
+    @staticmethod
+    def __kill(process: subprocess.Popen):
+        """
+        Kills the process and, on POSIX systems, every other process of its process group.
+        """
+        try:
+            if os.name == "posix":
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
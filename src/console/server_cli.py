@@ -1,12 +1,19 @@
 import cmd
+import time
 from pathlib import Path
+from typing import Optional, Union
 
+import config
+from src.core.command_batch import BatchCommand, encode_batch, format_results, read_command_file
+from src.core.exception import FileReadError
 from src.core.message import Message, MessageType
 from src.server.rce_server import RCEServer
+from src.server.result_set import ClientResult, ResultSet, ShardedResultSet
+from src.server.sharded_server import ShardedServer
 
 
 class ServerCLI(cmd.Cmd):
-    def __init__(self, server: RCEServer):
+    def __init__(self, server: Union[RCEServer, ShardedServer]):
         super().__init__()
         self.prompt = 'server> '
         self.server = server
@@ -41,15 +48,77 @@ class ServerCLI(cmd.Cmd):
         if not self.server.stop():
             print("Failed to stop server")
 
-    def do_inject(self, line):
-        args = self.__parse_args(line)
-        if len(args) < 2:
-            print("Usage: inject <file>")
+    def do_list(self, line):
+        selector, _ = self.__split_selector(line)
+        try:
+            clients = self.server.client_infos(selector)
+        except ValueError as e:
+            print(e)
+            return
+        if not clients:
+            print("No clients connected")
             return
 
-        print(args)
-        if args[0] != '-f' and args[0] != '--file':
-            print("Usage: inject -f/--file <file>")
+        sharded = isinstance(self.server, ShardedServer)
+        print(f"{'CLIENT':<22} {'SHARD ' if sharded else ''}{'HOSTNAME':<20} {'PROTOCOL':<9} {'COMPRESSION':<12} "
+              f"{'BYTES SAVED':>12} {'QUEUED':>10} {'RTT':>9}  TAGS")
+        for client in clients:
+            rtt = f"{client.rtt * 1000:.1f}ms" if client.rtt is not None else "-"
+            shard = f"{client.shard:<5} " if sharded else ""
+            print(f"{client.client_address_str:<22} {shard}{client.hostname[:20]:<20} "
+                  f"{'v' + str(client.protocol_version):<9} {str(client.compression):<12} {client.bytes_saved:>12} "
+                  f"{client.outbound_bytes:>10} {rtt:>9}  {','.join(client.tags)}")
+
+    def do_stats(self, line):
+        selector, _ = self.__split_selector(line)
+        metrics = self.server.metrics_snapshot()
+        print(f"Uptime {metrics.uptime:.0f}s, {len(metrics.clients)} clients connected, {metrics.connects} connects "
+              f"({metrics.connect_rate:.2f}/s), {metrics.disconnects} disconnects ({metrics.disconnect_rate:.2f}/s) "
+              f"over the last {config.METRICS_RATE_WINDOW:.0f}s")
+
+        traffic = metrics.traffic
+        print(f"\n{'TYPE':<18} {'SENT':>10} {'SENT BYTES':>12} {'RECEIVED':>10} {'RECV BYTES':>12}")
+        for message_type in MessageType:
+            index = message_type.value
+            if traffic.sent_bytes[index] or traffic.received_bytes[index]:
+                print(f"{message_type.name:<18} {traffic.sent_messages[index]:>10} "
+                      f"{self.__format_size(traffic.sent_bytes[index]):>12} {traffic.received_messages[index]:>10} "
+                      f"{self.__format_size(traffic.received_bytes[index]):>12}")
+
+        print(f"\n{'REQUEST':<18} {'COUNT':>10} {'P50':>10} {'P95':>10} {'P99':>10}")
+        for message_type, histogram in metrics.latency.items():
+            quantiles = [histogram.quantile(q) for q in (0.5, 0.95, 0.99)]
+            print(f"{message_type.name:<18} {histogram.count:>10} "
+                  + " ".join(f"{f'{value * 1000:.1f}ms' if value is not None else '-':>10}" for value in quantiles))
+
+        if metrics.throughput.count:
+            print(f"\nTransfers: {metrics.throughput.count}, {self.__format_size(metrics.transferred_bytes)} in "
+                  f"{metrics.transfer_seconds:.2f}s, median "
+                  f"{self.__format_size(metrics.throughput.quantile(0.5))}/s per client")
+        if metrics.reaped:
+            print(f"\nReaped {metrics.reaped} unresponsive clients")
+        if metrics.export_error:
+            print(f"\nFailed to export metrics: {metrics.export_error}")
+
+        if selector:
+            try:
+                clients = self.server.client_infos(selector)
+            except ValueError as e:
+                print(e)
+                return
+            print(f"\n{'CLIENT':<22} {'SENT':>10} {'SENT BYTES':>12} {'RECEIVED':>10} {'RECV BYTES':>12}")
+            for client in clients:
+                counters = client.traffic
+                print(f"{client.client_address_str:<22} {sum(counters.sent_messages):>10} "
+                      f"{self.__format_size(sum(counters.sent_bytes)):>12} {sum(counters.received_messages):>10} "
+                      f"{self.__format_size(sum(counters.received_bytes)):>12}")
+
+    def do_inject(self, line):
+        selector, line = self.__split_selector(line)
+        args = self.__parse_args(line)
+        if (len(args) not in (2, 4) or args[0] not in ('-f', '--file')
+                or (len(args) == 4 and args[2] not in ('-n', '--name'))):
+            print("Usage: inject [-s/--select <selector>] -f/--file <file> [-n/--name <name>]")
             return
 
         file = Path(args[1])
@@ -57,8 +126,184 @@ class ServerCLI(cmd.Cmd):
             print(f"File {file} does not exist")
             return
 
+        name = args[3] if len(args) > 3 else file.stem
         with open(file, 'rb') as f:
-            self.server.broadcast_message(Message(message_type=MessageType.INJECT, data=f.read()))
+            try:
+                self.__print_report(self.server.inject_payload(f.read(), name, selector=selector))
+            except ValueError as e:
+                print(e)
+
+    def do_push(self, line):
+        selector, line = self.__split_selector(line)
+        stripes, line = self.__split_option(line, ('--stripes',))
+        args = self.__parse_args(line)
+        if not args[0] or (stripes is not None and not stripes.isdigit()):
+            print("Usage: push [-s/--select <selector>] [--stripes <count>] <file|directory> [destination]")
+            return
+
+        destination = args[1] if len(args) > 1 else ""
+        try:
+            if Path(args[0]).is_dir():
+                self.__print_report(self.server.push_directory(args[0], destination, selector=selector))
+            else:
+                self.__print_report(self.server.push_file(args[0], destination, selector=selector,
+                                                          stripes=int(stripes) if stripes else None))
+        except (FileNotFoundError, FileReadError, ValueError) as e:
+            print(e)
 
     def do_execute(self, line):
-        self.server.broadcast_message(Message(message_type=MessageType.EXECUTE, data=b''))
+        try:
+            options, line = self.__split_request_options(line)
+        except ValueError:
+            print("Usage: execute [-s/--select <selector>] [-o/--output <file>] [-t/--timeout <seconds>] [-q/--quiet] "
+                  "[name]")
+            return
+
+        self.__fan_out(MessageType.EXECUTE, line.encode(), options)
+
+    def do_cmd(self, line):
+        try:
+            options, line = self.__split_request_options(line)
+        except ValueError:
+            line = ""
+        if not line:
+            print("Usage: cmd [-s/--select <selector>] [-o/--output <file>] [-t/--timeout <seconds>] [-q/--quiet] "
+                  "<command>")
+            return
+
+        self.__fan_out(MessageType.CMD, line.encode(), options)
+
+    def do_batch(self, line):
+        try:
+            options, line = self.__split_request_options(line, {"-e": "stop_on_error",
+                                                                "--stop-on-error": "stop_on_error"})
+        except ValueError:
+            line = ""
+        if not line:
+            print("Usage: batch [-s/--select <selector>] [-o/--output <file>] [-t/--timeout <seconds>] [-q/--quiet] "
+                  "[-e/--stop-on-error] <command file>")
+            print("  One command per line, optionally preceded by @timeout=<seconds>, @stop-on-error or "
+                  "@continue-on-error")
+            return
+
+        try:
+            commands = read_command_file(line, stop_on_error=options["stop_on_error"])
+        except (OSError, ValueError) as e:
+            print(e)
+            return
+        self.__fan_out(MessageType.BATCH, encode_batch(commands), options, commands)
+
+    def __fan_out(self, message_type: MessageType, data: bytes, options: dict,
+                  commands: Optional[list[BatchCommand]] = None):
+        """
+        Sends a request tagged with a new request ID to the selected clients and shows the results as they arrive,
+        below a live summary of the clients that are done, pending or failed. With --output, the results are also
+        appended to a JSONL file, with --quiet the output of the clients is not shown.
+        :param commands: The commands of a batch, shown with their results.
+        """
+        request_id = self.server.next_request_id()
+        print(f"Request #{request_id}")
+        shown = 0
+
+        def progress(results: Union[ResultSet, ShardedResultSet]):
+            nonlocal shown
+            print("\r\033[K", end="")  # Clears the summary line
+            for result in results.completed[shown:]:
+                if not options["quiet"]:
+                    self.__print_result(result, commands)
+            shown = len(results.completed)
+            print(f"{results.done} done, {results.pending} pending, {results.failed} failed", end="", flush=True)
+
+        try:
+            results = self.server.fan_out(Message(message_type, data, request_id=request_id),
+                                          options["select"], options["timeout"], options["output"], progress=progress)
+        except (ValueError, OSError) as e:
+            print(e)
+            return
+        except KeyboardInterrupt:
+            print("\nStopped waiting for the results")
+            return
+
+        print()
+        timed_out = results.timed_out
+        print(f"Request #{request_id}: {results.done} done, {results.failed} failed, {len(timed_out)} timed out of "
+              f"{len(results.results)} clients in {time.monotonic() - results.started_at:.2f}s")
+        if timed_out:
+            print(f"  Timed out: {', '.join(timed_out[:20])}" + (f" and {len(timed_out) - 20} more"
+                                                                  if len(timed_out) > 20 else ""))
+
+    @staticmethod
+    def __print_result(result: ClientResult, commands: Optional[list[BatchCommand]] = None):
+        status = f", status {result.status}" if result.status is not None else ""
+        print(f"CLIENT {result.client_address} {result.hostname} {result.state}{status} in "
+              f"{result.latency * 1000:.1f}ms")
+        if result.commands is not None:
+            print("  " + format_results(result.commands, result.skipped, commands).replace("\n", "\n  "))
+        for text in (result.stdout, result.stderr, result.error):
+            if text and (text := text.rstrip()):
+                print("  " + text.replace("\n", "\n  "))
+
+    def __split_request_options(self, line: str, flags: Optional[dict[str, str]] = None) -> tuple[dict, str]:
+        """
+        Splits the leading options of a request off its arguments, in any order: -s/--select <selector>,
+        -o/--output <file>, -t/--timeout <seconds>, -q/--quiet and the flags of the request.
+        :param flags: The names of the additional flags of the request, mapped to their option key.
+        :return: The options and the remaining arguments.
+        :raises ValueError: If an option lacks its value or the timeout is not a number.
+        """
+        names = {"-s": "select", "--select": "select", "-o": "output", "--output": "output", "-t": "timeout",
+                 "--timeout": "timeout"}
+        flags = {"-q": "quiet", "--quiet": "quiet", **(flags or {})}
+        options = {"select": None, "output": None, "timeout": config.GATHER_TIMEOUT,
+                   **{key: False for key in flags.values()}}
+        while True:
+            option, _, rest = line.strip().partition(' ')
+            if option in flags:
+                options[flags[option]], line = True, rest
+            elif option in names:
+                value, line = self.__split_option(line, (option,))
+                if value is None:
+                    raise ValueError(f"Missing value of {option}")
+                options[names[option]] = float(value) if option in ('-t', '--timeout') else value
+            else:
+                return options, line.strip()
+
+    @staticmethod
+    def __split_selector(line: str) -> tuple[Optional[str], str]:
+        """
+        Splits a leading -s/--select option off the arguments of a command. Selectors containing spaces are quoted,
+        e.g. -s "tag=web AND subnet=10.1.0.0/16".
+        :return: The selector (None if there is none) and the remaining arguments.
+        """
+        return ServerCLI.__split_option(line, ('-s', '--select'))
+
+    @staticmethod
+    def __split_option(line: str, names: tuple[str, ...]) -> tuple[Optional[str], str]:
+        """
+        Splits a leading option with a value off the arguments of a command, values containing spaces are quoted.
+        :param names: The names of the option, e.g. ('-s', '--select').
+        :return: The value (None if the option is not given) and the remaining arguments.
+        """
+        option, _, rest = line.strip().partition(' ')
+        if option not in names:
+            return None, line
+        rest = rest.lstrip()
+        if rest[:1] in ('"', "'"):
+            value, _, remainder = rest[1:].partition(rest[0])
+        else:
+            value, _, remainder = rest.partition(' ')
+        return value or None, remainder.strip()
+
+    @staticmethod
+    def __format_size(size: float) -> str:
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024 or unit == "GB":
+                return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+            size /= 1024
+
+    @staticmethod
+    def __print_report(report: dict[str, Optional[str]]):
+        failed = {client: error for client, error in report.items() if error}
+        print(f"Sent to {len(report) - len(failed)}/{len(report)} clients")
+        for client, error in failed.items():
+            print(f"  {client}: {error}")
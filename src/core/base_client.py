@@ -1,13 +1,36 @@
 import abc
+import collections
+import contextlib
+import json
 import os.path
+import select
 import socket
+import struct
+import sys
+import tarfile
 import threading
+import time
 from pathlib import Path
 from typing import Any, Optional
 
 import config
-from src.core.exception import FileWriteError, FileReadError, MessageTypeError
-from src.core.message import Message, MessageType
+from src.core.compression import Compression
+from src.core.exception import FileReadError, FileWriteError, MessageTypeError
+from src.core.file_transfer import (ChunkWriter, DeltaFile, Incoming, IncomingDirectory, IncomingFile,
+                                    send_file_delta, stream_size, write_directory_archive)
+from src.core.message import FILE_SIZE, PROTOCOL_V1, PROTOCOL_V2, FrameDecoder, Message, MessageType
+from src.core.metrics import TrafficCounters
+from src.core.outbound_queue import OutboundQueue
+from src.core.pending_replies import PendingReplies
+from src.core.striped_transfer import (StripedFile, StripeRegistry, StripeTransfer, connect_stripe, send_file_striped,
+                                       stripe_count)
+
+# Vectored sends are not available on every platform (e.g. Windows)
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+# SO_SNDTIMEO and SO_RCVTIMEO take a struct timeval on POSIX systems and a DWORD of milliseconds on Windows
+SOCKET_TIMEOUT = struct.Struct("@L" if sys.platform == "win32" else "@ll")
+# SO_LINGER enabled with a timeout of 0: closing the socket resets the connection and discards the unsent data
+LINGER_ABORT = struct.pack("@ii", 1, 0)
 
 
 class BaseClientThread(threading.Thread):
@@ -22,11 +45,31 @@ class BaseClientThread(threading.Thread):
         self.__address = None
         self.__connected = False
         self.__socket: Optional[socket.socket] = None
+        self.__send_lock = threading.RLock()
+        self.__outbound = OutboundQueue()
+        self.__outbound_writer: Optional[threading.Thread] = None
+        self.__exclusive_depth = 0
+        self.__frames = FrameDecoder()
+        self.__decoded: collections.deque[tuple[Message, int]] = collections.deque()
+        self.__receive_buffer = bytearray()  # Windows of raw file bodies, allocated by the first one
+        self.max_message_size = config.MAX_MESSAGE_SIZE
+        self.file_transfer_mode = config.FILE_TRANSFER_MODE
+        self.compression = Compression()
+        self.protocol_version = PROTOCOL_V1
+        self.striping = False  # Whether the peer accepts striped transfers, negotiated in the HELLO messages
+        self.file_stream = False  # Whether the peer accepts FILE_STREAM bodies, announced in its HELLO message
+        self.request_ids = False  # Whether the peer accepts request IDs in v1 frames, announced in its HELLO message
+        self.pending_replies = PendingReplies()
+        self.traffic = TrafficCounters()
+        self.last_received = time.monotonic()  # When the last data was received from the peer
+        self.__receive_timeout = 0.0
+        self.__incoming_files: dict[int, Incoming] = {}
 
     def init(self, client_socket: socket.socket, addr: Any):
         self.__socket = client_socket
         self.__address = addr
         self.__connected = True
+        self.set_nodelay(config.TCP_NODELAY)
 
     def connect_to_server(self, host: str, port: int):
         """
@@ -43,6 +86,7 @@ class BaseClientThread(threading.Thread):
             self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.__socket.connect((host, port))
             self.__connected = True
+            self.set_nodelay(config.TCP_NODELAY)
         except ConnectionRefusedError as error:
             raise error
 
@@ -54,88 +98,340 @@ class BaseClientThread(threading.Thread):
         """
         Closes the socket connection.
         If the connection is already closed, the method returns immediately.
-        :raises: OSError: If an error occurs during socket shutdown or closure.
+        :raises: OSError: If an error occurs during socket closure.
         """
         if not self.__connected:
             return
 
         self.__connected = False
-        self.__socket.shutdown(socket.SHUT_RDWR)
+        self.__outbound.close()
+        with contextlib.suppress(OSError):  # The peer may have reset the connection already
+            self.__socket.shutdown(socket.SHUT_RDWR)
         self.__socket.close()
 
+    def abort(self):
+        """
+        Closes the connection without waiting for the peer, e.g. an unresponsive one: the data that has not been sent
+        yet is discarded and the connection is reset.
+        """
+        if self.__connected:
+            with contextlib.suppress(OSError):
+                self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_ABORT)
+        with contextlib.suppress(OSError):
+            self.close()
+
     def is_connected(self):
         return self.__connected
 
-    def send_message(self, message: Message):
+    @property
+    def transferring(self) -> bool:
+        """
+        :return: Whether a transfer holds the connection (see exclusive), messages posted meanwhile stay queued.
+        """
+        return self.__exclusive_depth > 0
+
+    def set_receive_timeout(self, timeout: float):
+        """
+        Sets the kernel receive timeout (SO_RCVTIMEO) of the socket, receiving fails once nothing has been received
+        for that long. A timeout of 0 disables it.
+        :param timeout: The timeout in seconds.
+        """
+        self.__receive_timeout = timeout
+        self.__set_timeout(socket.SO_RCVTIMEO, timeout)
+
+    def set_nodelay(self, enabled: bool):
+        """
+        Enables or disables Nagle's algorithm on the socket. With TCP_NODELAY enabled, small control messages are
+        sent immediately instead of waiting for outstanding acknowledgements.
+        :param enabled: Whether TCP_NODELAY should be set.
+        """
+        self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+    @contextlib.contextmanager
+    def corked(self):
+        """
+        Context manager that holds back partial frames while a burst of messages is sent, so that consecutive small
+        messages are coalesced into full segments.
+        Uses TCP_CORK where the platform supports it, otherwise it is a no-op.
+        """
+        if not hasattr(socket, "TCP_CORK"):
+            yield
+            return
+
+        self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            yield
+        finally:
+            if self.__connected:
+                self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    def send_message(self, message: Message, timeout: Optional[float] = None):
         """
         Sends a message over the socket.
         This method performs the following steps:
-          1. Sets the sender information for the message using the socket's own address.
-          2. Converts the message to its byte representation.
-          3. Calculates the length of the data and converts this length to a 4-byte little-endian integer.
-          4. Sends the length of the data followed by the actual data over the socket.
+          1. Compresses ECHO and ERROR bodies if compression was negotiated and the body is worth compressing.
+          2. Frames the message as a header (4-byte little-endian length and the message type) and its payload.
+          3. Sends the header and the payload with a single vectored sendmsg call, without concatenating them.
+          4. Sends the remainder with sendall in case of a partial send.
+        Concurrent callers are serialized, so frames sent from different threads never interleave. Messages posted
+        before (see post_message) are written first, unless the connection is held for a transfer.
 
         :param message: The message object to be sent.
-        :raises: OSError: If an error occurs while sending data over the socket.
+        :param timeout: Optional number of seconds after which the send is aborted, including the wait for other
+            senders, e.g. a transfer holding the connection. A partially sent frame can not be recovered, so the
+            connection is closed when the timeout expires during the send.
+        :raises:
+            TimeoutError: If the message could not be sent within the timeout.
+            OSError: If an error occurs while sending data over the socket.
         """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        message = self.compression.encode(message)
+        header, payload = message.to_buffers(self.protocol_version, self.request_ids)
+        if not self.__send_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"Sending message timed out after {timeout}s, the connection is busy")
+
         try:
-            data = message.to_bytes()
-            data_size = len(data).to_bytes(4, byteorder="little")
-            self.__socket.sendall(data_size)
-            self.__socket.sendall(data)
-        except OSError as error:
-            raise error
+            if not self.__exclusive_depth:
+                self.__flush_outbound()
+            if deadline is None:
+                self.__send_buffers(header, payload)
+            elif deadline <= time.monotonic():  # Nothing was sent, the connection is still usable
+                raise TimeoutError(f"Sending message timed out after {timeout}s, the connection is busy")
+            else:
+                try:
+                    self.__send_buffers(header, payload, deadline=deadline)
+                finally:
+                    if self.__connected:
+                        self.__set_timeout(socket.SO_SNDTIMEO, 0)
+            self.traffic.sent(message, len(header) + len(payload))
+        except BlockingIOError:  # The send timeout expired
+            self.close()
+            raise TimeoutError(f"Sending message timed out after {timeout}s")
+        finally:
+            self.__send_lock.release()
+
+    def post_message(self, message: Message) -> bool:
+        """
+        Queues a message on the outbound queue of the connection without blocking, it is written by the connection's
+        writer thread in the order it was posted.
+        :param message: The message object to be sent.
+        :return: False if the message was not queued because the connection is congested, i.e. more than
+            config.OUTBOUND_HIGH_WATER bytes are waiting to be written.
+        :raises OSError: If the connection is closed, or if it has been congested for longer than
+            config.OUTBOUND_STALL_TIMEOUT, in which case it is closed.
+        """
+        if not self.__connected:
+            raise OSError("Connection closed")
+        if self.__outbound.stalled_for() > config.OUTBOUND_STALL_TIMEOUT:
+            self.close()
+            raise OSError(f"Dropped after being congested for more than {config.OUTBOUND_STALL_TIMEOUT}s")
+        if self.__outbound.congested:
+            return False
+
+        message = self.compression.encode(message)
+        header, payload = message.to_buffers(self.protocol_version, self.request_ids)
+        if not self.__outbound.put((header, payload, message)):
+            return False
+
+        if not self.__outbound_writer:
+            self.__outbound_writer = threading.Thread(target=self.__write_outbound, daemon=True,
+                                                      name=f"{self.name}-writer")
+            self.__outbound_writer.start()
+        return True
+
+    @property
+    def outbound_bytes(self) -> int:
+        """
+        :return: The number of bytes posted to the connection that have not been written yet.
+        """
+        return self.__outbound.size
+
+    def __write_outbound(self):
+        """
+        Writer thread of the outbound queue, it writes the posted messages whenever the connection is not held by a
+        sender.
+        """
+        try:
+            while self.__connected and self.__outbound.wait():
+                with self.__send_lock:
+                    self.__flush_outbound()
+        except OSError:
+            with contextlib.suppress(OSError):
+                self.close()
+
+    def __flush_outbound(self):
+        """
+        Writes the queued frames, the send lock must be held. While the connection is congested, the frames are written
+        with a deadline, a connection that does not drain within config.OUTBOUND_STALL_TIMEOUT is closed.
+        :raises TimeoutError: If the connection was closed because it stalled.
+        """
+        while frame := self.__outbound.pop():
+            header, payload, message = frame
+            if stalled_for := self.__outbound.stalled_for():
+                try:
+                    deadline = time.monotonic() + config.OUTBOUND_STALL_TIMEOUT - stalled_for
+                    self.__send_buffers(header, payload, deadline=deadline)
+                except BlockingIOError:
+                    self.close()
+                    raise TimeoutError(f"Dropped after being congested for more than {config.OUTBOUND_STALL_TIMEOUT}s")
+                finally:
+                    if self.__connected:
+                        self.__set_timeout(socket.SO_SNDTIMEO, 0)
+            else:
+                self.__send_buffers(header, payload)
+            self.__outbound.written(len(header) + len(payload))
+            self.traffic.sent(message, len(header) + len(payload))
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Holds the connection for a transfer whose messages must not be interleaved with other messages, e.g. a file
+        transfer to a protocol v1 peer. Messages posted meanwhile stay queued until the transfer is complete, other
+        threads sending messages wait for it. The connection can be held again by the holding thread.
+        """
+        with self.__send_lock:
+            self.__exclusive_depth += 1
+            try:
+                yield
+            finally:
+                self.__exclusive_depth -= 1
+
+    def __send_buffers(self, header: bytes, payload, deadline: Optional[float] = None):
+        """
+        Sends the header and payload of a frame, resuming after partial sends.
+        :param deadline: Optional time.monotonic() deadline, enforced with the kernel send timeout.
+        :raises BlockingIOError: If the deadline expires.
+        """
+        if deadline is not None:
+            if (timeout := deadline - time.monotonic()) <= 0:
+                raise BlockingIOError("Send deadline expired")
+            self.__set_timeout(socket.SO_SNDTIMEO, timeout)
+
+        if not HAS_SENDMSG and deadline is None:
+            self.__socket.sendall(header)
+            self.__socket.sendall(payload)
+            return
+
+        size = len(header) + len(payload)
+        if (sent := self.__socket.sendmsg((header, payload)) if HAS_SENDMSG else 0) == size:
+            return
+
+        if sent < len(header):
+            remaining = memoryview(header + payload)[sent:]
+        else:
+            remaining = memoryview(payload)[sent - len(header):]
+        if deadline is None:
+            self.__socket.sendall(remaining)
+            return
+
+        while remaining:
+            if (timeout := deadline - time.monotonic()) <= 0:
+                raise BlockingIOError("Send deadline expired")
+            self.__set_timeout(socket.SO_SNDTIMEO, timeout)
+            remaining = remaining[self.__socket.send(remaining):]
+
+    def __set_timeout(self, option: int, timeout: float):
+        """
+        Sets the kernel send (SO_SNDTIMEO) or receive (SO_RCVTIMEO) timeout of the socket, each only applies to its
+        direction so that the sending and receiving threads do not affect each other. A timeout of 0 disables it.
+        """
+        if timeout > 0:  # Sub-resolution timeouts must not round down to 0, which would disable the timeout
+            timeout = max(timeout, 0.001)
+
+        if sys.platform == "win32":
+            value = SOCKET_TIMEOUT.pack(int(timeout * 1000))
+        else:
+            value = SOCKET_TIMEOUT.pack(int(timeout), int(timeout % 1 * 1_000_000))
+        self.__socket.setsockopt(socket.SOL_SOCKET, option, value)
+
+    def wait_readable(self, timeout: float) -> bool:
+        """
+        Waits until receive_message has something to receive, without receiving it.
+        :param timeout: The number of seconds to wait.
+        :return: Whether data or the end of the connection arrived in time.
+        """
+        if self.__decoded or self.__frames.buffered or not self.__connected:
+            return True
+
+        readable, _, _ = select.select([self.__socket], [], [], timeout)
+        return bool(readable)
 
     def receive_message(self):
         """
         Receives a message from the socket.
         This method performs the following steps:
-            1. Reads 4 bytes from the socket and converts them to an integer (little-endian)
-                representing the size of the incoming message.
-            2. Checks if the received size is zero and raises an OSError if true.
-            3. Reads the specified number of bytes from the socket.
-            4. Converts the received bytes into a Message object.
-
-       :returns: A Message object containing the data received from the socket.
-       :raises: OSError: If an error occurs while receiving data or if the received message size is zero.
-       """
-
-        def __receive_all(size):
-            """
-            Helper function to receive `size` bytes reliably.
-
-            :param size: Number of bytes to receive.
-            :returns: The received bytes.
-            :raises OSError: If the connection is closed unexpectedly.
-            """
-            buffer = bytearray()
-            while len(buffer) < size:
-                next_chunk_size = size - len(buffer)
-                if not (packet := self.__socket.recv(next_chunk_size)):
-                    raise OSError("Connection closed while receiving data")
-                buffer.extend(packet)
-            return bytes(buffer)
+            1. If no message that was decoded before is left, receives as many bytes as the connection's receive
+                buffer holds and decodes all the complete frames among them in one pass (see FrameDecoder), until at
+                least one frame is complete. Frames whose size is zero or larger than `max_message_size` raise an
+                OSError. The buffer is reused between messages and only grows when a larger message arrives.
+            2. Returns the next decoded message, whose payload is a memoryview over the buffer.
+            3. Decompresses compressed bodies, except for FILE chunks which are decompressed as a stream by
+                receive_file.
 
+       :returns: A Message object containing the data received from the socket. Its payload is only valid until the
+            next call to this method.
+       :raises: OSError: If an error occurs while receiving data, or if the received frame is invalid.
+       """
         try:
-            if not (data_size := self.__socket.recv(4)):
-                raise OSError("Connection closed by peer")
+            if not self.__decoded:
+                while not (frames := self.__frames.decode(self.max_message_size)):
+                    if not self.__frames.fill(self.__socket.recv_into):
+                        raise OSError("Connection closed by peer" if not self.__frames.buffered
+                                      else "Connection closed while receiving data")
+                self.__decoded.extend(frames)
 
-            if not (data_size_as_int := int.from_bytes(data_size, byteorder='little')):
-                raise OSError("Received null bytes for message size")
+            message, size = self.__decoded.popleft()
+            self.traffic.received(message, size)
+            self.last_received = time.monotonic()
+            if message.compressed and not message.is_type(MessageType.FILE):
+                message = message.with_data(self.compression.decompress(message.data, self.max_message_size))
+            return message
+        except BlockingIOError:  # The receive timeout expired
+            raise TimeoutError(f"Nothing received for {self.__receive_timeout}s, the peer is unresponsive")
+        except ValueError as error:  # The stream can not be resynchronized after a frame that can not be decoded
+            raise OSError(f"Received malformed frame: {error}")
 
-            data = __receive_all(data_size_as_int)
-            return Message.from_bytes(data)
-        except OSError as error:
-            raise error
+    def __receive_into(self, buffer: memoryview):
+        """
+        Helper function to fill `buffer` reliably with bytes from the socket, starting with the bytes that were received
+        along with the previous messages.
 
-    def send_file(self, source_path: str, destination_path: str = ""):
+        :param buffer: The memoryview to fill.
+        :raises OSError: If the connection is closed unexpectedly.
+        """
+        received = self.__frames.read_into(buffer)
+        size = len(buffer)
+        while received < size:
+            if not (packet_size := self.__socket.recv_into(buffer[received:])):
+                raise OSError("Connection closed by peer" if not received else "Connection closed while receiving data")
+            received += packet_size
+
+    def send_file(self, source_path: str, destination_path: str = "", request_id: Optional[int] = None,
+                  stripes: Optional[int] = None) -> Optional[float]:
         """
         Sends a file to the client/server.
+        Depending on `file_transfer_mode`, the file is either sent as a sequence of FILE messages terminated by an
+        END_OF_FILE message ("chunked"), or as a FILE_STREAM message carrying the file size followed by the raw file
+        body, which is copied from the file to the socket by the kernel ("sendfile"). Peers that did not announce
+        FILE_STREAM support in their HELLO message are always sent files chunked.
+        If compression was negotiated and the file is compressible, it is always sent chunked, with the chunks
+        compressed as one stream.
+        On a protocol v2 connection, a file sent with a request ID is sent on that stream and other messages may be
+        interleaved with its chunks. Otherwise the connection is held for the whole transfer.
+        In "delta" mode, a file sent on a stream is sent as a delta against the receiver's version of it (see
+        DeltaFile), otherwise "delta" falls back to "sendfile".
+        In "striped" mode, or if stripes are requested, a file sent on a stream to a peer that accepts striped transfers
+        is sent over several data connections in parallel (see StripeTransfer), otherwise it falls back to "sendfile".
         :param source_path: The path to the file to be sent.
         :param destination_path: The path where the file should be saved on the server.
+        :param request_id: Optional ID of the request the file is sent for.
+        :param stripes: Optional number of stripes the file is sent in, regardless of the transfer mode and file size.
+        :return: The aggregate throughput of a striped transfer in bytes per second, None for the other modes.
         :raises:
             FileNotFoundError: When a file with the given path does not exist.
             FileReadError: When an error occurs while reading the file.
+            TimeoutError: When the receiver of a delta transfer does not answer within FILE_SYNC_TIMEOUT.
+            OSError: When the data connections of a striped transfer fail.
         """
         filepath = Path(source_path)
         if not filepath.exists():
@@ -145,44 +441,329 @@ class BaseClientThread(threading.Thread):
             raise FileNotFoundError(f"{filepath} is not a file")
 
         filename_with_destination = os.path.join(destination_path, filepath.name).encode()
-        self.send_message(Message(message_type=MessageType.FILE_UPLOAD, data=filename_with_destination))
+        if request_id is not None and self.protocol_version >= PROTOCOL_V2:
+            if self.striping and (count := stripe_count(filepath.stat().st_size, stripes, self.file_transfer_mode)):
+                return send_file_striped(self.send_message, self.open_stripes, filepath, filename_with_destination,
+                                         request_id, count)
+            if self.file_transfer_mode == "delta":
+                send_file_delta(self.send_message, self.pending_replies, filepath, filename_with_destination,
+                                request_id)
+            else:
+                self.__send_file(filepath, filename_with_destination, request_id)
+            return None
+
+        with self.exclusive(), self.corked():  # Other messages must not be interleaved with the file transfer
+            self.__send_file(filepath, filename_with_destination, request_id)
+        return None
+
+    def __send_file(self, filepath: Path, filename_with_destination: bytes, request_id: Optional[int]):
+        self.send_message(Message(MessageType.FILE_UPLOAD, filename_with_destination, request_id=request_id))
         try:
             with open(filepath, 'rb') as file:
+                compress = self.compression.enabled and Compression.is_compressible(
+                    file.read(config.COMPRESSION_SAMPLE_SIZE))
+                if self.file_transfer_mode != "chunked" and self.file_stream and not compress:
+                    self.__send_file_stream(file, request_id)
+                    return
+
+                file.seek(0)
+                compressor = self.compression.compressor() if compress else None
                 while chunk := file.read(config.FILE_CHUNK_SIZE):
-                    self.send_message(Message(MessageType.FILE, chunk))
-                self.send_message(Message(MessageType.END_OF_FILE))
+                    if compressor and (compressed_chunk := compressor.compress(chunk)) is not None:
+                        self.send_message(Message(MessageType.FILE, compressed_chunk, compressed=True,
+                                                  request_id=request_id))
+                    else:
+                        self.send_message(Message(MessageType.FILE, chunk, request_id=request_id))
+                self.send_message(Message(MessageType.END_OF_FILE, request_id=request_id))
         except OSError:
             raise FileReadError(f"Failed to read file {filepath}")
 
-    def receive_file(self, filename: str, save_path: Path = None):
+    def __send_file_stream(self, file, request_id: Optional[int]):
+        """
+        Sends the FILE_STREAM header followed by the raw file body using socket.sendfile.
+        The raw body is not framed, so the connection is held until it has been sent completely.
+        :param file: The file object opened in binary mode.
+        :param request_id: The stream the file is sent on.
+        :raises OSError: If the file could not be sent completely.
+        """
+        file_size = os.fstat(file.fileno()).st_size
+        with self.__send_lock:
+            self.send_message(Message(MessageType.FILE_STREAM, FILE_SIZE.pack(file_size), request_id=request_id))
+            if file_size and self.__socket.sendfile(file, 0, file_size) != file_size:
+                # The receiver expects exactly file_size bytes, the stream can not be recovered
+                self.close()
+                raise OSError("File was truncated while being sent")
+            self.traffic.body_sent(file_size)
+
+    def send_directory(self, source_path: str, destination_path: str = "", request_id: Optional[int] = None):
+        """
+        Sends a directory tree to the client/server as a DIRECTORY_UPLOAD message followed by a tar archive of the
+        directory, streamed in FILE messages (compressed like a chunked file) and terminated by an END_OF_FILE message.
+        The archive is produced while it is sent, it is never written to disk. Streams are used as for send_file.
+        :param source_path: The path to the directory to be sent.
+        :param destination_path: The path where the directory should be saved on the receiving side.
+        :param request_id: Optional ID of the request the directory is sent for.
+        :raises:
+            FileNotFoundError: When a directory with the given path does not exist.
+            FileReadError: When an error occurs while reading the directory.
+        """
+        dirpath = Path(source_path)
+        if not dirpath.is_dir():
+            raise FileNotFoundError(f"{dirpath} is not a directory")
+
+        dirname_with_destination = os.path.join(destination_path, dirpath.name).encode()
+        if request_id is not None and self.protocol_version >= PROTOCOL_V2:
+            self.__send_directory(dirpath, dirname_with_destination, request_id)
+            return
+
+        with self.exclusive(), self.corked():  # Other messages must not be interleaved with the transfer
+            self.__send_directory(dirpath, dirname_with_destination, request_id)
+
+    def __send_directory(self, dirpath: Path, dirname_with_destination: bytes, request_id: Optional[int]):
+        self.send_message(Message(MessageType.DIRECTORY_UPLOAD, dirname_with_destination, request_id=request_id))
+        compressor = self.compression.compressor() if self.compression.enabled else None
+
+        def send_chunk(chunk: bytes):
+            if compressor and (compressed_chunk := compressor.compress(chunk)) is not None:
+                self.send_message(Message(MessageType.FILE, compressed_chunk, compressed=True, request_id=request_id))
+            else:
+                self.send_message(Message(MessageType.FILE, chunk, request_id=request_id))
+
+        try:
+            with ChunkWriter(send_chunk) as writer:
+                write_directory_archive(dirpath, writer)
+        except (OSError, tarfile.TarError):
+            raise FileReadError(f"Failed to read directory {dirpath}")
+        self.send_message(Message(MessageType.END_OF_FILE, request_id=request_id))
+
+    def receive_file(self, filename: str, save_path: Path = None, request_id: Optional[int] = None) -> bool:
         """
         Receives a file from the server and saves it locally.
+        On a protocol v2 connection, a file sent with a request ID is received on that stream: the method only opens
+        the file and returns, the FILE messages of the stream are then passed to receive_file_message as they arrive.
         :param filename: The name of the file to be saved.
         :param save_path: The path where the file should be saved (applies to client-side handling).
+        :param request_id: The request ID of the FILE_UPLOAD message.
+        :return: Whether the file has been received completely.
         :raises:
             MessageTypeError: When the next message is not of type MessageType.FILE.
             FileWriteError: When an error occurs while writing the file.
+            OSError: If an error occurs while receiving data.
+        """
+        save_path = self.__save_path(save_path)
+        # Files received on streams share this thread, one waiting for a buffer must not hold another one meanwhile
+        streamed = request_id is not None and self.protocol_version >= PROTOCOL_V2
+        incoming = IncomingFile(save_path / filename, self.compression.decompressor(), self.max_message_size,
+                                batched=not streamed)
+        return self.__receive(incoming, request_id)
+
+    def receive_directory(self, dirname: str, save_path: Path = None, request_id: Optional[int] = None) -> bool:
+        """
+        Receives a directory sent by send_directory, extracting the archive while it arrives.
+        Streams are used as for receive_file.
+        :param dirname: The name of the directory to be saved.
+        :param save_path: The path where the directory should be saved (applies to client-side handling).
+        :param request_id: The request ID of the DIRECTORY_UPLOAD message.
+        :return: Whether the directory has been received completely.
+        :raises:
+            MessageTypeError: When the next message is not of type MessageType.FILE.
+            FileWriteError: When an error occurs while extracting the directory.
+            OSError: If an error occurs while receiving data.
+        """
+        save_path = self.__save_path(save_path)
+        incoming = IncomingDirectory(save_path / dirname, self.compression.decompressor(), self.max_message_size)
+        return self.__receive(incoming, request_id)
+
+    def receive_file_sync(self, message: Message, save_path: Path = None):
+        """
+        Starts receiving a delta transfer: answers the FILE_SYNC message with the signature of the receiver's version
+        of the file, the FILE_BLOCK messages of the stream are then passed to receive_file_message as they arrive.
+        If the transfer can not be started, the sender is answered with an ERROR message instead.
+        :param message: The FILE_SYNC message.
+        :param save_path: The path the file path of the message is relative to (applies to client-side handling).
+        :raises:
+            MessageTypeError: When the FILE_SYNC message is malformed.
+            FileWriteError: When the file can not be written.
+            OSError: If an error occurs while sending the answer.
+        """
+        try:
+            request = json.loads(message.decode())
+            file_path = self.__save_path(save_path) / request["path"]
+            file_size, block_size = int(request["size"]), int(request["block_size"])
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_message(Message(MessageType.ERROR, b"Malformed FILE_SYNC message", request_id=message.request_id))
+            raise MessageTypeError(f"Received malformed FILE_SYNC message: {error}")
+
+        try:
+            os.makedirs(file_path.parent, exist_ok=True)
+            incoming = DeltaFile(file_path, file_size, block_size)
+        except (OSError, FileWriteError) as error:
+            self.send_message(Message(MessageType.ERROR, str(error).encode(), request_id=message.request_id))
+            raise FileWriteError(f"Failed to start delta transfer of {file_path}: {error}")
+
+        try:
+            signature = incoming.signature()
+        except OSError as error:
+            incoming.abort()
+            self.send_message(Message(MessageType.ERROR, str(error).encode(), request_id=message.request_id))
+            raise FileWriteError(f"Failed to start delta transfer of {file_path}: {error}")
+
+        self.__incoming_files[message.request_id] = incoming
+        self.send_message(Message(MessageType.FILE_SIGNATURE, signature, request_id=message.request_id))
+
+    def open_stripes(self, transfer: StripeTransfer):
+        """
+        Opens the data connections of a striped transfer to the server the client is connected to, every stripe runs
+        on a thread of its own. Data connections are always opened by the client, servers wait for them instead (see
+        StripeRegistry).
+        """
+        address = self.__socket.getpeername()[:2]
+        for index in range(len(transfer.ranges)):
+            threading.Thread(target=self.__run_stripe, args=(transfer, address, index), name=f"stripe-{index}",
+                             daemon=True).start()
+
+    @staticmethod
+    def __run_stripe(transfer: StripeTransfer, address: tuple[str, int], index: int):
+        try:
+            sock = connect_stripe(address, transfer.token, index)
+        except OSError as error:
+            transfer.fail(error)
+            return
+
+        with sock:
+            transfer.run(index, sock)
+
+    def serve_stripe(self, stripes: StripeRegistry, token: Any, index: Any):
+        """
+        Hands the connection over to the striped transfer it is a data connection of, as announced by its HELLO
+        message, and closes it once the stripe has been transferred.
+        :param stripes: The registry of the transfers the data connection may belong to.
+        :param token: The token of the transfer.
+        :param index: The index of the stripe.
+        :raises OSError: If the transfer is unknown.
+        """
+        try:
+            stripes.attach(token, index, self.__socket)
+        finally:
+            self.close()
+
+    def abort_file_transfers(self):
         """
+        Aborts the transfers that are still being received, e.g. when the connection is closed.
+        """
+        for incoming in self.__incoming_files.values():
+            incoming.abort()
+        self.__incoming_files.clear()
+
+    def __save_path(self, save_path: Optional[Path]) -> Path:
         if not save_path:  # Server-side handling
             save_path = config.DOWNLOAD_DIR / f"{self.__address[0]}:{self.__address[1]}"
 
         if not save_path.exists():
             os.makedirs(save_path, exist_ok=True)
+        return save_path
+
+    def __receive(self, incoming: Incoming, request_id: Optional[int]) -> bool:
+        """
+        Receives the body of a file transfer, right away or on its stream.
+        :return: Whether the transfer is complete.
+        """
+        if request_id is not None and self.protocol_version >= PROTOCOL_V2:
+            self.__incoming_files[request_id] = incoming
+            return False
 
         try:
-            file_path = save_path / filename
-            with open(file_path, 'wb') as file:
-                while True:
-                    message = self.receive_message()
-                    if message.is_type(MessageType.END_OF_FILE):
-                        break
-
-                    if not message.is_type(MessageType.FILE):
-                        raise MessageTypeError(
-                            f"Invalid message type provided: {message.get_type()}, expected FILE type")
-                    file.write(message.data)
-        except OSError:
-            raise FileWriteError(f"Failed to save file {save_path}")
+            while not self.__receive_file_body(incoming, self.receive_message()):
+                pass
+        except BaseException:
+            incoming.abort()
+            raise
+        incoming.finish()
+        return True
+
+    def receive_file_message(self, message: Message) -> Optional[Path]:
+        """
+        Passes a FILE, FILE_STREAM or END_OF_FILE message to the file that is being received on its stream.
+        :param message: The message of the file transfer.
+        :return: The path of the file if the message completed it, otherwise None.
+        :raises:
+            MessageTypeError: When no file is being received on the stream of the message, or the message is
+                malformed, which aborts the transfer.
+            FileWriteError: When the message completed a file that could not be written.
+            OSError: If an error occurs while receiving data.
+        """
+        if not (incoming := self.__incoming_files.get(message.request_id)):
+            raise MessageTypeError(f"Received {message.get_type()} for unknown stream {message.request_id}")
+
+        try:
+            if not self.__receive_file_body(incoming, message):
+                return None
+        except MessageTypeError:
+            del self.__incoming_files[message.request_id]  # The rest of the transfer is refused as an unknown stream
+            incoming.abort()
+            raise
+
+        del self.__incoming_files[message.request_id]
+        incoming.finish()
+        return incoming.file_path
+
+    def __receive_file_body(self, incoming: Incoming, message: Message) -> bool:
+        """
+        Writes a message of a file transfer to the incoming file.
+        :return: Whether the message completed the transfer.
+        """
+        if message.is_type(MessageType.END_OF_FILE):
+            if message.data:  # The digests of the stripes of a striped transfer
+                incoming.write_chunk(message)
+            return True
+
+        if message.is_type(MessageType.FILE_STREAM):
+            self.__receive_file_stream(incoming, stream_size(message))
+            return True
+
+        if message.is_type(MessageType.FILE_STRIPES):
+            self.__receive_stripes(incoming, message)
+            return False
+
+        incoming.write_chunk(message)
+        return False
+
+    def __receive_stripes(self, incoming: Incoming, message: Message):
+        """
+        Starts receiving the stripes of a striped transfer announced by a FILE_STRIPES message, the file of the stream
+        is written in place by the stripes from then on.
+        :raises MessageTypeError: If the transfer is not striped on a stream, or the announcement is malformed.
+        """
+        if not isinstance(incoming, IncomingFile) or self.__incoming_files.get(message.request_id) is not incoming:
+            raise MessageTypeError("Received FILE_STRIPES outside of a file transfer on a stream")
+
+        striped = StripedFile(incoming, message)
+        self.__incoming_files[message.request_id] = striped
+        self.open_stripes(striped)
+
+    def __receive_file_stream(self, incoming: Incoming, file_size: int):
+        """
+        Receives a raw file body of `file_size` bytes into a preallocated file.
+        The body is received with recv_into in windows of up to FILE_CHUNK_SIZE bytes of the connection's receive
+        buffer and written out directly, without decoding any messages.
+        :param incoming: The destination file.
+        :param file_size: The number of bytes in the file body.
+        :raises OSError: If an error occurs while receiving the file.
+        """
+        incoming.preallocate(file_size)
+        window_size = min(file_size, config.FILE_CHUNK_SIZE)
+        if window_size > len(self.__receive_buffer):
+            self.__receive_buffer = bytearray(window_size)
+
+        buffer = memoryview(self.__receive_buffer)
+        remaining = file_size
+        while remaining:
+            window = buffer[:min(remaining, window_size)]
+            self.__receive_into(window)
+            self.traffic.body_received(len(window))
+            self.last_received = time.monotonic()
+            incoming.write(window)
+            remaining -= len(window)
 
     def get_address(self):
         return self.__address
@@ -0,0 +1,198 @@
+import json
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import config
+from src.core.exception import MessageTypeError
+
+
+class BatchCommand:
+    """
+    A command of a batch (see MessageType.BATCH) with its options.
+    """
+
+    def __init__(self, command: str, timeout: Optional[float] = None, stop_on_error=False):
+        """
+        :param command: The shell command.
+        :param timeout: The number of seconds the command may run before it is killed, None for no limit.
+        :param stop_on_error: Whether the commands after it are skipped if it fails.
+        """
+        self.command = command
+        self.timeout = timeout
+        self.stop_on_error = stop_on_error
+
+    def to_json(self) -> dict[str, Any]:
+        command: dict[str, Any] = {"command": self.command}
+        if self.timeout is not None:
+            command["timeout"] = self.timeout
+        if self.stop_on_error:
+            command["stop_on_error"] = True
+        return command
+
+    @staticmethod
+    def from_json(command: dict[str, Any]) -> "BatchCommand":
+        """
+        :raises MessageTypeError: If the command is malformed.
+        """
+        try:
+            timeout = command.get("timeout")
+            if not isinstance(command["command"], str) or (timeout is not None and float(timeout) <= 0):
+                raise ValueError
+            return BatchCommand(command["command"], float(timeout) if timeout is not None else None,
+                                bool(command.get("stop_on_error")))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise MessageTypeError("Received malformed batch command")
+
+
+class CommandResult:
+    """
+    The result of a command of a batch. A command fails if it exits with a non-zero status, is killed by its timeout or
+    can not be run at all (error). Fields that are empty or false are left out of the JSON form, which keeps the
+    batched results compact.
+    """
+
+    def __init__(self, status: Optional[int] = None, stdout="", stderr="", truncated=False, timed_out=False,
+                 error: Optional[str] = None):
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.truncated = truncated
+        self.timed_out = timed_out
+        self.error = error
+
+    @property
+    def failed(self) -> bool:
+        return bool(self.status or self.timed_out or self.error is not None)
+
+    def to_json(self) -> dict[str, Any]:
+        result: dict[str, Any] = {"status": self.status}
+        for key in ("stdout", "stderr", "truncated", "timed_out", "error"):
+            if value := getattr(self, key):
+                result[key] = value
+        return result
+
+    @staticmethod
+    def from_json(result: dict[str, Any]) -> "CommandResult":
+        """
+        :raises MessageTypeError: If the result is malformed.
+        """
+        try:
+            return CommandResult(result.get("status"), str(result.get("stdout", "")), str(result.get("stderr", "")),
+                                 bool(result.get("truncated")), bool(result.get("timed_out")), result.get("error"))
+        except AttributeError:
+            raise MessageTypeError("Received malformed batch result")
+
+
+def encode_batch(commands: list[BatchCommand]) -> bytes:
+    """
+    :return: The payload of a BATCH message carrying the commands in the order they run in.
+    """
+    return json.dumps({"commands": [command.to_json() for command in commands]}).encode()
+
+
+def decode_batch(data: Union[bytes, memoryview]) -> list[BatchCommand]:
+    """
+    :raises MessageTypeError: If the batch is malformed.
+    """
+    try:
+        commands = json.loads(bytes(data))["commands"]
+        if not isinstance(commands, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        raise MessageTypeError("Received malformed batch")
+    return [BatchCommand.from_json(command) for command in commands]
+
+
+def encode_results(results: list[CommandResult], skipped: int) -> bytes:
+    """
+    :param results: The results of the commands that ran, in the order of the batch.
+    :param skipped: The number of commands skipped after a command failed that stops the batch on errors.
+    :return: The payload of a BATCH_RESULT message.
+    """
+    return json.dumps({"results": [result.to_json() for result in results], "skipped": skipped},
+                      ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def decode_results(data: Union[bytes, memoryview]) -> tuple[list[CommandResult], int]:
+    """
+    :return: The results of the commands that ran and the number of commands that were skipped.
+    :raises MessageTypeError: If the results are malformed.
+    """
+    try:
+        batch = json.loads(bytes(data))
+        results, skipped = batch["results"], int(batch.get("skipped", 0))
+        if not isinstance(results, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        raise MessageTypeError("Received malformed batch results")
+    return [CommandResult.from_json(result) for result in results], skipped
+
+
+def read_command_file(path: Union[str, Path], timeout: Optional[float] = config.BATCH_COMMAND_TIMEOUT,
+                      stop_on_error=False) -> list[BatchCommand]:
+    """
+    Reads the commands of a batch from a file, one shell command per line. Blank lines and lines starting with '#' are
+    ignored. The options of a command precede it on its line: @timeout=<seconds> (0 for no limit), @stop-on-error and
+    @continue-on-error, e.g. "@timeout=5 @stop-on-error systemctl is-active nginx".
+    :param path: The command file.
+    :param timeout: The timeout of the commands without a timeout option.
+    :param stop_on_error: Whether the commands without an error option stop the batch if they fail.
+    :return: The commands in the order of the file.
+    :raises OSError: If the file can not be read.
+    :raises ValueError: If an option is unknown or malformed, or the file holds no command.
+    """
+    commands = []
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            command = BatchCommand(line, timeout, stop_on_error)
+            while command.command.startswith("@"):
+                option, _, command.command = command.command.partition(" ")
+                command.command = command.command.lstrip()
+                name, _, value = option[1:].partition("=")
+                if name == "timeout":
+                    try:
+                        if (seconds := float(value)) < 0:
+                            raise ValueError
+                    except ValueError:
+                        raise ValueError(f"{path}:{number}: invalid timeout '{value}'")
+                    command.timeout = seconds or None
+                elif name in ("stop-on-error", "continue-on-error") and not value:
+                    command.stop_on_error = name == "stop-on-error"
+                else:
+                    raise ValueError(f"{path}:{number}: unknown option '{option}'")
+            if not command.command:
+                raise ValueError(f"{path}:{number}: missing command")
+            commands.append(command)
+
+    if not commands:
+        raise ValueError(f"{path} holds no command")
+    return commands
+
+
+def format_results(results: list[CommandResult], skipped: int, commands: Optional[list[BatchCommand]] = None) -> str:
+    """
+    Renders the results of a batch as text, one block per command: its status followed by its indented output.
+    :param results: The results of the commands that ran.
+    :param skipped: The number of commands that were skipped.
+    :param commands: The commands of the batch, if they are known, to show each of them with its result.
+    """
+    lines = []
+    for index, result in enumerate(results):
+        if result.error is not None:
+            outcome = "error"
+        elif result.timed_out:
+            outcome = f"timed out (status {result.status})"
+        else:
+            outcome = f"status {result.status}"
+        command = f" $ {commands[index].command}" if commands and index < len(commands) else ""
+        lines.append(f"[{index + 1}]{command}: {outcome}" + (" (output truncated)" if result.truncated else ""))
+        for text in (result.stdout, result.stderr, result.error):
+            if text and (text := text.rstrip()):
+                lines.append("  " + text.replace("\n", "\n  "))
+    if skipped:
+        lines.append(f"{skipped} command{'s' if skipped > 1 else ''} skipped")
+    return "\n".join(lines)
@@ -0,0 +1,174 @@
+import lzma
+import zlib
+from typing import Optional, Union
+
+import config
+from src.core.message import Message, MessageType, PreparedMessage
+
+Buffer = Union[bytes, bytearray, memoryview]
+# Message bodies that are compressed on their own, FILE chunks are compressed as a stream
+COMPRESSIBLE_TYPES = (MessageType.ECHO, MessageType.ERROR, MessageType.OUTPUT, MessageType.FILE_BLOCK)
+
+
+class Compression:
+    """
+    Per-connection compression state. The algorithm is negotiated at connect time through the HELLO handshake, an
+    algorithm of None means that the peers did not agree on one and nothing is compressed.
+    It also keeps track of the number of bytes before and after compression of everything sent on the connection.
+    """
+
+    def __init__(self, algorithm: Optional[str] = None):
+        if algorithm and algorithm not in config.COMPRESSION_ALGORITHMS:
+            raise ValueError(f"Unsupported compression algorithm: {algorithm}")
+
+        self.algorithm = algorithm
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    @staticmethod
+    def negotiate(offered: list[str]) -> Optional[str]:
+        """
+        Picks the preferred algorithm of this side that is also offered by the peer.
+        :param offered: The algorithms supported by the peer.
+        :return: The name of the algorithm or None if there is no common one.
+        """
+        return next((algorithm for algorithm in config.COMPRESSION_ALGORITHMS if algorithm in offered), None)
+
+    @staticmethod
+    def is_compressible(data: Buffer) -> bool:
+        """
+        Quick ratio check on a sample of the data, used to skip data that is already compressed (archives, images...).
+        :param data: The data to check.
+        :return: Whether the sample shrinks by enough to be worth compressing.
+        """
+        sample = data[:config.COMPRESSION_SAMPLE_SIZE]
+        return len(zlib.compress(sample, 1)) < len(sample) * config.COMPRESSION_MAX_RATIO
+
+    @property
+    def enabled(self):
+        return self.algorithm is not None
+
+    @property
+    def bytes_saved(self):
+        return self.raw_bytes - self.compressed_bytes
+
+    def encode(self, message: Message) -> Message:
+        """
+        Returns the message as it should be sent on this connection, i.e. with its body compressed if compression
+        was negotiated and the body is worth compressing. Prepared messages are compressed once per algorithm.
+        :param message: The message to be sent.
+        :return: The message to put on the wire.
+        """
+        if not self.enabled or message.compressed or message.get_type() not in COMPRESSIBLE_TYPES:
+            return message
+
+        if isinstance(message, PreparedMessage):
+            encoded = message.compressed_variant(self.algorithm, self.compress)
+        elif (compressed := self.compress(message.data)) is not None:
+            encoded = message.with_data(compressed, compressed=True)
+        else:
+            return message
+
+        if encoded.compressed:
+            self.account(len(message.data), len(encoded.data))
+        return encoded
+
+    def compress(self, data: Buffer) -> Optional[bytes]:
+        """
+        Compresses a single message body.
+        :param data: The message body.
+        :return: The compressed body or None if the body is too small, incompressible or would not shrink.
+        """
+        if not self.enabled or len(data) < config.COMPRESSION_MIN_SIZE or not self.is_compressible(data):
+            return None
+
+        if self.algorithm == "zlib":
+            compressed = zlib.compress(data, config.COMPRESSION_LEVEL)
+        else:
+            compressed = lzma.compress(data)
+
+        if len(compressed) >= len(data):
+            return None
+        return compressed
+
+    def decompress(self, data: Buffer, max_size: int) -> bytes:
+        """
+        Decompresses a single message body.
+        :param data: The compressed message body.
+        :param max_size: The maximum size of the decompressed body.
+        :return: The decompressed body.
+        :raises OSError: If the body is corrupt or larger than max_size once decompressed.
+        """
+        return self.decompressor().decompress(data, max_size)
+
+    def compressor(self) -> "StreamCompressor":
+        return StreamCompressor(self)
+
+    def decompressor(self) -> "StreamDecompressor":
+        return StreamDecompressor(self.algorithm)
+
+    def account(self, raw_size: int, compressed_size: int):
+        self.raw_bytes += raw_size
+        self.compressed_bytes += compressed_size
+
+
+class StreamCompressor:
+    """
+    Compresses a sequence of chunks (e.g. the FILE chunks of a transfer) with one compression context, so that
+    redundancy across chunks is exploited. Every compressed chunk is flushed, so the receiver can decompress it as soon
+    as it arrives. With lzma, which can not flush mid-stream, every chunk is compressed on its own.
+    """
+
+    def __init__(self, compression: Compression):
+        self.__compression = compression
+        self.__compressor = zlib.compressobj(config.COMPRESSION_LEVEL) if compression.algorithm == "zlib" else None
+
+    def compress(self, chunk: Buffer) -> Optional[bytes]:
+        """
+        :param chunk: The next chunk of the stream.
+        :return: The compressed chunk or None if the chunk is incompressible and should be sent as is.
+        """
+        if not Compression.is_compressible(chunk):
+            return None
+
+        if self.__compressor:
+            compressed = self.__compressor.compress(chunk) + self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            compressed = lzma.compress(chunk)
+
+        self.__compression.account(len(chunk), len(compressed))
+        return compressed
+
+
+class StreamDecompressor:
+    """
+    Decompresses the chunks produced by a StreamCompressor, in order.
+    """
+
+    def __init__(self, algorithm: str):
+        self.__algorithm = algorithm
+        self.__decompressor = zlib.decompressobj() if algorithm == "zlib" else None
+
+    def decompress(self, chunk: Buffer, max_size: int) -> bytes:
+        """
+        :param chunk: The next compressed chunk of the stream.
+        :param max_size: The maximum size of the decompressed chunk.
+        :return: The decompressed chunk.
+        :raises OSError: If the chunk is corrupt or larger than max_size once decompressed.
+        """
+        try:
+            if self.__decompressor:
+                data = self.__decompressor.decompress(chunk, max_size)
+                exceeded = bool(self.__decompressor.unconsumed_tail)
+            elif self.__algorithm == "lzma":
+                decompressor = lzma.LZMADecompressor()
+                data = decompressor.decompress(chunk, max_size)
+                exceeded = not decompressor.eof
+            else:
+                raise OSError("Received compressed data but no compression was negotiated")
+        except (zlib.error, lzma.LZMAError) as error:
+            raise OSError(f"Failed to decompress data: {error}")
+
+        if exceeded:
+            raise OSError(f"Decompressed data exceeds the maximum of {max_size} bytes")
+        return data
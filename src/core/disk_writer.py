@@ -0,0 +1,182 @@
+import os
+import queue
+import threading
+import time
+from typing import BinaryIO, Optional, Union
+
+import config
+
+
+class BufferPool:
+    """
+    Bounded pool of reusable buffers of a fixed size. Buffers are allocated on first use, at most `count` of them, and
+    acquiring one waits while all of them are in use.
+    """
+
+    def __init__(self, count: int = config.DISK_WRITE_BUFFERS, size: int = config.DISK_WRITE_BUFFER_SIZE):
+        self.size = size
+        self.__count = count
+        self.__allocated = 0
+        self.__free: queue.LifoQueue[bytearray] = queue.LifoQueue()  # The most recently used buffer is still cached
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        try:
+            return self.__free.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.__lock:
+            if self.__allocated < self.__count:
+                self.__allocated += 1
+                return bytearray(self.size)
+        return self.__free.get()
+
+    def release(self, buffer: bytearray):
+        self.__free.put(buffer)
+
+
+def sync_directory(path: Union[str, os.PathLike]):
+    """
+    Syncs a directory to stable storage, so that the files renamed into it survive a crash. Only POSIX systems support
+    it, elsewhere nothing is done.
+    :raises OSError: If the directory can not be synced.
+    """
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+
+    descriptor = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+# Shared by the disk writers of all incoming files, it bounds the memory of the data waiting to be written
+DISK_WRITE_POOL = BufferPool()
+
+
+class DiskWriter:
+    """
+    Writes a file on a thread of its own, so that the thread receiving the file never waits for the disk and receiving
+    and writing overlap. Written data is copied into buffers of a shared pool and handed to the writer thread once a
+    buffer is full, so small chunks are written in batches. When the disks fall behind, the pool runs out of buffers
+    and writing waits for one to be written, which slows down the receiver instead of buffering without bounds.
+    Unbatched writers hand the data of every write to the writer thread right away instead of keeping a partly filled
+    buffer until more data arrives, so a write that waits for a buffer only waits for the disks, never for other
+    transfers to receive more data. Receivers that share the threads their writes run on use them (see
+    RCEAsyncConnection).
+    The durability mode decides when the data is flushed to stable storage (see config.FILE_DURABILITY_MODES).
+    Write errors are kept and raised by close(), the data written after an error is discarded.
+    """
+
+    def __init__(self, file: BinaryIO, durability: str = config.FILE_DURABILITY, pool: BufferPool = DISK_WRITE_POOL,
+                 sync_interval: float = config.FILE_DURABILITY_INTERVAL, batched: bool = True):
+        """
+        :param file: The file, opened for writing without buffering.
+        :param durability: "none", "eof" or "periodic".
+        :param pool: The pool the buffers are taken from.
+        :param sync_interval: The number of seconds between two syncs in the "periodic" mode.
+        :param batched: Whether the data of small writes is batched in the buffers.
+        :raises ValueError: If the durability mode is unknown.
+        """
+        if durability not in config.FILE_DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+
+        self.durability = durability
+        self.written = 0  # Bytes written to the file so far
+        self.error: Optional[OSError] = None
+        self.__file = file
+        self.__pool = pool
+        self.__sync_interval = sync_interval
+        self.__batched = batched
+        self.__synced_at = time.monotonic()
+        self.__buffer: Optional[bytearray] = None
+        self.__filled = 0
+        self.__requests: queue.SimpleQueue = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__run, name="disk-writer", daemon=True)
+        self.__thread.start()
+
+    def preallocate(self, size: int):
+        """
+        Reserves the disk space of the file on the writer thread, where the platform supports it.
+        """
+        self.__requests.put(("preallocate", size))
+
+    def write(self, data: Union[bytes, memoryview]):
+        """
+        Copies the data into the buffers of the pool, waiting for a free buffer if needed.
+        """
+        view = memoryview(data).cast("B")
+        offset = 0
+        while offset < len(view):
+            if self.__buffer is None:
+                self.__buffer = self.__pool.acquire()
+            size = min(len(view) - offset, len(self.__buffer) - self.__filled)
+            self.__buffer[self.__filled:self.__filled + size] = view[offset:offset + size]
+            self.__filled += size
+            offset += size
+            if self.__filled == len(self.__buffer):
+                self.flush()
+        if not self.__batched:
+            self.flush()
+
+    def flush(self):
+        """
+        Hands the buffer being filled to the writer thread.
+        """
+        if self.__buffer is not None:
+            self.__requests.put(("write", self.__buffer, self.__filled))
+            self.__buffer, self.__filled = None, 0
+
+    def close(self, sync=True):
+        """
+        Waits until everything has been written and stops the writer thread, the file is left open.
+        :param sync: Whether the file is synced as the durability mode requires, False for an interrupted transfer.
+        :raises OSError: The first error that occurred while writing.
+        """
+        self.flush()
+        self.__requests.put(("close", sync))
+        self.__thread.join()
+        if self.error:
+            raise self.error
+
+    def __run(self):
+        while True:
+            request = self.__requests.get()
+            try:
+                if request[0] == "write":
+                    with memoryview(request[1]) as buffer:
+                        self.__write(buffer[:request[2]])
+                elif request[0] == "preallocate":
+                    self.__preallocate(request[1])
+                else:
+                    if request[1] and self.durability != "none" and not self.error:
+                        os.fsync(self.__file.fileno())
+                    return
+            except OSError as error:
+                self.error = self.error or error
+            finally:
+                if request[0] == "write":
+                    self.__pool.release(request[1])
+
+    def __write(self, data: memoryview):
+        if self.error:
+            return
+
+        size = len(data)
+        while data:
+            data = data[self.__file.write(data):]
+        self.written += size
+        if self.durability == "periodic" and time.monotonic() - self.__synced_at >= self.__sync_interval:
+            getattr(os, "fdatasync", os.fsync)(self.__file.fileno())  # fdatasync skips the metadata, where available
+            self.__synced_at = time.monotonic()
+
+    def __preallocate(self, size: int):
+        if not hasattr(os, "posix_fallocate") or not size:
+            return
+
+        try:
+            os.posix_fallocate(self.__file.fileno(), 0, size)
+        except OSError:  # Not supported by the file system, the file simply grows while it is written
+            pass
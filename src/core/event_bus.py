@@ -0,0 +1,129 @@
+import collections
+import threading
+import traceback
+from typing import Any, Optional
+
+import config
+from src.core.observer import RCEEventObserver
+
+Event = tuple[str, tuple]
+
+
+class ObserverChannel:
+    """
+    Bounded queue of the events for one observer, delivered in order by a dispatcher thread of its own. When the
+    observer falls behind and the queue is full, the observer's overflow policy applies:
+      - "drop_oldest": the oldest queued event is dropped to make room.
+      - "drop_newest": the new event is dropped.
+      - "block": the publisher waits for room, for observers that must see every event.
+    The observer is told how many events it missed through on_error once it has caught up.
+    """
+
+    def __init__(self, observer: RCEEventObserver, queue_size: int = config.OBSERVER_QUEUE_SIZE):
+        self.observer = observer
+        self.events: Optional[frozenset[str]] = getattr(observer, "events", None)
+        self.__policy = getattr(observer, "overflow_policy", config.OBSERVER_OVERFLOW_POLICY)
+        if self.__policy not in config.OBSERVER_OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {self.__policy}")
+
+        self.__queue_size = queue_size
+        self.__events: collections.deque[Event] = collections.deque()
+        self.__condition = threading.Condition()
+        self.__busy = False
+        self.dropped = 0
+        self.__dispatcher = threading.Thread(target=self.__dispatch, daemon=True,
+                                             name=f"observer-{type(observer).__name__}")
+        self.__dispatcher.start()
+
+    def put(self, event: str, args: tuple):
+        """
+        Queues an event without blocking, unless the queue is full and the policy is "block".
+        :param event: The name of the observer method to call.
+        :param args: The arguments of the call.
+        """
+        with self.__condition:
+            if len(self.__events) >= self.__queue_size:
+                if self.__policy == "block":
+                    self.__condition.wait_for(lambda: len(self.__events) < self.__queue_size)
+                elif self.__policy == "drop_oldest":
+                    self.__events.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return
+
+            self.__events.append((event, args))
+            self.__condition.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until every queued event has been delivered.
+        :return: Whether the queue was drained within the timeout.
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not self.__events and not self.__busy, timeout)
+
+    def __dispatch(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__events)
+                event, args = self.__events.popleft()
+                dropped, self.dropped = self.dropped, 0
+                self.__busy = True
+                self.__condition.notify_all()
+
+            try:
+                if dropped:
+                    self.observer.on_error(f"{dropped} events were dropped, the observer fell behind")
+                getattr(self.observer, event)(*args)
+            except Exception:  # A failing observer must not stop the delivery of further events
+                traceback.print_exc()
+            finally:
+                with self.__condition:
+                    self.__busy = False
+                    self.__condition.notify_all()
+
+
+class EventBus:
+    """
+    Delivers events to observers off the publishing thread, so that slow observers (a terminal, a log sink...) never
+    hold up the network threads that publish them. Every observer gets its own ObserverChannel, so a slow observer
+    only delays itself.
+    """
+
+    def __init__(self, queue_size: int = config.OBSERVER_QUEUE_SIZE):
+        self.__queue_size = queue_size
+        self.__channels: dict[int, ObserverChannel] = {}
+        self.__lock = threading.Lock()
+
+    def publish(self, observers: list[RCEEventObserver], event: str, *args: Any):
+        """
+        Queues an event for the observers.
+        :param observers: The observers to notify.
+        :param event: The name of the RCEEventObserver method to call.
+        :param args: The arguments of the call, which must not reference buffers that are reused.
+        """
+        for observer in observers:
+            channel = self.__channel(observer)
+            if channel.events is None or event in channel.events:
+                channel.put(event, args)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the events published so far have been delivered to every observer.
+        :param timeout: The maximum number of seconds to wait for each observer.
+        :return: Whether all events were delivered within the timeout.
+        """
+        with self.__lock:
+            channels = list(self.__channels.values())
+        return all([channel.join(timeout) for channel in channels])
+
+    def __channel(self, observer: RCEEventObserver) -> ObserverChannel:
+        if (channel := self.__channels.get(id(observer))) and channel.observer is observer:
+            return channel
+
+        with self.__lock:
+            if not (channel := self.__channels.get(id(observer))) or channel.observer is not observer:
+                channel = ObserverChannel(observer, self.__queue_size)
+                self.__channels[id(observer)] = channel
+            return channel
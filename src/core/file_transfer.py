@@ -0,0 +1,554 @@
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import shutil
+import stat
+import tarfile
+import threading
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import config
+from src.core.compression import StreamDecompressor
+from src.core.disk_writer import DiskWriter, sync_directory
+from src.core.exception import FileReadError, FileWriteError, MessageTypeError
+from src.core.message import (BLOCK_OFFSET, FILE_SIZE, FRAME_LENGTH, TAGGED_FRAME_HEADER, V2_FRAME_HEADER, Message,
+                              MessageType)
+from src.core.pending_replies import PendingReplies
+
+# Messages that carry the body of a file transfer, after its FILE_UPLOAD, DIRECTORY_UPLOAD or FILE_SYNC message
+FILE_BODY_TYPES = (MessageType.FILE, MessageType.FILE_STREAM, MessageType.FILE_BLOCK, MessageType.FILE_STRIPES,
+                   MessageType.END_OF_FILE)
+BLOCK_DIGEST_SIZE = 16
+
+
+def part_path(file_path: Path) -> Path:
+    """
+    :return: The path of the temporary file a file is received into, it is renamed to file_path once complete.
+    """
+    return file_path.with_name(file_path.name + ".part")
+
+
+def block_digest(block: Union[bytes, memoryview]) -> bytes:
+    """
+    :return: The digest identifying a block of a delta transfer.
+    """
+    return hashlib.blake2b(block, digest_size=BLOCK_DIGEST_SIZE).digest()
+
+
+def stream_size(message: Message) -> int:
+    """
+    :return: The size of the raw file body that follows a FILE_STREAM message.
+    :raises MessageTypeError: If the message does not carry a file size.
+    """
+    if len(message.data) != FILE_SIZE.size:
+        raise MessageTypeError(f"Received malformed FILE_STREAM message of {len(message.data)} bytes")
+    return FILE_SIZE.unpack(message.data)[0]
+
+
+def delta_block_size(file_size: int) -> int:
+    """
+    :return: The block size of a delta transfer of a file of the given size. Every block has to fit in the frame of
+        a FILE_BLOCK message, very large files are cut into more than DELTA_MAX_BLOCKS blocks instead.
+    """
+    block_size = config.DELTA_BLOCK_SIZE
+    while file_size > block_size * config.DELTA_MAX_BLOCKS:
+        block_size *= 2
+    frame_header_size = max(V2_FRAME_HEADER.size, TAGGED_FRAME_HEADER.size) - FRAME_LENGTH.size
+    return min(block_size, config.MAX_MESSAGE_SIZE - frame_header_size - BLOCK_OFFSET.size)
+
+
+class IncomingFile:
+    """
+    A file that is being received, written to disk as its chunks arrive.
+    On protocol v2 connections a file sent on a stream is received while other messages are processed, so several
+    incoming files can be open at once, one per stream.
+    The file is written to a temporary ".part" file which is renamed over the destination once it is complete, so the
+    destination never holds a partial file. An aborted transfer leaves the temporary file behind, a delta transfer of
+    the same file resumes from it.
+    A chunk that fails to be written does not abort the transfer, the remaining chunks still have to be consumed to
+    keep the connection in sync. The failure is reported once the transfer is finished.
+    The chunks are written to disk by a DiskWriter, so that receiving the next chunks overlaps with writing the previous
+    ones.
+    """
+
+    def __init__(self, file_path: Path, decompressor: StreamDecompressor, max_message_size: int,
+                 durability: str = config.FILE_DURABILITY, batched: bool = True):
+        """
+        :param file_path: The path the file is saved to.
+        :param decompressor: The decompressor of the compressed chunks of the transfer.
+        :param max_message_size: The maximum size of a decompressed chunk.
+        :param durability: When the file is flushed to stable storage (see config.FILE_DURABILITY_MODES).
+        :param batched: Whether small chunks are batched before they are written (see DiskWriter).
+        :raises FileWriteError: If the file can not be created.
+        :raises ValueError: If the durability mode is unknown.
+        """
+        if durability not in config.FILE_DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+
+        self.file_path = file_path
+        self.__decompressor = decompressor
+        self.__max_message_size = max_message_size
+        self.__error: Optional[OSError] = None
+        try:
+            self.__file = open(part_path(file_path), 'wb', buffering=0)  # The writer writes whole buffers
+        except OSError as error:
+            raise FileWriteError(f"Failed to save file {file_path}: {error}")
+        self.__writer = DiskWriter(self.__file, durability, batched=batched)
+
+    def preallocate(self, file_size: int):
+        """
+        Reserves the disk space of a file whose size is known upfront, where the platform supports it.
+        """
+        self.__writer.preallocate(file_size)
+
+    def write(self, data: Union[bytes, memoryview]):
+        """
+        Writes raw file data, e.g. a window of a FILE_STREAM body.
+        """
+        if not self.__error and not self.__writer.error:
+            self.__writer.write(data)
+
+    def write_at(self, data: Union[bytes, memoryview], offset: int):
+        """
+        Writes raw file data at an offset with a positioned write, bypassing the DiskWriter. Safe to call from several
+        threads at once, e.g. by the stripes of a striped transfer.
+        :raises OSError: If the data could not be written, or the file is closed.
+        """
+        try:
+            descriptor = self.__file.fileno()
+        except ValueError:
+            raise OSError("File is closed")
+
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(descriptor, view, offset)
+            view = view[written:]
+            offset += written
+
+    def write_chunk(self, message: Message):
+        """
+        Writes the chunk carried by a FILE message, decompressing it first if it is compressed.
+        :raises MessageTypeError: If the message is not a FILE message.
+        """
+        if not message.is_type(MessageType.FILE):
+            raise MessageTypeError(f"Invalid message type provided: {message.get_type()}, expected FILE type")
+
+        if self.__error:
+            return
+
+        try:
+            if message.compressed:
+                self.write(self.__decompressor.decompress(message.data, self.__max_message_size))
+            else:
+                self.write(message.data)
+        except OSError as error:
+            self.__error = error
+
+    def finish(self):
+        """
+        Waits until the file has been written, closes it once the transfer is complete and moves it to its destination.
+        Unless the durability mode is "none", the file and then the rename are synced to stable storage.
+        :raises FileWriteError: If any part of the file could not be written.
+        """
+        try:
+            self.__writer.close()
+        except OSError as error:
+            self.__error = self.__error or error
+
+        try:
+            self.__file.close()
+            if not self.__error:
+                os.replace(self.__file.name, self.file_path)
+                if self.__writer.durability != "none":
+                    sync_directory(self.file_path.parent)
+        except OSError as error:
+            self.__error = self.__error or error
+
+        if self.__error:
+            raise FileWriteError(f"Failed to save file {self.file_path}: {self.__error}")
+
+    def abort(self):
+        """
+        Closes the file of an interrupted transfer once the data received so far has been written. The temporary file
+        is kept, without the space preallocated for the rest of the file, so that it only holds received data.
+        """
+        with contextlib.suppress(OSError):
+            self.__writer.close(sync=False)
+        try:
+            self.__file.truncate(self.__writer.written)
+            self.__file.close()
+        except OSError:
+            pass
+
+
+class ChunkWriter:
+    """
+    File-like object that cuts the data written to it into chunks of FILE_CHUNK_SIZE bytes and hands every full chunk
+    to a callback, e.g. to stream a tar archive as FILE messages without writing it to disk first.
+    The last, partial chunk is handed over when the writer is closed without an error.
+    """
+
+    def __init__(self, send_chunk: Callable[[bytes], None]):
+        self.__send_chunk = send_chunk
+        self.__buffer = bytearray()
+
+    def write(self, data: Union[bytes, memoryview]) -> int:
+        self.__buffer += data
+        if len(self.__buffer) >= config.FILE_CHUNK_SIZE:
+            chunks = memoryview(self.__buffer)
+            sent = 0
+            while len(chunks) - sent >= config.FILE_CHUNK_SIZE:
+                self.__send_chunk(bytes(chunks[sent:sent + config.FILE_CHUNK_SIZE]))
+                sent += config.FILE_CHUNK_SIZE
+            chunks.release()
+            del self.__buffer[:sent]
+        return len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.__buffer:
+            self.__send_chunk(bytes(self.__buffer))
+        self.__buffer.clear()
+
+
+class IncomingDirectory:
+    """
+    A directory that is being received as a tar stream, with the same interface as IncomingFile.
+    The archive is extracted incrementally by a worker thread while its chunks arrive, nothing is buffered on disk.
+    At most DIRECTORY_EXTRACT_QUEUE_SIZE chunks are queued, the receiving side waits if extraction falls behind.
+    """
+
+    def __init__(self, directory_path: Path, decompressor: StreamDecompressor, max_message_size: int):
+        """
+        :param directory_path: The path the directory is extracted to.
+        :param decompressor: The decompressor of the compressed chunks of the transfer.
+        :param max_message_size: The maximum size of a decompressed chunk.
+        :raises FileWriteError: If the directory can not be created.
+        """
+        self.file_path = directory_path
+        self.__decompressor = decompressor
+        self.__max_message_size = max_message_size
+        self.__chunks: queue.Queue[Optional[bytes]] = queue.Queue(config.DIRECTORY_EXTRACT_QUEUE_SIZE)
+        self.__pending = memoryview(b"")
+        self.__error: Optional[Exception] = None
+        try:
+            os.makedirs(directory_path, exist_ok=True)
+        except OSError as error:
+            raise FileWriteError(f"Failed to save directory {directory_path}: {error}")
+
+        self.__extractor = threading.Thread(target=self.__extract, name="extract", daemon=True)
+        self.__extractor.start()
+
+    def preallocate(self, file_size: int):
+        pass
+
+    def write(self, data: Union[bytes, memoryview]):
+        """
+        Queues raw archive data for extraction.
+        """
+        if not self.__error:
+            self.__chunks.put(bytes(data))
+
+    def write_chunk(self, message: Message):
+        """
+        Queues the archive chunk carried by a FILE message for extraction, decompressing it first if it is compressed.
+        :raises MessageTypeError: If the message is not a FILE message.
+        """
+        if not message.is_type(MessageType.FILE):
+            raise MessageTypeError(f"Invalid message type provided: {message.get_type()}, expected FILE type")
+
+        if self.__error:
+            return
+
+        try:
+            if message.compressed:
+                self.write(self.__decompressor.decompress(message.data, self.__max_message_size))
+            else:
+                self.write(message.data)
+        except OSError as error:
+            self.__error = error
+
+    def finish(self):
+        """
+        Waits for the extraction of the archive to complete.
+        :raises FileWriteError: If the archive could not be extracted.
+        """
+        self.__chunks.put(None)
+        self.__extractor.join()
+        if self.__error:
+            raise FileWriteError(f"Failed to save directory {self.file_path}: {self.__error}")
+
+    def abort(self):
+        """
+        Stops the extraction of an interrupted transfer, the files extracted so far are kept.
+        """
+        self.__chunks.put(None)
+        self.__extractor.join()
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads from the queued archive data, blocking until data arrives. Used by tarfile on the extractor thread.
+        :return: Up to size bytes, or b"" at the end of the transfer.
+        """
+        while not self.__pending:
+            if (chunk := self.__chunks.get()) is None:
+                self.__chunks.put(None)  # Every further read hits the end of the transfer as well
+                return b""
+            self.__pending = memoryview(chunk)
+
+        data = self.__pending[:size] if size >= 0 else self.__pending
+        self.__pending = self.__pending[len(data):]
+        return bytes(data)
+
+    def __extract(self):
+        """
+        Extracts the regular files and directories of the archive, other members are skipped.
+        Members are checked lexically instead of with TarFile.extractall's filters, which resolve every path on disk
+        and dominate the extraction time of trees of small files.
+        """
+        try:
+            with tarfile.open(fileobj=self, mode="r|") as archive:
+                for member in archive:
+                    name = os.path.normpath(member.name)
+                    if os.path.isabs(name) or name.split(os.sep)[0] == "..":
+                        raise tarfile.TarError(f"Refusing to extract archive member {member.name}")
+
+                    target = os.path.join(self.file_path, name)
+                    if member.isdir():
+                        os.makedirs(target, exist_ok=True)
+                    elif member.isreg():
+                        with open(target, 'wb') as file:
+                            shutil.copyfileobj(archive.extractfile(member), file)
+                    else:
+                        continue
+                    os.chmod(target, member.mode & 0o755 | (0o700 if member.isdir() else 0o600))
+                    os.utime(target, (member.mtime, member.mtime))
+        except (OSError, tarfile.TarError) as error:
+            self.__error = error
+        finally:
+            while self.read(config.FILE_CHUNK_SIZE):  # Consume the rest of the transfer, so the receiver never blocks
+                pass
+
+
+class DeltaFile:
+    """
+    A file that is received as a delta against the receiver's version of it, with the same interface as IncomingFile.
+    The file is cut into fixed-size blocks. The receiver reports the digest of every block it already has (signature),
+    and the sender only sends the blocks whose digest differs, in FILE_BLOCK messages in increasing offset order.
+    The file is assembled in the temporary ".part" file: blocks that were not sent are copied from the current version
+    of the file, then the temporary file is renamed over it.
+    The complete blocks at the start of a temporary file left behind by an interrupted transfer take precedence over
+    the current version, so a transfer that is retried resumes where the previous one stopped.
+    """
+
+    def __init__(self, file_path: Path, file_size: int, block_size: int):
+        """
+        :param file_path: The path the file is saved to.
+        :param file_size: The size of the file that is sent.
+        :param block_size: The block size of the transfer.
+        :raises FileWriteError: If the temporary file can not be opened.
+        """
+        self.file_path = file_path
+        self.__file_size = file_size
+        self.__block_size = block_size
+        self.__error: Optional[OSError] = None
+        try:
+            self.__file = open(part_path(file_path), 'r+b' if part_path(file_path).exists() else 'w+b')
+            resumed_size = os.fstat(self.__file.fileno()).st_size // block_size * block_size
+            self.__file.truncate(resumed_size)
+            self.__position = resumed_size  # Everything before it is assembled
+            self.__basis = open(file_path, 'rb') if file_path.is_file() else None
+        except OSError as error:
+            raise FileWriteError(f"Failed to save file {file_path}: {error}")
+
+    @property
+    def resumed_size(self) -> int:
+        return self.__position
+
+    def signature(self) -> bytes:
+        """
+        Hashes the blocks the receiver already has: the resumed blocks of the temporary file, then the blocks of the
+        current version of the file. Blocks that exist in neither get an empty digest, which never matches.
+        :return: The concatenated digests of the blocks of the file that is sent.
+        :raises OSError: If the files can not be read.
+        """
+        digests = bytearray()
+        missing = bytes(BLOCK_DIGEST_SIZE)
+        for offset in range(0, self.__file_size, self.__block_size):
+            size = min(self.__block_size, self.__file_size - offset)
+            source = self.__file if offset < self.__position else self.__basis
+            if not source:
+                digests += missing
+                continue
+
+            source.seek(offset)
+            block = source.read(size)
+            digests += block_digest(block) if len(block) == size else missing
+        return bytes(digests)
+
+    def preallocate(self, file_size: int):
+        pass
+
+    def write(self, data: Union[bytes, memoryview]):
+        raise MessageTypeError("Delta transfers can not carry raw file data")
+
+    def write_chunk(self, message: Message):
+        """
+        Writes the block carried by a FILE_BLOCK message, after copying the unchanged blocks before it.
+        :raises MessageTypeError: If the message is not a FILE_BLOCK message or does not carry a block offset.
+        """
+        if not message.is_type(MessageType.FILE_BLOCK):
+            raise MessageTypeError(f"Invalid message type provided: {message.get_type()}, expected FILE_BLOCK type")
+
+        if len(message.data) < BLOCK_OFFSET.size:
+            raise MessageTypeError(f"Received malformed FILE_BLOCK message of {len(message.data)} bytes")
+
+        if self.__error:
+            return
+
+        offset = BLOCK_OFFSET.unpack_from(message.data)[0]
+        block = message.data[BLOCK_OFFSET.size:]
+        try:
+            if offset >= self.__position:
+                self.__copy_basis(offset)
+                self.__position = offset + len(block)
+            self.__file.seek(offset)  # Blocks before the position replace resumed blocks that changed since
+            self.__file.write(block)
+        except OSError as error:
+            self.__error = error
+
+    def finish(self):
+        """
+        Copies the remaining unchanged blocks and moves the file to its destination.
+        :raises FileWriteError: If the file could not be assembled.
+        """
+        try:
+            if not self.__error:
+                self.__copy_basis(self.__file_size)
+                self.__file.truncate(self.__file_size)
+        except OSError as error:
+            self.__error = error
+
+        self.abort()
+        try:
+            if not self.__error:
+                os.replace(self.__file.name, self.file_path)
+        except OSError as error:
+            self.__error = error
+
+        if self.__error:
+            raise FileWriteError(f"Failed to save file {self.file_path}: {self.__error}")
+
+    def abort(self):
+        """
+        Closes the files of an interrupted transfer, the temporary file is kept for a later transfer to resume from.
+        """
+        for file in (self.__file, self.__basis):
+            try:
+                if file:
+                    file.close()
+            except OSError:
+                pass
+
+    def __copy_basis(self, end: int):
+        """
+        Copies the unchanged blocks from the current version of the file up to the given offset.
+        """
+        if self.__position >= end:
+            return
+
+        if not self.__basis:
+            raise OSError(f"Block at offset {self.__position} was neither sent nor present")
+
+        self.__basis.seek(self.__position)
+        self.__file.seek(self.__position)
+        remaining = end - self.__position
+        while remaining:
+            if not (data := self.__basis.read(min(remaining, config.FILE_CHUNK_SIZE))):
+                raise OSError(f"Block at offset {self.__position} was neither sent nor present")
+            self.__file.write(data)
+            remaining -= len(data)
+        self.__position = end
+
+
+def write_directory_archive(dirpath: Path, fileobj):
+    """
+    Writes a tar archive of the regular files and directories of a tree to a file-like object, in streaming mode.
+    The members are built from a single lstat per entry, without the owner lookups of TarFile.add, and in GNU format,
+    which needs no extended header per member.
+    :param dirpath: The root of the tree, its contents are stored relative to it.
+    :param fileobj: The file-like object the archive is written to.
+    :raises OSError: If an error occurs while reading the tree.
+    """
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.GNU_FORMAT) as archive:
+        for root, directories, files in os.walk(dirpath):
+            directories.sort()
+            relative_root = os.path.relpath(root, dirpath)
+            for name in [None, *sorted(files)]:
+                path = root if name is None else os.path.join(root, name)
+                status = os.lstat(path)
+                member = tarfile.TarInfo(relative_root if name is None else os.path.join(relative_root, name))
+                member.mode = stat.S_IMODE(status.st_mode)
+                member.mtime = int(status.st_mtime)
+                if name is None:
+                    member.type = tarfile.DIRTYPE
+                    archive.addfile(member)
+                elif stat.S_ISREG(status.st_mode):
+                    member.size = status.st_size
+                    with open(path, 'rb') as file:
+                        archive.addfile(member, file)
+
+
+def send_file_delta(send_message: Callable[[Message], None], pending_replies: PendingReplies, filepath: Path,
+                    filename_with_destination: bytes, request_id: int):
+    """
+    Sends a file as a delta against the receiver's version of it (see DeltaFile): offers the file in a FILE_SYNC
+    message, waits for the signature of the receiver's version and sends the blocks whose digest differs in FILE_BLOCK
+    messages, followed by an END_OF_FILE message.
+    :param send_message: Sends a message on the connection.
+    :param pending_replies: The pending replies of the connection, which receive the signature.
+    :param filepath: The path to the file to be sent.
+    :param filename_with_destination: The path where the file should be saved on the receiving side.
+    :param request_id: The request ID of the transfer.
+    :raises:
+        FileReadError: When an error occurs while reading the file.
+        TimeoutError: When the receiver does not answer within FILE_SYNC_TIMEOUT.
+        OSError: When the receiver refuses the transfer or an error occurs while sending.
+    """
+    file_size = filepath.stat().st_size
+    block_size = delta_block_size(file_size)
+    reply = pending_replies.expect(request_id)
+    send_message(Message(MessageType.FILE_SYNC, json.dumps({
+        "path": filename_with_destination.decode(),
+        "size": file_size,
+        "block_size": block_size,
+    }).encode(), request_id=request_id))
+    try:
+        signature = reply.result(config.FILE_SYNC_TIMEOUT)
+    except TimeoutError:
+        reply.cancel()
+        raise TimeoutError(f"No signature received for {filepath} after {config.FILE_SYNC_TIMEOUT}s")
+
+    if not signature.is_type(MessageType.FILE_SIGNATURE):
+        raise OSError(f"Delta transfer of {filepath} refused: {signature.decode(errors='replace')}")
+
+    digests = signature.data
+    try:
+        with open(filepath, 'rb') as file:
+            for offset in range(0, file_size, block_size):
+                block = file.read(block_size)
+                index = offset // block_size * BLOCK_DIGEST_SIZE
+                if block_digest(block) != digests[index:index + BLOCK_DIGEST_SIZE]:
+                    send_message(Message(MessageType.FILE_BLOCK, BLOCK_OFFSET.pack(offset) + block,
+                                         request_id=request_id))
+    except OSError:
+        raise FileReadError(f"Failed to read file {filepath}")
+    send_message(Message(MessageType.END_OF_FILE, request_id=request_id))
+
+
+Incoming = Union[IncomingFile, IncomingDirectory, DeltaFile]
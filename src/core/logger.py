@@ -35,7 +35,7 @@ class Logger(RCEEventObserver):
         :param message: The message to be logged.
         :param prefix: An optional prefix to be added to the message.
         """
-        self.__logger.info(f"{self.Colors.INFO}{prefix}{message}{self.Colors.ENDC}")
+        self.__logger.info("%s%s%s%s", self.Colors.INFO, prefix, message, self.Colors.ENDC)
 
     def on_debug(self, message, prefix=""):
         """
@@ -43,7 +43,7 @@ class Logger(RCEEventObserver):
         :param message: The message to be logged.
         :param prefix: An optional prefix to be added to the message.
         """
-        self.__logger.debug(f"{self.Colors.DEBUG}{prefix}{message}{self.Colors.ENDC}")
+        self.__logger.debug("%s%s%s%s", self.Colors.DEBUG, prefix, message, self.Colors.ENDC)
 
     def on_error(self, message, prefix=""):
         """
@@ -51,7 +51,7 @@ class Logger(RCEEventObserver):
         :param message: The message to be logged.
         :param prefix: An optional prefix to be added to the message.
         """
-        self.__logger.error(f"{self.Colors.ERROR}{prefix}{message}{self.Colors.ENDC}")
+        self.__logger.error("%s%s%s%s", self.Colors.ERROR, prefix, message, self.Colors.ENDC)
 
     def on_connect(self, client_address: str):
         """
@@ -65,11 +65,13 @@ class Logger(RCEEventObserver):
         """
         self.on_info(f"Client {client_address} disconnected")
 
-    def on_message(self, sender: str, message: str):
+    def on_message(self, sender: str, message: bytes):
         """
         Logs a message indicating that a message has been received from a client.
+        The message is only decoded if information messages are logged.
         """
-        self.on_info(f"{sender}: {message}")
+        if self.__logger.isEnabledFor(logging.INFO):
+            self.on_info(f"{sender}: {str(message, 'utf-8', 'replace')}")
 
     @staticmethod
     def get_formatter():
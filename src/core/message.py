@@ -1,4 +1,10 @@
+import json
+import struct
+import threading
 from enum import Enum, auto
+from typing import Callable, Optional, Union
+
+import config
 
 
 class MessageType(Enum):
@@ -15,39 +21,202 @@ class MessageType(Enum):
     END_OF_FILE = auto()
     INJECT = auto()
     EXECUTE = auto()
+    FILE_STREAM = auto()
+    HELLO = auto()
+    OUTPUT = auto()
+    EXIT = auto()
+    DIRECTORY_UPLOAD = auto()
+    FILE_SYNC = auto()
+    FILE_SIGNATURE = auto()
+    FILE_BLOCK = auto()
+    PAYLOAD_OFFER = auto()
+    PAYLOAD_STATUS = auto()
+    PING = auto()
+    PONG = auto()
+    FILE_STRIPES = auto()
+    BATCH = auto()
+    BATCH_RESULT = auto()
+
+
+# Message types by value, indexed by the type byte of a frame: a tuple lookup is much cheaper than the Enum's lookup by
+# value on the receive path. Values without a message type map to None.
+MESSAGE_TYPE_TABLE: tuple[Optional[MessageType], ...] = tuple(
+    MessageType._value2member_map_.get(value) for value in range(256))
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+# 4-byte little-endian length that starts every frame, not counting itself
+FRAME_LENGTH = struct.Struct("<I")
+# v1 frame: 4-byte little-endian frame length (type byte + payload) followed by the 1-byte message type
+FRAME_HEADER = struct.Struct("<IB")
+# Set in the type byte of a frame whose payload is compressed with the negotiated algorithm
+COMPRESSED_FLAG = 0x80
+# Set in the type byte of a frame that carries a request ID, a 4-byte little-endian integer following the type byte.
+# Only sent to peers that announced request ID support in their HELLO message, others reject it as an unknown type.
+REQUEST_ID_FLAG = 0x40
+REQUEST_ID = struct.Struct("<I")
+TAGGED_FRAME_HEADER = struct.Struct("<IBI")
+# v2 frame: 4-byte little-endian frame length, a header byte holding VERSIONED_FLAG, the protocol version and the
+# COMPRESSED_FLAG, the 1-byte message type and a 4-byte little-endian stream ID (0 if the frame belongs to no stream).
+# VERSIONED_FLAG is never set in the type byte of a v1 frame, so receivers tell both formats apart.
+V2_FRAME_HEADER = struct.Struct("<IBBI")
+VERSIONED_FLAG = 0x20
+VERSION_MASK = 0x0F
+# The type byte of a v1 frame holds the message type below the flags, which leaves room for 31 message types
+assert max(message_type.value for message_type in MessageType) < VERSIONED_FLAG, "Message types overlap the flags"
+# First byte of an OUTPUT message, identifying the stream of the command the output was read from
+OUTPUT_STDOUT = 1
+OUTPUT_STDERR = 2
+# 8-byte little-endian file size carried by FILE_STREAM messages, the raw file body follows the message
+FILE_SIZE = struct.Struct("<Q")
+# 8-byte little-endian offset of the block carried by a FILE_BLOCK message, the block data follows it
+BLOCK_OFFSET = struct.Struct("<Q")
+# 8-byte little-endian time.monotonic_ns() of the sender carried by PING messages, the PONG answer echoes it back
+HEARTBEAT_TIME = struct.Struct("<Q")
 
 
 class Message:
     """
     Class representing a message that can be sent or received to/from the server.
+    On protocol v2 connections the request ID of a message is sent as its stream ID.
+    The payload of a received message is a memoryview over the connection's receive buffer, which is only valid until
+    the next message is received on that connection. Copy it (e.g. bytes(message.data)) if it has to outlive that.
+    Messages have no instance dictionary, every received frame creates one.
     """
+    __slots__ = ("__type", "__data", "__compressed", "__request_id")
     __type: MessageType
-    __data: bytes
+    __data: Union[bytes, memoryview]
+    __compressed: bool
+    __request_id: Optional[int]
 
-    def __init__(self, message_type: MessageType = None, data: bytes = None):
+    def __init__(self, message_type: MessageType = None, data: Union[bytes, memoryview] = None, compressed=False,
+                 request_id: Optional[int] = None):
+        """
+        :param message_type: The type of the message.
+        :param data: The payload of the message.
+        :param compressed: Whether the payload is compressed with the connection's negotiated algorithm.
+        :param request_id: Optional ID of the request the message belongs to. Results of a request are tagged with
+            the ID of the request, so that several requests can be in flight on one connection.
+        """
         self.__type = message_type
         self.__data = data if data else b''
+        self.__compressed = compressed
+        self.__request_id = request_id
 
     @staticmethod
-    def from_bytes(data: bytes):
+    def from_bytes(data: Union[bytes, bytearray, memoryview]):
         """
         Creates a Message object from a byte representation of the message data.
+        The payload is not copied, it is a memoryview over the given data.
         :param data: The byte representation of the message data.
         :return: A Message object.
+        :raises OSError: If the data is a frame of an unsupported protocol version, or too short for its header.
+        :raises ValueError: If the frame carries an unknown message type.
         """
-        packet_type = MessageType(data[0])
+        type_byte = data[0]
         packet_data = b''
+        request_id = None
+        offset = 1
+
+        if type_byte & VERSIONED_FLAG:
+            if (version := type_byte & VERSION_MASK) != PROTOCOL_V2:
+                raise OSError(f"Received frame of unsupported protocol version {version}")
+            if len(data) < V2_FRAME_HEADER.size - FRAME_LENGTH.size:
+                raise OSError(f"Received malformed v2 frame of {len(data)} bytes")
+            packet_type = MESSAGE_TYPE_TABLE[data[1]]
+            request_id = REQUEST_ID.unpack_from(data, 2)[0] or None
+            offset = V2_FRAME_HEADER.size - FRAME_LENGTH.size
+        else:
+            packet_type = MESSAGE_TYPE_TABLE[type_byte & ~(COMPRESSED_FLAG | REQUEST_ID_FLAG)]
+            if type_byte & REQUEST_ID_FLAG:
+                if len(data) < offset + REQUEST_ID.size:
+                    raise OSError(f"Received malformed tagged frame of {len(data)} bytes")
+                request_id = REQUEST_ID.unpack_from(data, offset)[0]
+                offset += REQUEST_ID.size
+        if packet_type is None:
+            raise ValueError(f"{data[1] if type_byte & VERSIONED_FLAG else type_byte} is not a valid MessageType")
 
-        if len(data) > 1:
-            packet_data = data[1:]
-        return Message(message_type=packet_type, data=packet_data)
+        if len(data) > offset:
+            packet_data = (data if type(data) is memoryview else memoryview(data))[offset:]
+        return Message(packet_type, packet_data, type_byte & COMPRESSED_FLAG != 0, request_id)
 
     def to_bytes(self):
         """
         Converts the message to its byte representation.
         :return: The byte representation of the message
         """
-        return bytes([self.__type.value]) + self.__data
+        header, payload = self.to_buffers()
+        return header[FRAME_HEADER.size - 1:] + payload  # Without the length
+
+    def to_buffers(self, version: int = PROTOCOL_V1, tagged=True):
+        """
+        Converts the message to its framed representation without copying the payload.
+        :param version: The protocol version negotiated on the connection the message is sent on.
+        :param tagged: Whether a v1 frame carries the request ID of the message, only for peers that announced request
+            ID support. v2 frames always carry it.
+        :return: A tuple of the frame header (length and type) and the payload, meant to be written with a single
+            vectored send.
+        """
+        flags = COMPRESSED_FLAG if self.__compressed else 0
+        if version >= PROTOCOL_V2:
+            return V2_FRAME_HEADER.pack(len(self.__data) + V2_FRAME_HEADER.size - 4,
+                                        VERSIONED_FLAG | PROTOCOL_V2 | flags, self.__type.value,
+                                        self.__request_id or 0), self.__data
+
+        type_byte = self.__type.value | flags
+        if self.__request_id is None or not tagged:
+            return FRAME_HEADER.pack(len(self.__data) + 1, type_byte), self.__data
+
+        return TAGGED_FRAME_HEADER.pack(len(self.__data) + 1 + REQUEST_ID.size, type_byte | REQUEST_ID_FLAG,
+                                        self.__request_id), self.__data
+
+    def frame_size(self, version: int = PROTOCOL_V1, tagged=True) -> int:
+        """
+        :return: The size of the frame of the message, including its length (see to_buffers).
+        """
+        if version >= PROTOCOL_V2:
+            return V2_FRAME_HEADER.size + len(self.__data)
+        tagged = tagged and self.__request_id is not None
+        return (TAGGED_FRAME_HEADER if tagged else FRAME_HEADER).size + len(self.__data)
+
+    def pack_into(self, buffer: Union[bytearray, memoryview], offset: int = 0, version: int = PROTOCOL_V1,
+                  tagged=True) -> int:
+        """
+        Writes the frame of the message into a buffer, e.g. to frame a batch of messages into one preallocated buffer
+        instead of allocating the frame of every message.
+        :param buffer: The buffer, it must have room for frame_size(version) bytes from the offset.
+        :param offset: The position of the frame in the buffer.
+        :param version: The protocol version negotiated on the connection the message is sent on.
+        :param tagged: Whether a v1 frame carries the request ID of the message (see to_buffers).
+        :return: The size of the frame.
+        """
+        data = self.__data
+        flags = COMPRESSED_FLAG if self.__compressed else 0
+        if version >= PROTOCOL_V2:
+            V2_FRAME_HEADER.pack_into(buffer, offset, len(data) + V2_FRAME_HEADER.size - 4,
+                                      VERSIONED_FLAG | PROTOCOL_V2 | flags, self.__type.value, self.__request_id or 0)
+            end = offset + V2_FRAME_HEADER.size
+        elif self.__request_id is None or not tagged:
+            FRAME_HEADER.pack_into(buffer, offset, len(data) + 1, self.__type.value | flags)
+            end = offset + FRAME_HEADER.size
+        else:
+            TAGGED_FRAME_HEADER.pack_into(buffer, offset, len(data) + 1 + REQUEST_ID.size,
+                                          self.__type.value | flags | REQUEST_ID_FLAG, self.__request_id)
+            end = offset + TAGGED_FRAME_HEADER.size
+        buffer[end:end + len(data)] = data
+        return end + len(data) - offset
+
+    def copy(self) -> "Message":
+        """
+        :return: A copy of the message that owns its payload, for messages that have to outlive the receive buffer.
+        """
+        return Message(self.__type, bytes(self.__data), self.__compressed, self.__request_id)
+
+    def with_data(self, data: Union[bytes, memoryview], compressed=False) -> "Message":
+        """
+        :return: A message of the same type and request with the given payload.
+        """
+        return Message(self.__type, data, compressed, self.__request_id)
 
     def get_type(self):
         return self.__type
@@ -59,9 +228,191 @@ class Message:
     def data(self):
         return self.__data
 
+    @property
+    def compressed(self):
+        return self.__compressed
+
+    @property
+    def request_id(self):
+        return self.__request_id
+
+    def decode(self, encoding="utf-8", errors="strict") -> str:
+        """
+        Decodes the payload to a string.
+        :param encoding: The encoding of the payload.
+        :param errors: The error handling scheme, as for bytes.decode().
+        :return: The decoded payload.
+        """
+        return str(self.__data, encoding, errors)
+
     def __repr__(self):
         return (f"""
         Message:
           TYPE: {self.__type}
-          DATA: {self.__data}
+          COMPRESSED: {self.__compressed}
+          REQUEST ID: {self.__request_id}
+          DATA: {bytes(self.__data)}
         """)
+
+
+class PreparedMessage(Message):
+    """
+    A message that is framed once and then reused for every send, e.g. when the same message is broadcast to many
+    clients. The payload is copied once into an immutable buffer and compressed variants are only created once per
+    compression algorithm.
+    """
+    __slots__ = ("__buffers", "__variants", "__lock")
+
+    def __init__(self, message_type: MessageType = None, data: Union[bytes, memoryview] = None, compressed=False,
+                 request_id: Optional[int] = None):
+        super().__init__(message_type, bytes(data) if data else None, compressed, request_id)
+        self.__buffers = {version: super(PreparedMessage, self).to_buffers(version)
+                          for version in (PROTOCOL_V1, PROTOCOL_V2)}
+        self.__variants: dict[str, PreparedMessage] = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def of(message: Message) -> "PreparedMessage":
+        """
+        :param message: The message to prepare.
+        :return: The message itself if it is already prepared, otherwise a prepared copy of it.
+        """
+        if isinstance(message, PreparedMessage):
+            return message
+        return PreparedMessage(message.get_type(), message.data, message.compressed, message.request_id)
+
+    def to_buffers(self, version: int = PROTOCOL_V1, tagged=True):
+        if not tagged and version < PROTOCOL_V2 and self.request_id is not None:  # Only the header is framed again
+            return super().to_buffers(version, tagged)
+        return self.__buffers[min(version, PROTOCOL_V2)]
+
+    def compressed_variant(self, algorithm: str, compress: Callable[[bytes], Optional[bytes]]) -> "PreparedMessage":
+        """
+        Returns the variant of this message compressed with the given algorithm, creating it on first use.
+        :param algorithm: The name of the compression algorithm.
+        :param compress: Function compressing the payload, returning None if the payload is not worth compressing.
+        :return: The compressed variant, or this message if the payload is not worth compressing.
+        """
+        with self.__lock:
+            if algorithm not in self.__variants:
+                compressed = compress(self.data)
+                self.__variants[algorithm] = self if compressed is None else \
+                    PreparedMessage(self.get_type(), compressed, compressed=True, request_id=self.request_id)
+            return self.__variants[algorithm]
+
+
+class FrameDecoder:
+    """
+    Decodes the frames received on a connection in bulk: the receive buffer is filled by reads as large as the free
+    space in it, and all the complete frames it holds are parsed in a single pass. A burst of small messages costs one
+    read instead of two per message.
+    The payloads of the decoded messages are memoryviews over the buffer, they stay valid until the next fill().
+    Parsing stops after a FILE_STREAM message, the raw file body that follows it is not framed and is read with
+    read_into() instead.
+    """
+
+    def __init__(self, size: int = config.RECEIVE_BUFFER_SIZE):
+        """
+        :param size: The initial size of the buffer, it grows to hold frames that are larger.
+        """
+        self.__buffer = bytearray(size)
+        self.__start = 0  # The first byte that was not decoded yet
+        self.__end = 0  # The end of the received bytes
+
+    @property
+    def buffered(self) -> int:
+        """
+        :return: The number of bytes received but not decoded yet.
+        """
+        return self.__end - self.__start
+
+    def fill(self, recv_into: Callable[[memoryview], int]) -> int:
+        """
+        Receives more bytes into the buffer. The bytes that were not decoded yet are moved to the front of the buffer
+        first, which invalidates the payloads of the messages decoded before. A new buffer is allocated if the frame
+        being received does not fit, the decoded messages may still reference the current one.
+        :param recv_into: Receives bytes into a memoryview and returns their number, e.g. socket.recv_into.
+        :return: The number of bytes received, 0 if the peer closed the connection.
+        """
+        buffered = self.__end - self.__start
+        needed = FRAME_LENGTH.size
+        if buffered >= FRAME_LENGTH.size:
+            needed += FRAME_LENGTH.unpack_from(self.__buffer, self.__start)[0]
+        if needed > len(self.__buffer):
+            buffer = bytearray(needed)
+            buffer[:buffered] = memoryview(self.__buffer)[self.__start:self.__end]
+            self.__buffer = buffer
+        elif self.__start:
+            self.__buffer[:buffered] = memoryview(self.__buffer)[self.__start:self.__end]
+        self.__start, self.__end = 0, buffered
+
+        received = recv_into(memoryview(self.__buffer)[buffered:])
+        self.__end += received
+        return received
+
+    def decode(self, max_message_size: int = config.MAX_MESSAGE_SIZE) -> list[tuple[Message, int]]:
+        """
+        Decodes the complete frames in the buffer.
+        :param max_message_size: The maximum size of a frame, not counting its length.
+        :return: The decoded messages with the sizes of their frames, in the order they were received.
+        :raises OSError: If a frame is empty or larger than the maximum size, or of an unsupported protocol version.
+        :raises ValueError: If a frame carries an unknown message type.
+        """
+        buffer, position, end = self.__buffer, self.__start, self.__end
+        view = memoryview(buffer)
+        messages = []
+        while end - position >= 4:
+            size = FRAME_LENGTH.unpack_from(buffer, position)[0]
+            if not size:
+                raise OSError("Received null bytes for message size")
+            if size > max_message_size:
+                raise OSError(f"Message size {size} exceeds the maximum of {max_message_size} bytes")
+            if end - position - 4 < size:
+                break
+
+            message = Message.from_bytes(view[position + 4:position + 4 + size])
+            messages.append((message, size + 4))
+            position += size + 4
+            if message.get_type() is MessageType.FILE_STREAM:
+                break
+        self.__start = position
+        return messages
+
+    def read_into(self, buffer: memoryview) -> int:
+        """
+        Moves bytes that were received but not decoded, e.g. the start of a raw file body, into another buffer.
+        :return: The number of bytes moved.
+        """
+        size = min(len(buffer), self.__end - self.__start)
+        buffer[:size] = memoryview(self.__buffer)[self.__start:self.__start + size]
+        self.__start += size
+        return size
+
+
+def hello_capabilities(message: Message) -> dict:
+    """
+    Decodes the capabilities a peer announced in its HELLO message.
+    :param message: The HELLO message carrying the capabilities as a JSON object.
+    :return: The capabilities, whose compression, protocol and tags entries are lists if present.
+    :raises ValueError: If the message is not a JSON object, or one of these entries is not a list (of protocol
+        versions).
+    """
+    capabilities = json.loads(message.decode())
+    if not isinstance(capabilities, dict):
+        raise ValueError("The capabilities are not a JSON object")
+
+    for key in ("compression", "protocol", "tags"):
+        if not isinstance(capabilities.get(key, []), list):
+            raise ValueError(f"The {key} capability is not a list")
+    if not all(type(version) is int for version in capabilities.get("protocol", [])):
+        raise ValueError("The protocol capability is not a list of versions")
+    return capabilities
+
+
+def negotiate_protocol(offered: list[int]) -> int:
+    """
+    Picks the highest protocol version supported by both peers. Peers that do not offer any version only speak v1.
+    :param offered: The protocol versions supported by the peer.
+    :return: The protocol version to use on the connection.
+    """
+    return max(set(offered) & set(config.PROTOCOL_VERSIONS), default=PROTOCOL_V1)
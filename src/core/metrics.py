@@ -0,0 +1,487 @@
+import bisect
+import collections
+import itertools
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import config
+from src.core.message import MESSAGE_TYPE_TABLE, Message, MessageType
+from src.core.observer import RCEEventObserver
+
+MESSAGE_TYPES = max(message_type.value for message_type in MessageType) + 1  # Counters are indexed by type value
+# Requests whose round trip is timed and the reply types that complete them, by message type value
+ROUND_TRIPS = {
+    MessageType.CMD.value: (MessageType.EXIT.value, MessageType.ERROR.value),
+    MessageType.EXECUTE.value: (MessageType.ECHO.value, MessageType.EXIT.value, MessageType.ERROR.value),
+    MessageType.BATCH.value: (MessageType.BATCH_RESULT.value, MessageType.ERROR.value),
+}
+
+
+class Histogram:
+    """
+    Histogram over fixed buckets, as exported in the Prometheus text format: the number of observations per bucket
+    upper bound, their sum and their count.
+    """
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative(self) -> list[int]:
+        """
+        :return: The number of observations less than or equal to every bucket bound, the last one being +Inf.
+        """
+        return list(itertools.accumulate(self.counts))
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimates a quantile by interpolating linearly within the bucket it falls in, like Prometheus'
+        histogram_quantile does.
+        :param q: The quantile, between 0 (exclusive) and 1.
+        :return: The estimate or None if nothing was observed. Quantiles beyond the last bucket bound are estimated
+            as that bound.
+        """
+        counts = self.cumulative()
+        if not counts[-1]:
+            return None
+
+        rank = q * counts[-1]
+        index = bisect.bisect_left(counts, rank)
+        if index == len(self.buckets):
+            return self.buckets[-1]
+
+        lower, below = (self.buckets[index - 1], counts[index - 1]) if index else (0.0, 0)
+        return lower + (self.buckets[index] - lower) * (rank - below) / (counts[index] - below)
+
+    def add(self, other: "Histogram"):
+        """
+        Adds the observations of another histogram over the same buckets to this histogram.
+        """
+        with other.__lock:
+            counts, total, count = list(other.counts), other.sum, other.count
+        with self.__lock:
+            self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+            self.sum += total
+            self.count += count
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_Histogram__lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+
+class TrafficCounters:
+    """
+    Message and byte counters of a connection by message type value, updated on its send and receive paths. Messages
+    are counted with their frame header once they have been written or read.
+    The counters are not locked, every direction has a single writer at a time: sends are serialized by the connection
+    and receives happen on its receiving thread or event loop.
+    If the counters are given latency histograms, the round trips of CMD, EXECUTE and BATCH requests are timed, from the
+    request being written until the reply that completes it is read (see ROUND_TRIPS).
+    """
+
+    def __init__(self, latency: Optional[dict[MessageType, Histogram]] = None):
+        self.sent_messages = [0] * MESSAGE_TYPES
+        self.sent_bytes = [0] * MESSAGE_TYPES
+        self.received_messages = [0] * MESSAGE_TYPES
+        self.received_bytes = [0] * MESSAGE_TYPES
+        self.__latency = latency
+        self.__requests: collections.OrderedDict[int, tuple[int, float]] = collections.OrderedDict()
+
+    def sent(self, message: Message, size: int):
+        """
+        :param message: The message that was written.
+        :param size: The size of its frame in bytes.
+        """
+        index = message.get_type()._value_  # Faster than the value property, which is on the hot path
+        self.sent_messages[index] += 1
+        self.sent_bytes[index] += size
+        if self.__latency is not None and index in ROUND_TRIPS and message.request_id is not None:
+            self.__requests[message.request_id] = (index, time.monotonic())
+            if len(self.__requests) > config.METRICS_PENDING_REQUESTS:
+                self.__requests.popitem(last=False)
+
+    def received(self, message: Message, size: int):
+        """
+        :param message: The message that was read.
+        :param size: The size of its frame in bytes.
+        """
+        index = message.get_type()._value_
+        self.received_messages[index] += 1
+        self.received_bytes[index] += size
+        if not self.__requests or (request := self.__requests.get(message.request_id)) is None:
+            return
+        if index in ROUND_TRIPS[request[0]] and self.__requests.pop(message.request_id, None):
+            self.__latency[MESSAGE_TYPE_TABLE[request[0]]].observe(time.monotonic() - request[1])
+
+    def body_sent(self, size: int):
+        """
+        Accounts the raw body of a FILE_STREAM message, which is written without framing.
+        """
+        self.sent_bytes[MessageType.FILE_STREAM.value] += size
+
+    def body_received(self, size: int):
+        """
+        Accounts the raw body of a FILE_STREAM message, which is read without framing.
+        """
+        self.received_bytes[MessageType.FILE_STREAM.value] += size
+
+    def add(self, other: "TrafficCounters"):
+        """
+        Adds the counters of another connection to these counters.
+        """
+        for mine, theirs in ((self.sent_messages, other.sent_messages), (self.sent_bytes, other.sent_bytes),
+                             (self.received_messages, other.received_messages),
+                             (self.received_bytes, other.received_bytes)):
+            for index, value in enumerate(theirs):
+                mine[index] += value
+
+
+class MetricsObserver(RCEEventObserver):
+    """
+    Collects the metrics of the server: the messages and bytes sent and received per message type and per client, the
+    latency of CMD, EXECUTE and BATCH round trips, the throughput of file transfers and the connect and disconnect
+    rates.
+    The hot paths do not go through the observer: every connection counts its traffic in the TrafficCounters it got
+    from track(), the observer only sums them up when the metrics are read. Connects and disconnects are taken from
+    the server's events, the traffic of a client is folded into the totals once it disconnected.
+    """
+
+    events = frozenset(("on_connect", "on_disconnect"))
+    overflow_policy = "block"  # Handling an event is cheap, and missed disconnects would leak the clients' counters
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.latency = {MessageType(value): Histogram(config.METRICS_LATENCY_BUCKETS) for value in ROUND_TRIPS}
+        self.throughput = Histogram(config.METRICS_THROUGHPUT_BUCKETS)
+        self.transferred_bytes = 0
+        self.transfer_seconds = 0.0
+        self.connects = 0
+        self.disconnects = 0
+        self.__connect_times: collections.deque[float] = collections.deque()
+        self.__disconnect_times: collections.deque[float] = collections.deque()
+        self.__clients: dict[str, list[TrafficCounters]] = {}
+        self.__retired = TrafficCounters()  # Traffic of the clients that disconnected
+        self.__lock = threading.Lock()
+
+    def track(self, client_address: str) -> TrafficCounters:
+        """
+        :param client_address: The address of a new connection.
+        :return: The counters the connection has to update, whose round trips are timed.
+        """
+        counters = TrafficCounters(self.latency)
+        with self.__lock:
+            # A previous connection from the same address may not have been reported as disconnected yet
+            self.__clients.setdefault(client_address, []).append(counters)
+        return counters
+
+    def transferred(self, size: int, seconds: float, count: int = 1):
+        """
+        Records completed file transfers.
+        :param size: The number of bytes of the file or directory archive transferred to every client.
+        :param seconds: The duration of the transfer.
+        :param count: The number of clients the transfer completed for.
+        """
+        if count <= 0:
+            return
+
+        with self.__lock:
+            self.transferred_bytes += size * count
+            self.transfer_seconds += seconds * count
+        for _ in range(count):
+            self.throughput.observe(size / max(seconds, 1e-6))
+
+    def traffic(self, client_address: Optional[str] = None) -> TrafficCounters:
+        """
+        :param client_address: The address of a connected client, None for the traffic of all clients.
+        :return: The summed up counters.
+        """
+        total = TrafficCounters()
+        with self.__lock:
+            if client_address is None:
+                total.add(self.__retired)
+            for address, counters in self.__clients.items():
+                if client_address is None or address == client_address:
+                    for client_counters in counters:
+                        total.add(client_counters)
+        return total
+
+    def connect_rate(self) -> float:
+        """
+        :return: The number of connects per second over the last config.METRICS_RATE_WINDOW seconds.
+        """
+        with self.__lock:
+            return self.__rate(self.__connect_times)
+
+    def disconnect_rate(self) -> float:
+        """
+        :return: The number of disconnects per second over the last config.METRICS_RATE_WINDOW seconds.
+        """
+        with self.__lock:
+            return self.__rate(self.__disconnect_times)
+
+    def connected_clients(self) -> list[str]:
+        with self.__lock:
+            return list(self.__clients)
+
+    def on_connect(self, client_address: str):
+        with self.__lock:
+            self.connects += 1
+            self.__connect_times.append(time.monotonic())
+            self.__rate(self.__connect_times)
+
+    def on_disconnect(self, client_address: str):
+        with self.__lock:
+            self.disconnects += 1
+            self.__disconnect_times.append(time.monotonic())
+            self.__rate(self.__disconnect_times)
+            if counters := self.__clients.get(client_address):
+                self.__retired.add(counters.pop(0))  # Connections from the same address disconnect in order
+                if not counters:
+                    del self.__clients[client_address]
+
+    def on_message(self, sender: str, message: bytes):
+        pass
+
+    def on_info(self, message: str, prefix=""):
+        pass
+
+    def on_debug(self, message: str, prefix=""):
+        pass
+
+    def on_error(self, error: str, prefix=""):
+        pass
+
+    def snapshot(self) -> "MetricsSnapshot":
+        """
+        :return: A copy of the current metrics.
+        """
+        snapshot = MetricsSnapshot()
+        snapshot.uptime = time.monotonic() - self.started_at
+        with self.__lock:
+            snapshot.connects, snapshot.disconnects = self.connects, self.disconnects
+            snapshot.connect_rate = self.__rate(self.__connect_times)
+            snapshot.disconnect_rate = self.__rate(self.__disconnect_times)
+            snapshot.transferred_bytes, snapshot.transfer_seconds = self.transferred_bytes, self.transfer_seconds
+        snapshot.traffic = self.traffic()
+        snapshot.clients = {address: self.traffic(address) for address in self.connected_clients()}
+        for message_type, histogram in self.latency.items():
+            snapshot.latency[message_type].add(histogram)
+        snapshot.throughput.add(self.throughput)
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        """
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        return self.snapshot().to_prometheus()
+
+    def write_prometheus(self, path: str):
+        """
+        Writes the metrics to a file in the Prometheus text format (see MetricsSnapshot.write_prometheus).
+        :raises OSError: If the file can not be written.
+        """
+        self.snapshot().write_prometheus(path)
+
+    def __rate(self, times: collections.deque[float]) -> float:
+        """
+        Forgets the events older than config.METRICS_RATE_WINDOW, the lock must be held.
+        :return: The number of events per second within the window.
+        """
+        window_start = time.monotonic() - config.METRICS_RATE_WINDOW
+        while times and times[0] < window_start:
+            times.popleft()
+        return len(times) / config.METRICS_RATE_WINDOW
+
+
+class MetricsSnapshot:
+    """
+    Copy of the metrics of a server at one point in time. Snapshots can be pickled, e.g. to send them from the shards of
+    a sharded server to its control plane, which merges them with add().
+    """
+
+    def __init__(self):
+        self.uptime = 0.0
+        self.connects = 0
+        self.disconnects = 0
+        self.connect_rate = 0.0
+        self.disconnect_rate = 0.0
+        self.traffic = TrafficCounters()
+        self.clients: dict[str, TrafficCounters] = {}  # The traffic of every connected client
+        self.latency = {MessageType(value): Histogram(config.METRICS_LATENCY_BUCKETS) for value in ROUND_TRIPS}
+        self.throughput = Histogram(config.METRICS_THROUGHPUT_BUCKETS)
+        self.transferred_bytes = 0
+        self.transfer_seconds = 0.0
+        self.reaped = 0  # Unresponsive clients reaped by the heartbeat monitor
+        self.export_error: Optional[str] = None
+
+    def add(self, other: "MetricsSnapshot"):
+        """
+        Adds the metrics of another server to this snapshot.
+        """
+        self.uptime = max(self.uptime, other.uptime)
+        self.connects += other.connects
+        self.disconnects += other.disconnects
+        self.connect_rate += other.connect_rate
+        self.disconnect_rate += other.disconnect_rate
+        self.traffic.add(other.traffic)
+        self.clients.update(other.clients)
+        for message_type, histogram in other.latency.items():
+            self.latency[message_type].add(histogram)
+        self.throughput.add(other.throughput)
+        self.transferred_bytes += other.transferred_bytes
+        self.transfer_seconds += other.transfer_seconds
+        self.reaped += other.reaped
+        self.export_error = self.export_error or other.export_error
+
+    def to_prometheus(self) -> str:
+        """
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name: str, kind: str, description: str, samples: list[tuple[str, float]]):
+            lines.extend((f"# HELP {name} {description}", f"# TYPE {name} {kind}"))
+            lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+        traffic = self.traffic
+        directions = (("sent", traffic.sent_messages, traffic.sent_bytes),
+                      ("received", traffic.received_messages, traffic.received_bytes))
+        metric("rce_messages_total", "counter", "Messages sent and received by message type.",
+               [(f'{{direction="{direction}",type="{message_type.name}"}}', messages[message_type.value])
+                for direction, messages, _ in directions for message_type in MessageType
+                if messages[message_type.value]])
+        metric("rce_bytes_total", "counter", "Bytes sent and received by message type.",
+               [(f'{{direction="{direction}",type="{message_type.name}"}}', sizes[message_type.value])
+                for direction, _, sizes in directions for message_type in MessageType if sizes[message_type.value]])
+
+        clients = list(self.clients.items())
+        metric("rce_client_messages_total", "counter", "Messages sent to and received from every connected client.",
+               [(f'{{client="{address}",direction="{direction}"}}', sum(counts))
+                for address, counters in clients
+                for direction, counts in (("sent", counters.sent_messages), ("received", counters.received_messages))])
+        metric("rce_client_bytes_total", "counter", "Bytes sent to and received from every connected client.",
+               [(f'{{client="{address}",direction="{direction}"}}', sum(counts))
+                for address, counters in clients
+                for direction, counts in (("sent", counters.sent_bytes), ("received", counters.received_bytes))])
+
+        latency_samples = []
+        for message_type, histogram in self.latency.items():
+            latency_samples.extend(self.__histogram_samples(histogram, f'type="{message_type.name}",'))
+        metric("rce_request_duration_seconds", "histogram", "Round trip latency of CMD, EXECUTE and BATCH requests.",
+               latency_samples)
+        metric("rce_transfer_throughput_bytes_per_second", "histogram", "Throughput of the file transfers per client.",
+               self.__histogram_samples(self.throughput))
+        metric("rce_transfer_bytes_total", "counter", "Bytes of the file transfers, summed over the clients.",
+               [("", self.transferred_bytes)])
+        metric("rce_transfer_seconds_total", "counter", "Duration of the file transfers, summed over the clients.",
+               [("", round(self.transfer_seconds, 6))])
+
+        metric("rce_connects_total", "counter", "Client connects.", [("", self.connects)])
+        metric("rce_disconnects_total", "counter", "Client disconnects.", [("", self.disconnects)])
+        metric("rce_connect_rate", "gauge", f"Client connects per second over the last {config.METRICS_RATE_WINDOW}s.",
+               [("", round(self.connect_rate, 6))])
+        metric("rce_disconnect_rate", "gauge",
+               f"Client disconnects per second over the last {config.METRICS_RATE_WINDOW}s.",
+               [("", round(self.disconnect_rate, 6))])
+        metric("rce_reaped_clients_total", "counter", "Unresponsive clients reaped by the heartbeat monitor.",
+               [("", self.reaped)])
+        metric("rce_connected_clients", "gauge", "Connected clients.", [("", len(clients))])
+        metric("rce_uptime_seconds", "gauge", "Seconds since the metrics started being collected.",
+               [("", round(self.uptime, 3))])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """
+        Writes the metrics to a file in the Prometheus text format. The file is replaced atomically, so that readers
+        never see a partially written file.
+        :param path: The path of the file.
+        :raises OSError: If the file can not be written.
+        """
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(self.to_prometheus())
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def __histogram_samples(histogram: Histogram, labels: str = "") -> list[tuple[str, float]]:
+        """
+        :param labels: Labels shared by the samples, followed by a comma.
+        :return: The bucket, sum and count samples of a histogram.
+        """
+        bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+        samples = [(f'_bucket{{{labels}le="{bound}"}}', count) for bound, count in zip(bounds, histogram.cumulative())]
+        samples.append((f"_sum{{{labels.rstrip(',')}}}" if labels else "_sum", round(histogram.sum, 6)))
+        samples.append((f"_count{{{labels.rstrip(',')}}}" if labels else "_count", histogram.count))
+        return samples
+
+
+class MetricsExporter:
+    """
+    Writes metrics to a file in the Prometheus text format periodically from a thread of its own, e.g. for the textfile
+    collector of the node exporter.
+    """
+
+    def __init__(self, snapshot: Callable[[], MetricsSnapshot], path: str,
+                 interval: float = config.METRICS_EXPORT_INTERVAL):
+        """
+        :param snapshot: Returns the metrics to write.
+        :param path: The path of the file.
+        :param interval: The number of seconds between two writes.
+        """
+        self.__snapshot = snapshot
+        self.__path = path
+        self.__interval = interval
+        self.error: Optional[OSError] = None  # The error of the last failed write, if any
+        self.__thread: Optional[threading.Thread] = None
+        self.__stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None
+
+    def start(self):
+        if self.__thread:
+            return
+
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__export, daemon=True, name="metrics-exporter")
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stops the export, the metrics are written a last time.
+        """
+        if not self.__thread:
+            return
+
+        self.__stopped.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def __export(self):
+        while True:
+            stopped = self.__stopped.wait(self.__interval)
+            try:
+                self.__snapshot().write_prometheus(self.__path)
+                self.error = None
+            except OSError as e:
+                self.error = e
+            if stopped:
+                return
@@ -1,12 +1,19 @@
 import abc
 
+import config
+
 
 class RCEEventObserver:
     """
     Interface for the implementation of observers for RCE events that the server may emit
     i.e. connection, disconnection, messages, logs, errors, etc.
+    The server delivers the events on a dispatcher thread of the observer's own (see EventBus), overflow_policy decides
+    what happens when the observer falls behind (see config.OBSERVER_OVERFLOW_POLICIES).
     """
 
+    overflow_policy = config.OBSERVER_OVERFLOW_POLICY
+    events = None  # Names of the methods of the events the observer is notified of, None for all events
+
     @abc.abstractmethod
     def on_connect(self, client_address: str):
         raise NotImplementedError
@@ -16,7 +23,11 @@ class RCEEventObserver:
         raise NotImplementedError
 
     @abc.abstractmethod
-    def on_message(self, sender: str, message: str):
+    def on_message(self, sender: str, message: bytes):
+        """
+        :param sender: The address of the client the message was received from.
+        :param message: The raw payload of the message, which the observer decodes if it needs to.
+        """
         raise NotImplementedError
 
     @abc.abstractmethod
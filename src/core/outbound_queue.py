@@ -0,0 +1,102 @@
+import collections
+import threading
+import time
+from typing import Optional, Union
+
+import config
+from src.core.message import Message
+
+Buffer = Union[bytes, bytearray, memoryview]
+Frame = tuple[bytes, Buffer, Message]  # The header and payload of a frame, and the message they frame
+
+
+class OutboundQueue:
+    """
+    Bounded queue of the frames waiting to be written to a connection, accounted in bytes.
+    Once the queued bytes reach the high-water mark the connection is congested: no more frames are accepted until
+    the writer has drained the queue down to the low-water mark. A frame stays accounted until it has been written, so
+    the frame being written counts as well. The time since the connection became congested is tracked, so that
+    clients that stay congested for too long can be dropped.
+    """
+
+    def __init__(self, high_water: int = config.OUTBOUND_HIGH_WATER, low_water: int = config.OUTBOUND_LOW_WATER):
+        self.__high_water = high_water
+        self.__low_water = low_water
+        self.__frames: collections.deque[Frame] = collections.deque()
+        self.__size = 0
+        self.__congested_since: Optional[float] = None
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    @property
+    def congested(self) -> bool:
+        return self.__congested_since is not None
+
+    def stalled_for(self) -> float:
+        """
+        :return: The number of seconds the connection has been congested for, 0 if it is not congested.
+        """
+        congested_since = self.__congested_since
+        return time.monotonic() - congested_since if congested_since is not None else 0.0
+
+    def put(self, frame: Frame) -> bool:
+        """
+        Queues a frame without blocking. A frame is always accepted by an empty queue, however large it is.
+        :param frame: The header and payload of the frame, and the message it frames.
+        :return: False if the frame was not queued because the connection is congested.
+        """
+        with self.__condition:
+            if self.__closed or self.__congested_since is not None:
+                return False
+
+            self.__frames.append(frame)
+            self.__size += len(frame[0]) + len(frame[1])
+            if self.__size >= self.__high_water:
+                self.__congested_since = time.monotonic()
+            self.__condition.notify()
+            return True
+
+    def pop(self) -> Optional[Frame]:
+        """
+        :return: The next frame to write or None if the queue is empty. Call written() once it has been written.
+        """
+        with self.__condition:
+            return self.__frames.popleft() if self.__frames else None
+
+    def written(self, size: int):
+        """
+        Releases the bytes of written frames, which ends the congestion once the low-water mark is reached. Frames
+        that were being written when the queue was closed are no longer accounted, they are ignored.
+        :param size: The number of bytes written.
+        """
+        with self.__condition:
+            if self.__closed:
+                return
+
+            self.__size -= size
+            if self.__congested_since is not None and self.__size <= self.__low_water:
+                self.__congested_since = None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until a frame is queued or the queue is closed.
+        :return: Whether a frame is queued.
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__frames or self.__closed, timeout)
+            return bool(self.__frames) and not self.__closed
+
+    def close(self):
+        """
+        Discards the queued frames and wakes the writer, e.g. when the connection is closed.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__frames.clear()
+            self.__size = 0
+            self.__congested_since = None
+            self.__condition.notify_all()
@@ -0,0 +1,67 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import config
+
+
+def payload_digest(source: bytes) -> str:
+    """
+    :return: The content hash identifying a payload, its source's SHA-256 hex digest.
+    """
+    return hashlib.sha256(source).hexdigest()
+
+
+class PayloadCache:
+    """
+    LRU cache of the compiled payloads of a client, keyed by the content hash of their source. Names are bound to a
+    hash, so a payload injected under several names or re-injected unchanged is compiled once. When a payload is
+    evicted, the names bound to it are forgotten and have to be injected again.
+    """
+
+    def __init__(self, capacity: int = config.PAYLOAD_CACHE_SIZE):
+        self.__capacity = capacity
+        self.__payloads: OrderedDict[str, Callable] = OrderedDict()
+        self.__names: dict[str, str] = {}
+        self.__lock = threading.Lock()
+
+    def bind(self, name: str, digest: str) -> bool:
+        """
+        Binds a name to a cached payload.
+        :param name: The name the payload is executed by.
+        :param digest: The content hash of the payload.
+        :return: Whether the payload is cached, if not it has to be added.
+        """
+        with self.__lock:
+            if digest not in self.__payloads:
+                return False
+            self.__payloads.move_to_end(digest)
+            self.__names[name] = digest
+            return True
+
+    def add(self, name: str, digest: str, payload: Callable):
+        """
+        Caches a compiled payload and binds a name to it, evicting the least recently used payloads beyond capacity.
+        :param name: The name the payload is executed by.
+        :param digest: The content hash of the payload.
+        :param payload: The payload function, compiled from the payload's source.
+        """
+        with self.__lock:
+            self.__payloads[digest] = payload
+            self.__payloads.move_to_end(digest)
+            self.__names[name] = digest
+            while len(self.__payloads) > self.__capacity:
+                evicted, _ = self.__payloads.popitem(last=False)
+                self.__names = {name: digest for name, digest in self.__names.items() if digest != evicted}
+
+    def get(self, name: str) -> Optional[Callable]:
+        """
+        :param name: The name the payload was bound to.
+        :return: The payload function or None if no cached payload is bound to the name.
+        """
+        with self.__lock:
+            if (digest := self.__names.get(name)) not in self.__payloads:
+                return None
+            self.__payloads.move_to_end(digest)
+            return self.__payloads[digest]
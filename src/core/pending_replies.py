@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import Future
+
+from src.core.message import Message
+
+
+class PendingReplies:
+    """
+    Keeps track of the requests a connection is waiting on a reply for, e.g. the FILE_SIGNATURE a delta transfer waits
+    for. Replies are matched to their request by request ID, a request may be answered by an ERROR message instead of
+    the expected reply. The receiving side of the connection resolves them, the requesting side waits on the returned
+    future from any thread.
+    """
+
+    def __init__(self):
+        self.__futures: dict[int, Future] = {}
+        self.__lock = threading.Lock()
+
+    def expect(self, request_id: int) -> Future:
+        """
+        Registers a request that waits for a reply. Must be called before the request is sent. Callers that stop
+        waiting must cancel the future.
+        :param request_id: The request ID the reply is tagged with.
+        :return: A future that is resolved with the reply message, which owns its payload.
+        """
+        future = Future()
+        with self.__lock:
+            self.__futures[request_id] = future
+        future.add_done_callback(lambda _: self.__discard(request_id, future))
+        return future
+
+    def resolve(self, message: Message) -> bool:
+        """
+        Passes a reply to the request waiting for it.
+        :param message: The received reply.
+        :return: Whether a request was waiting for the reply.
+        """
+        if message.request_id is None:
+            return False
+
+        with self.__lock:
+            future = self.__futures.pop(message.request_id, None)
+        if not future or not future.set_running_or_notify_cancel():
+            return False
+
+        future.set_result(message.copy())
+        return True
+
+    def fail_all(self, error: Exception):
+        """
+        Fails every pending request, e.g. when the connection is closed.
+        """
+        with self.__lock:
+            futures = list(self.__futures.values())
+            self.__futures.clear()
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def __discard(self, request_id: int, future: Future):
+        """
+        Forgets a request that is done, e.g. because its caller stopped waiting.
+        """
+        with self.__lock:
+            if self.__futures.get(request_id) is future:
+                del self.__futures[request_id]
@@ -0,0 +1,410 @@
+import abc
+import contextlib
+import hashlib
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+import config
+from src.core.exception import FileReadError, FileWriteError, MessageTypeError
+from src.core.file_transfer import IncomingFile
+from src.core.message import FRAME_LENGTH, Message, MessageType
+
+# Positioned writes are not available on every platform (e.g. Windows), peers without them never stripe transfers
+HAS_PWRITE = hasattr(os, "pwrite")
+STRIPE_DIGEST_SIZE = 32
+# Receivers open the data connections a sender announces, up to this many per transfer
+MAX_STRIPES = 64
+
+
+def stripe_ranges(file_size: int, stripes: int) -> list[tuple[int, int]]:
+    """
+    Splits a file into at most `stripes` contiguous byte ranges of whole FILE_CHUNK_SIZE chunks, the last range takes
+    the remainder.
+    :return: The offset and length of every range.
+    """
+    chunks = -(-file_size // config.FILE_CHUNK_SIZE)
+    stripe_size = max(1, -(-chunks // max(1, stripes))) * config.FILE_CHUNK_SIZE
+    return [(offset, min(stripe_size, file_size - offset)) for offset in range(0, file_size, stripe_size)]
+
+
+def stripe_count(file_size: int, stripes: Optional[int], file_transfer_mode: str) -> int:
+    """
+    :param file_size: The size of the file that is sent.
+    :param stripes: The number of stripes requested for the transfer, if any.
+    :param file_transfer_mode: The transfer mode of the connection, "striped" stripes files of at least
+        FILE_STRIPE_MIN_SIZE bytes into FILE_STRIPES stripes.
+    :return: The number of stripes the file is sent in, 0 if it is not striped.
+    """
+    if stripes is None and file_transfer_mode == "striped" and file_size >= config.FILE_STRIPE_MIN_SIZE:
+        stripes = config.FILE_STRIPES
+    return stripes if stripes and stripes > 1 and file_size else 0
+
+
+def send_frame(sock: socket.socket, message: Message):
+    """
+    Sends a v1 frame on a data connection, which carries nothing but its HELLO messages and the raw stripe.
+    """
+    header, payload = message.to_buffers()
+    sock.sendall(bytes(header) + bytes(payload))
+
+
+def receive_frame(sock: socket.socket) -> Message:
+    """
+    Receives a frame on a data connection, nothing beyond it.
+    :raises OSError: If the connection is closed or the frame is larger than a HELLO message can be.
+    """
+    size = FRAME_LENGTH.unpack(receive_exactly(sock, FRAME_LENGTH.size))[0]
+    if not 0 < size <= 64 * config.KB:
+        raise OSError(f"Received invalid frame size {size} on a data connection")
+    return Message.from_bytes(receive_exactly(sock, size))
+
+
+def receive_exactly(sock: socket.socket, size: int) -> bytearray:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        if not (packet_size := sock.recv_into(view[received:])):
+            raise OSError("Data connection closed by peer")
+        received += packet_size
+    return data
+
+
+def connect_stripe(address: tuple[str, int], token: str, index: int) -> socket.socket:
+    """
+    Opens a data connection of a striped transfer: announces the transfer and the stripe in a HELLO message and waits
+    for the peer's answer, which it sends once the stripe can be transferred.
+    :param address: The address of the peer, the one the connection of the transfer is connected to.
+    :param token: The token of the transfer.
+    :param index: The index of the stripe.
+    :return: The connected socket, with a timeout of FILE_STRIPE_TIMEOUT seconds.
+    :raises OSError: If the connection fails or the peer refuses it.
+    """
+    sock = socket.create_connection(address, timeout=config.FILE_STRIPE_TIMEOUT)
+    try:
+        send_frame(sock, Message(MessageType.HELLO, json.dumps({"stripe": token, "index": index}).encode()))
+        if not receive_frame(sock).is_type(MessageType.HELLO):
+            raise OSError(f"Data connection of stripe {index} refused")
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+class StripeTransfer(abc.ABC):
+    """
+    A file transfer whose byte ranges (stripes) are transferred in parallel, each over a data connection of its own to
+    the same peer. Data connections are opened by the client side of the connection the transfer is announced on, the
+    server receives them like client connections and hands them to the transfer by its token (see StripeRegistry).
+    Every stripe runs on the thread its data connection is served by, the digests of the stripes verify the result.
+    """
+
+    def __init__(self, ranges: list[tuple[int, int]], token: Optional[str] = None):
+        """
+        :param ranges: The offset and length of every stripe.
+        :param token: The token the data connections present, a new one if the transfer is sent.
+        """
+        self.ranges = ranges
+        self.token = token or secrets.token_hex(16)
+        self.digests: list[Optional[str]] = [None] * len(ranges)
+        self.error: Optional[Exception] = None
+        self.started_at = time.monotonic()
+        self.__attached: set[int] = set()
+        self.__sockets: set[socket.socket] = set()
+        self.__condition = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        """
+        :return: Whether every stripe has been transferred, or the transfer failed.
+        """
+        return self.error is not None or None not in self.digests
+
+    def run(self, index: int, sock: socket.socket):
+        """
+        Transfers a stripe over its data connection, on the calling thread. Failures fail the whole transfer.
+        :param index: The index of the stripe.
+        :param sock: The data connection, closed by the caller.
+        """
+        with self.__condition:
+            if self.error or not 0 <= index < len(self.ranges) or index in self.__attached:
+                return
+            self.__attached.add(index)
+            self.__sockets.add(sock)
+            self.__condition.notify_all()
+
+        digest = None
+        try:
+            digest = self.transfer_stripe(index, sock)
+        except (OSError, FileReadError) as error:
+            self.fail(error)
+        finally:
+            with self.__condition:
+                self.__sockets.discard(sock)
+                self.digests[index] = digest if not self.error else None
+                self.__condition.notify_all()
+
+    @abc.abstractmethod
+    def transfer_stripe(self, index: int, sock: socket.socket) -> str:
+        """
+        :return: The hex digest of the stripe.
+        :raises OSError: If the stripe could not be transferred.
+        """
+        raise NotImplementedError
+
+    def fail(self, error: Exception):
+        """
+        Fails the transfer, the data connections that are still transferring are shut down, which stops their stripes.
+        """
+        with self.__condition:
+            self.error = self.error or error
+            for sock in self.__sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.__condition.notify_all()
+
+    def wait(self, timeout: float = config.FILE_STRIPE_TIMEOUT):
+        """
+        Waits until every stripe has been transferred, or until the transfer failed and none of its stripes runs
+        anymore, so the file can be closed. The data connections have to come up within the timeout, a stripe that
+        stalls once it runs fails with its data connection.
+        :raises OSError: If the transfer failed or timed out.
+        """
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.error or len(self.__attached) == len(self.ranges), timeout):
+                self.fail(TimeoutError(f"Data connections of the striped transfer not opened after {timeout}s"))
+            self.__condition.wait_for(lambda: self.finished and not self.__sockets)
+        if self.error:
+            raise self.error if isinstance(self.error, OSError) else OSError(str(self.error))
+
+    def throughput(self) -> float:
+        """
+        :return: The aggregate throughput of the stripes in bytes per second, so far.
+        """
+        size = sum(length for (_, length), digest in zip(self.ranges, self.digests) if digest)
+        return size / max(time.monotonic() - self.started_at, 1e-9)
+
+
+class StripedSender(StripeTransfer):
+    """
+    The sending side of a striped transfer: every stripe is read with positioned reads of FILE_CHUNK_SIZE bytes and
+    hashed while it is sent.
+    """
+
+    def __init__(self, descriptor: int, ranges: list[tuple[int, int]]):
+        """
+        :param descriptor: The file descriptor of the file that is sent.
+        :param ranges: The offset and length of every stripe.
+        """
+        super().__init__(ranges)
+        self.__descriptor = descriptor
+
+    def transfer_stripe(self, index: int, sock: socket.socket) -> str:
+        offset, remaining = self.ranges[index]
+        digest = hashlib.blake2b(digest_size=STRIPE_DIGEST_SIZE)
+        while remaining:
+            try:
+                chunk = os.pread(self.__descriptor, min(remaining, config.FILE_CHUNK_SIZE), offset)
+            except OSError as error:
+                raise FileReadError(f"Failed to read stripe {index}: {error}")
+            if not chunk:
+                raise FileReadError("File was truncated while being sent")
+            digest.update(chunk)
+            sock.sendall(chunk)
+            offset += len(chunk)
+            remaining -= len(chunk)
+        return digest.hexdigest()
+
+
+class StripedFile(StripeTransfer):
+    """
+    The receiving side of a striped transfer, with the interface of an incoming file (see IncomingFile). Every stripe
+    is received in windows of FILE_CHUNK_SIZE bytes and written at its offset with positioned writes, so the stripes
+    are written in parallel and the file is assembled in place. The END_OF_FILE message of the transfer carries the
+    digests of the stripes as the sender read them, the file is only moved to its destination if they match.
+    """
+
+    def __init__(self, incoming: IncomingFile, message: Message):
+        """
+        :param incoming: The file opened by the FILE_UPLOAD message of the transfer, which is written in place.
+        :param message: The FILE_STRIPES message of the transfer, carrying the token, the file size and the stripes.
+        :raises MessageTypeError: If the message is malformed or the stripes do not cover the file.
+        """
+        try:
+            announcement = json.loads(message.decode())
+            token, file_size = str(announcement["token"]), int(announcement["size"])
+            ranges = [(int(offset), int(length)) for offset, length in announcement["stripes"]]
+        except (KeyError, TypeError, ValueError) as error:
+            raise MessageTypeError(f"Received malformed FILE_STRIPES message: {error}")
+
+        position = 0
+        for offset, length in ranges:
+            if offset != position or length <= 0:
+                raise MessageTypeError("Stripes of the striped transfer do not cover the file")
+            position += length
+        if position != file_size or len(ranges) > MAX_STRIPES:
+            raise MessageTypeError(f"Striped transfer of {len(ranges)} stripes does not cover the file")
+
+        super().__init__(ranges, token)
+        self.file_path = incoming.file_path
+        self.__incoming = incoming
+        self.__expected: Optional[list[str]] = None
+        incoming.preallocate(file_size)
+
+    def transfer_stripe(self, index: int, sock: socket.socket) -> str:
+        offset, remaining = self.ranges[index]
+        digest = hashlib.blake2b(digest_size=STRIPE_DIGEST_SIZE)
+        buffer = memoryview(bytearray(min(remaining, config.FILE_CHUNK_SIZE)))
+        while remaining:
+            window = buffer[:min(remaining, len(buffer))]
+            received = 0
+            while received < len(window):
+                if not (packet_size := sock.recv_into(window[received:])):
+                    raise OSError(f"Data connection of stripe {index} closed while receiving data")
+                received += packet_size
+            self.__incoming.write_at(window, offset)
+            digest.update(window)
+            offset += len(window)
+            remaining -= len(window)
+        return digest.hexdigest()
+
+    def preallocate(self, file_size: int):
+        pass
+
+    def write(self, data: Union[bytes, memoryview]):
+        raise MessageTypeError("Striped transfers carry their data on their data connections")
+
+    def write_chunk(self, message: Message):
+        """
+        Takes the digests of the stripes from the END_OF_FILE message of the transfer.
+        :raises MessageTypeError: If the message is not an END_OF_FILE message carrying the digests.
+        """
+        if not message.is_type(MessageType.END_OF_FILE):
+            raise MessageTypeError(f"Invalid message type provided: {message.get_type()}, expected END_OF_FILE type")
+
+        try:
+            self.__expected = [str(digest) for digest in json.loads(message.decode())]
+        except (TypeError, ValueError) as error:
+            raise MessageTypeError(f"Received malformed digests of a striped transfer: {error}")
+
+    def finish(self):
+        """
+        Waits until every stripe has been received, verifies the digests of the stripes and moves the file to its
+        destination. The sender sends the END_OF_FILE message once it has sent every stripe, so waiting is bounded by
+        the data still in flight.
+        :raises FileWriteError: If the transfer failed, or the file does not match what the sender read.
+        """
+        if self.__expected is None:  # The sender failed to send the stripes
+            self.fail(OSError("Striped transfer was interrupted by the sender"))
+        try:
+            self.wait()
+            if self.digests != self.__expected:
+                raise OSError("Stripes do not match the digests of the sender")
+        except OSError as error:
+            self.__incoming.abort()
+            raise FileWriteError(f"Failed to save file {self.file_path}: {error}")
+        self.__incoming.finish()
+
+    def abort(self):
+        """
+        Fails the stripes that are still being received and closes the file once they stopped, see IncomingFile.abort.
+        """
+        self.fail(OSError("Transfer aborted"))
+        with contextlib.suppress(OSError):
+            self.wait()
+        self.__incoming.abort()
+
+
+class StripeRegistry:
+    """
+    Hands the data connections of the striped transfers of a server to the transfers they belong to, by the token the
+    transfer announced. Data connections are accepted like client connections, the HELLO message they start with
+    identifies them. Finished transfers are forgotten as new ones are opened.
+    """
+
+    def __init__(self):
+        self.__transfers: dict[str, StripeTransfer] = {}
+        self.__condition = threading.Condition()
+
+    def open(self, transfer: StripeTransfer):
+        """
+        Registers a transfer, whose data connections are then expected.
+        """
+        with self.__condition:
+            for token in [token for token, other in self.__transfers.items() if other.finished]:
+                del self.__transfers[token]
+            self.__transfers[transfer.token] = transfer
+            self.__condition.notify_all()
+
+    def attach(self, token: Any, index: Any, sock: socket.socket):
+        """
+        Runs the stripe of a data connection on the calling thread. The transfer may be registered after its data
+        connection arrived, as it is announced on another connection, so it is waited for up to FILE_STRIPE_TIMEOUT.
+        The HELLO message of the data connection is answered once its transfer is known.
+        :param token: The token the data connection presented.
+        :param index: The index of the stripe.
+        :param sock: The data connection, closed by the caller.
+        :raises OSError: If no such transfer was opened.
+        """
+        if not isinstance(token, str) or not isinstance(index, int):
+            raise OSError("Malformed HELLO message of a data connection")
+
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: token in self.__transfers, config.FILE_STRIPE_TIMEOUT):
+                raise OSError("Data connection of an unknown striped transfer")
+            transfer = self.__transfers[token]
+
+        sock.settimeout(config.FILE_STRIPE_TIMEOUT)
+        send_frame(sock, Message(MessageType.HELLO, json.dumps({"stripe": token}).encode()))
+        transfer.run(index, sock)
+
+
+def send_file_striped(send_message: Callable[[Message], None], open_stripes: Callable[[StripeTransfer], None],
+                      filepath: Path, filename_with_destination: bytes, request_id: int, stripes: int) -> float:
+    """
+    Sends a file in a striped transfer (see StripeTransfer): the FILE_UPLOAD message is followed by a FILE_STRIPES
+    message announcing the token, the file size and the stripes. Once every stripe has been sent over its data
+    connection, an END_OF_FILE message carries the digests of the stripes, or nothing if the transfer failed.
+    :param send_message: Sends a message on the connection.
+    :param open_stripes: Opens the data connections of the transfer, or waits for them on the server.
+    :param filepath: The path to the file to be sent.
+    :param filename_with_destination: The path where the file should be saved on the receiving side.
+    :param request_id: The request ID of the transfer.
+    :param stripes: The number of stripes.
+    :return: The aggregate throughput of the stripes in bytes per second.
+    :raises:
+        FileReadError: When an error occurs while reading the file.
+        OSError: When the data connections fail or do not come up within FILE_STRIPE_TIMEOUT.
+    """
+    try:
+        file = open(filepath, 'rb')
+    except OSError:
+        raise FileReadError(f"Failed to read file {filepath}")
+
+    with file:
+        file_size = os.fstat(file.fileno()).st_size
+        transfer = StripedSender(file.fileno(), stripe_ranges(file_size, stripes))
+        send_message(Message(MessageType.FILE_UPLOAD, filename_with_destination, request_id=request_id))
+        send_message(Message(MessageType.FILE_STRIPES, json.dumps({
+            "token": transfer.token,
+            "size": file_size,
+            "stripes": transfer.ranges,
+        }).encode(), request_id=request_id))
+        open_stripes(transfer)
+        try:
+            transfer.wait()  # The file stays open until no stripe reads it anymore
+        except OSError:
+            send_message(Message(MessageType.END_OF_FILE, request_id=request_id))
+            if isinstance(transfer.error, FileReadError):
+                raise transfer.error
+            raise
+    send_message(Message(MessageType.END_OF_FILE, json.dumps(transfer.digests).encode(), request_id=request_id))
+    return transfer.throughput()
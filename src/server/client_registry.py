@@ -0,0 +1,238 @@
+import bisect
+import ipaddress
+import re
+import threading
+import time
+from typing import Any, Optional
+
+from src.core.metrics import TrafficCounters
+
+Address = tuple[str, int]
+# Indexed attributes of a client: the client, its tags, hostname, IP key (version, integer value) and connect time
+Entry = tuple[Any, frozenset[str], str, tuple[int, int], float]
+
+SELECTOR_TERM = re.compile(r"^(\w+)\s*(=|<|>)\s*(\S+)$")
+SELECTOR_AND = re.compile(r"\s+AND\s+", re.IGNORECASE)
+
+
+class RegistrySnapshot:
+    """
+    Immutable view of the registry: the registered clients and the secondary indexes over them.
+    Indexes map to frozensets of client addresses, the IP and connect time indexes are tuples sorted for range queries.
+    """
+
+    def __init__(self, entries: dict[Address, Entry] = None, tags: dict[str, frozenset[Address]] = None,
+                 hostnames: dict[str, frozenset[Address]] = None, ips: tuple[tuple[int, int, Address], ...] = (),
+                 connected: tuple[tuple[float, Address], ...] = ()):
+        self.entries = entries or {}
+        self.tags = tags or {}
+        self.hostnames = hostnames or {}
+        self.ips = ips
+        self.connected = connected
+
+
+class ClientInfo:
+    """
+    Copy of the state of a connected client as shown to operators, which can be pickled, e.g. to send the client lists
+    of the shards of a sharded server to its control plane.
+    """
+
+    def __init__(self, client_address_str: str, hostname: str = "", protocol_version: int = 1,
+                 compression: Optional[str] = None, bytes_saved: int = 0, outbound_bytes: int = 0,
+                 rtt: Optional[float] = None, tags: tuple[str, ...] = (), traffic: TrafficCounters = None,
+                 shard: Optional[int] = None):
+        self.client_address_str = client_address_str
+        self.hostname = hostname
+        self.protocol_version = protocol_version
+        self.compression = compression  # The negotiated compression algorithm
+        self.bytes_saved = bytes_saved
+        self.outbound_bytes = outbound_bytes
+        self.rtt = rtt
+        self.tags = tags
+        self.traffic = traffic or TrafficCounters()
+        self.shard = shard  # The index of the shard serving the client, None if the server is not sharded
+
+    @classmethod
+    def of(cls, client: Any) -> "ClientInfo":
+        """
+        :param client: A client thread/connection.
+        """
+        traffic = TrafficCounters()
+        traffic.add(client.traffic)
+        return cls(client.client_address_str, client.hostname, client.protocol_version, client.compression.algorithm,
+                   client.compression.bytes_saved, client.outbound_bytes, client.rtt, tuple(sorted(client.tags)),
+                   traffic)
+
+
+class ClientRegistry:
+    """
+    Registry of the connected clients, indexed by address and by the tags and hostname the clients report in their
+    HELLO message, their subnet and their connect time, so that selectors (see select) resolve without scanning the
+    whole fleet.
+    Writers update the indexes in place under a lock and invalidate the published snapshot. Readers use the published
+    snapshot without locking, only the first read after a change rebuilds it, so connects and disconnects stay cheap
+    during reconnect storms and lookups never wait for a writer to finish a batch of changes.
+    """
+
+    def __init__(self):
+        self.__entries: dict[Address, Entry] = {}
+        self.__tags: dict[str, set[Address]] = {}
+        self.__hostnames: dict[str, set[Address]] = {}
+        self.__ips: list[tuple[int, int, Address]] = []
+        self.__connected: list[tuple[float, Address]] = []
+        self.__snapshot: Optional[RegistrySnapshot] = RegistrySnapshot()
+        self.__write_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def add(self, client: Any):
+        """
+        Registers a client under its address, replacing a client previously registered under it.
+        :param client: The client thread/connection, exposing get_address(), tags, hostname and connected_at.
+        """
+        with self.__write_lock:
+            if client.get_address() in self.__entries:
+                self.__unindex(client.get_address())
+            self.__index(client)
+
+    def update(self, client: Any):
+        """
+        Re-indexes a registered client whose tags or hostname changed, e.g. after its HELLO message.
+        """
+        with self.__write_lock:
+            if (entry := self.__entries.get(client.get_address())) and entry[0] is client:
+                self.__unindex(client.get_address())
+                self.__index(client)
+
+    def remove(self, client: Any) -> bool:
+        """
+        Unregisters a client, unless another client was registered under its address since.
+        :return: Whether the client was registered.
+        """
+        with self.__write_lock:
+            if not (entry := self.__entries.get(client.get_address())) or entry[0] is not client:
+                return False
+            self.__unindex(client.get_address())
+            return True
+
+    def clear(self) -> list[Any]:
+        """
+        Unregisters all clients.
+        :return: The clients that were registered.
+        """
+        with self.__write_lock:
+            clients = [entry[0] for entry in self.__entries.values()]
+            self.__entries, self.__tags, self.__hostnames = {}, {}, {}
+            self.__ips, self.__connected = [], []
+            self.__snapshot = None
+            return clients
+
+    def all(self) -> list[Any]:
+        return [entry[0] for entry in self.snapshot().entries.values()]
+
+    def find(self, client_address: str) -> Optional[Any]:
+        """
+        :param client_address: The address of the client as "host:port".
+        :return: The client registered under the address or None if there is none or the address is malformed.
+        """
+        host, _, port = client_address.rpartition(":")
+        if not port.isdigit():
+            return None
+        entry = self.__entries.get((host, int(port)))  # A single lookup, it does not need a consistent snapshot
+        return entry[0] if entry else None
+
+    def snapshot(self) -> RegistrySnapshot:
+        """
+        :return: The current immutable view of the registry, rebuilt if the registry changed since it was published.
+        """
+        if snapshot := self.__snapshot:
+            return snapshot
+
+        with self.__write_lock:
+            if not self.__snapshot:
+                self.__snapshot = RegistrySnapshot(dict(self.__entries),
+                                                   {key: frozenset(value) for key, value in self.__tags.items()},
+                                                   {key: frozenset(value) for key, value in self.__hostnames.items()},
+                                                   tuple(self.__ips), tuple(self.__connected))
+            return self.__snapshot
+
+    def select(self, selector: str) -> list[Any]:
+        """
+        Returns the clients matching a selector: terms joined by AND, each of which is one of
+          - tag=<tag>: the client reported the tag.
+          - host=<hostname>: the client reported the hostname.
+          - subnet=<network>: the client's IP is in the network, e.g. 10.1.0.0/16.
+          - addr=<host:port>: the client's address.
+          - age<<seconds> / age><seconds>: the client connected less / more than the given seconds ago.
+          - *: every client.
+        Every term is resolved through an index, the terms are intersected smallest first.
+        :param selector: The selector, e.g. "tag=web AND subnet=10.1.0.0/16".
+        :return: The matching clients, ordered by address.
+        :raises ValueError: If the selector is malformed.
+        """
+        snapshot = self.snapshot()
+        matches = sorted((self.__resolve(snapshot, term) for term in SELECTOR_AND.split(selector.strip())), key=len)
+        addresses = matches[0].intersection(*matches[1:])
+        return [snapshot.entries[address][0] for address in sorted(addresses)]
+
+    @staticmethod
+    def __resolve(snapshot: RegistrySnapshot, term: str) -> frozenset[Address]:
+        """
+        :return: The addresses of the clients matching a single selector term.
+        """
+        if term == "*":
+            return frozenset(snapshot.entries)
+        if not (match := SELECTOR_TERM.match(term)):
+            raise ValueError(f"Invalid selector term: '{term}'")
+
+        key, operator, value = match.groups()
+        if (key, operator) == ("tag", "="):
+            return snapshot.tags.get(value, frozenset())
+        if (key, operator) == ("host", "="):
+            return snapshot.hostnames.get(value, frozenset())
+        if (key, operator) == ("addr", "="):
+            host, _, port = value.rpartition(":")
+            address = (host, int(port)) if port.isdigit() else None
+            return frozenset((address,)) if address in snapshot.entries else frozenset()
+        if (key, operator) == ("subnet", "="):
+            network = ipaddress.ip_network(value, strict=False)
+            start = bisect.bisect_left(snapshot.ips, (network.version, int(network.network_address)))
+            end = bisect.bisect_left(snapshot.ips, (network.version, int(network.broadcast_address) + 1))
+            return frozenset(address for _, _, address in snapshot.ips[start:end])
+        if key == "age" and operator in "<>":
+            threshold = time.monotonic() - float(value)
+            split = bisect.bisect_right(snapshot.connected, threshold, key=lambda connect: connect[0])
+            connects = snapshot.connected[split:] if operator == "<" else snapshot.connected[:split]
+            return frozenset(address for _, address in connects)
+        raise ValueError(f"Invalid selector term: '{term}'")
+
+    def __index(self, client: Any):
+        """
+        Adds the client to the indexes, the write lock must be held.
+        """
+        address = client.get_address()
+        ip = ipaddress.ip_address(address[0])
+        entry = (client, frozenset(client.tags), client.hostname, (ip.version, int(ip)), client.connected_at)
+        self.__entries[address] = entry
+        for tag in entry[1]:
+            self.__tags.setdefault(tag, set()).add(address)
+        if client.hostname:
+            self.__hostnames.setdefault(client.hostname, set()).add(address)
+        bisect.insort(self.__ips, (ip.version, int(ip), address))
+        bisect.insort(self.__connected, (client.connected_at, address))
+        self.__snapshot = None
+
+    def __unindex(self, address: Address):
+        """
+        Removes the client registered under the address from the indexes, the write lock must be held.
+        """
+        _, tags, hostname, ip_key, connected_at = self.__entries.pop(address)
+        for index, keys in ((self.__tags, tags), (self.__hostnames, (hostname,) if hostname else ())):
+            for key in keys:
+                index[key].discard(address)
+                if not index[key]:
+                    del index[key]
+        del self.__ips[bisect.bisect_left(self.__ips, (*ip_key, address))]
+        del self.__connected[bisect.bisect_left(self.__connected, (connected_at, address))]
+        self.__snapshot = None
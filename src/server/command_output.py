@@ -0,0 +1,133 @@
+import codecs
+import json
+import typing
+
+from src.core.command_batch import decode_results, format_results
+from src.core.exception import MessageTypeError
+from src.core.message import OUTPUT_STDERR, OUTPUT_STDOUT, Message
+
+if typing.TYPE_CHECKING:
+    from src.server.rce_server import RCEServer
+
+
+class CommandOutput:
+    """
+    Renders the output that a client streams while running commands.
+    OUTPUT messages are decoded incrementally, so characters split across messages are not mangled, and passed on to
+    the server's observers as they arrive: stdout as messages and stderr as errors. The EXIT message reports the exit
+    status of the command. Several commands may run at once, their output is told apart by request ID. The results of
+    a batch of commands arrive at once in a BATCH_RESULT message.
+    The replies to requests that are fanned out (see RCEServer.fan_out) are gathered in the request's ResultSet
+    instead, they are only passed on to the observers if the result set asks for it.
+    """
+
+    def __init__(self, server_instance: "RCEServer", client_address_str: str):
+        self.server = server_instance
+        self.client_address_str = client_address_str
+        self.__decoders = {}
+
+    def on_output(self, message: Message):
+        """
+        :param message: An OUTPUT message, whose first byte identifies the stream the output was read from.
+        """
+        if not message.data:
+            return
+
+        stream = message.data[0]
+        key = (message.request_id, stream)
+        if key not in self.__decoders:
+            self.__decoders[key] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        if not (text := self.__decoders[key].decode(message.data[1:])):
+            return
+
+        if results := self.server.result_set(message.request_id):
+            results.output(self.client_address_str, stream, text)
+            if not results.notify:
+                return
+
+        if stream == OUTPUT_STDERR:
+            self.server.on_error(text, prefix=f"CLIENT {self.sender(message)} ")
+        else:
+            self.server.on_message(self.sender(message), Message(data=text.encode()))
+
+    def on_exit(self, message: Message):
+        """
+        :param message: An EXIT message carrying the exit status of the command as JSON.
+        """
+        for stream in (OUTPUT_STDOUT, OUTPUT_STDERR):  # Drop incomplete characters at the end of the output
+            if decoder := self.__decoders.pop((message.request_id, stream), None):
+                decoder.decode(b"", final=True)
+
+        prefix = f"CLIENT {self.sender(message)} "
+        results = self.server.result_set(message.request_id)
+        try:
+            result = json.loads(message.decode())
+        except ValueError:
+            if results:
+                results.fail(self.client_address_str, "Received malformed EXIT message")
+            self.server.on_error("Received malformed EXIT message", prefix=prefix)
+            return
+
+        if results:
+            results.finish(self.client_address_str, result.get("status"), bool(result.get("truncated")))
+            if not results.notify:
+                return
+
+        status = f"Command exited with status {result.get('status')}"
+        if result.get("truncated"):
+            status += " (output truncated)"
+        self.server.on_info(status, prefix=prefix)
+
+    def on_batch_result(self, message: Message):
+        """
+        :param message: A BATCH_RESULT message carrying the results of the commands of a batch as JSON, which are passed
+            on to the observers as a single message.
+        """
+        prefix = f"CLIENT {self.sender(message)} "
+        results = self.server.result_set(message.request_id)
+        try:
+            commands, skipped = decode_results(message.data)
+        except MessageTypeError as e:
+            if results:
+                results.fail(self.client_address_str, str(e))
+            self.server.on_error(str(e), prefix=prefix)
+            return
+
+        if results:
+            results.finish_batch(self.client_address_str, commands, skipped)
+            if not results.notify:
+                return
+
+        self.server.on_message(self.sender(message), Message(data=format_results(commands, skipped).encode()))
+
+    def on_echo(self, message: Message):
+        """
+        :param message: An ECHO message, which carries the output of a payload or of a "cd" command if it answers a
+            request.
+        """
+        if results := self.server.result_set(message.request_id):
+            results.finish(self.client_address_str, output=message.decode(errors="replace"))
+            if not results.notify:
+                return
+
+        self.server.on_message(self.sender(message), message)
+
+    def on_error(self, message: Message):
+        """
+        :param message: An ERROR message that no pending reply was waiting for.
+        """
+        if results := self.server.result_set(message.request_id):
+            results.fail(self.client_address_str, message.decode(errors="replace"))
+            if not results.notify:
+                return
+
+        self.server.on_error(message.decode(), prefix=f"CLIENT {self.sender(message)} ")
+
+    def sender(self, message: Message):
+        """
+        :return: The address of the client, followed by the request ID if the message belongs to a request.
+        """
+        if message.request_id is None:
+            return self.client_address_str
+        return f"{self.client_address_str} #{message.request_id}"
@@ -0,0 +1,124 @@
+import socket
+import threading
+import time
+import typing
+from typing import Optional
+
+import config
+from src.core.exception import MessageTypeError
+from src.core.message import HEARTBEAT_TIME, Message, MessageType
+
+if typing.TYPE_CHECKING:
+    from src.server.rce_server import RCEServer
+
+# Weight of a new RTT sample in the smoothed RTT of a connection, as in TCP's SRTT (RFC 6298)
+RTT_GAIN = 0.125
+
+
+class HeartbeatMonitor:
+    """
+    Sends PING messages to the clients that support heartbeats and reaps the clients that have gone silent, e.g. peers
+    that disappeared without closing their connection. A client is alive as long as it sends anything, the PONG
+    answers to the pings only guarantee that a healthy client does. Clients are never reaped while a transfer holds
+    their connection, the pings are queued behind it and cannot be answered until it is complete.
+    The PONG answers also give the round trip time of every connection, which includes the time the ping waited in
+    the outbound queue of the connection.
+    Connections of clients without heartbeat support are left to TCP keepalive (see enable_keepalive).
+    """
+
+    def __init__(self, server: "RCEServer", interval: Optional[float] = config.HEARTBEAT_INTERVAL,
+                 timeout: float = config.HEARTBEAT_TIMEOUT):
+        """
+        :param server: The server whose clients are monitored.
+        :param interval: The number of seconds between two pings, None disables heartbeats.
+        :param timeout: The number of seconds after which a silent client is reaped.
+        :raises ValueError: If the timeout is not longer than the interval.
+        """
+        if interval is not None and timeout <= interval:
+            raise ValueError(f"The heartbeat timeout ({timeout}s) must be longer than the interval ({interval}s)")
+
+        self.__server = server
+        self.interval = interval
+        self.timeout = timeout
+        self.reaped = 0
+        self.__thread: Optional[threading.Thread] = None
+        self.__stopped = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval is not None
+
+    def start(self):
+        if not self.enabled or self.__thread:
+            return
+
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name="heartbeat-monitor")
+        self.__thread.start()
+
+    def stop(self):
+        if not self.__thread:
+            return
+
+        self.__stopped.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def enable_keepalive(self, sock: socket.socket):
+        """
+        Enables TCP keepalive on a client socket, so that the kernel probes a peer that has been silent for the
+        heartbeat interval and resets the connection once the peer has not answered within the heartbeat timeout.
+        Where the platform supports it, data that stays unacknowledged for the heartbeat timeout resets the connection
+        as well (TCP_USER_TIMEOUT), so that writes to a dead peer fail instead of blocking.
+        The timers are only set on platforms that expose them, the others use the system defaults.
+        :param sock: The socket of a client connection.
+        """
+        if not self.enabled:
+            return
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        interval = max(1, int(self.interval))
+        probes = max(1, round((self.timeout - self.interval) / self.interval))
+        for option, value in (("TCP_KEEPIDLE", interval), ("TCP_KEEPALIVE", interval), ("TCP_KEEPINTVL", interval),
+                              ("TCP_KEEPCNT", probes), ("TCP_USER_TIMEOUT", int(self.timeout * 1000))):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def on_pong(self, client: "RCEServer.Client", message: Message):
+        """
+        Updates the smoothed RTT of a client with the round trip of a ping.
+        :param client: The client that answered the ping.
+        :param message: The PONG message, which echoes the time the ping was sent at.
+        :raises MessageTypeError: If the message does not carry the time of a ping.
+        """
+        if len(message.data) != HEARTBEAT_TIME.size:
+            raise MessageTypeError(f"Received malformed PONG message of {len(message.data)} bytes")
+
+        sample = (time.monotonic_ns() - HEARTBEAT_TIME.unpack(message.data)[0]) / 1e9
+        client.rtt = sample if client.rtt is None else client.rtt + RTT_GAIN * (sample - client.rtt)
+
+    def beat(self):
+        """
+        Reaps the clients that have been silent for longer than the timeout and pings the others.
+        """
+        now = time.monotonic()
+        ping = Message(MessageType.PING, HEARTBEAT_TIME.pack(time.monotonic_ns()))
+        for client in self.__server.clients.all():
+            if not client.heartbeat or not client.is_connected() or client.transferring:
+                continue
+
+            if (silent_for := now - client.last_received) > self.timeout:
+                self.__server.on_info(f"Reaping unresponsive client, nothing received for {silent_for:.0f}s",
+                                      prefix=f"CLIENT {client.client_address_str} ")
+                self.reaped += 1
+                client.abort()  # Its connection handler removes it from the registry
+                continue
+
+            try:
+                client.post_message(ping)  # Congested clients are skipped, they are dropped once they stall
+            except OSError:  # The client has just disconnected
+                pass
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            self.beat()
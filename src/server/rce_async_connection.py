@@ -0,0 +1,733 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import socket
+import tarfile
+import threading
+import time
+import typing
+from pathlib import Path
+from typing import Any, Optional
+
+import config
+from src.core.compression import Compression
+from src.core.exception import FileReadError, FileWriteError, MessageTypeError
+from src.core.file_transfer import (FILE_BODY_TYPES, ChunkWriter, DeltaFile, Incoming, IncomingDirectory,
+                                    IncomingFile, send_file_delta, stream_size, write_directory_archive)
+from src.core.message import (FILE_SIZE, PROTOCOL_V1, PROTOCOL_V2, Message, MessageType, hello_capabilities,
+                              negotiate_protocol)
+from src.core.metrics import TrafficCounters
+from src.core.outbound_queue import OutboundQueue
+from src.core.pending_replies import PendingReplies
+from src.core.striped_transfer import StripedFile, StripeTransfer, send_file_striped, stripe_count
+from src.server.command_output import CommandOutput
+
+if typing.TYPE_CHECKING:
+    from src.server.rce_server import RCEServer
+
+
+class RCEAsyncConnection:
+    """
+    Represents a client connection that is served by the event loop of the server's async engine.
+    It exposes the same interface as RCEServerThread, so the server can address a client regardless of the engine that
+    accepted it.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, addr: Any,
+                 server_instance: "RCEServer"):
+        self.__reader = reader
+        self.__writer = writer
+        self.__address = addr
+        self.__loop = asyncio.get_running_loop()
+        self.__connected = True
+        self.__send_lock = threading.RLock()
+        self.__outbound = OutboundQueue()
+        self.__exclusive_depth = 0
+        self.__draining = False  # Only accessed on the event loop
+        self.max_message_size = config.MAX_MESSAGE_SIZE
+        self.file_transfer_mode = config.FILE_TRANSFER_MODE
+        self.compression = Compression()
+        self.protocol_version = PROTOCOL_V1
+        self.striping = False  # Whether the client accepts striped transfers, negotiated in the HELLO messages
+        self.file_stream = False  # Whether the client accepts FILE_STREAM bodies, announced in its HELLO message
+        self.request_ids = False  # Whether the client accepts request IDs in v1 frames, announced in its HELLO message
+        self.pending_replies = PendingReplies()
+        self.payload_cache = False  # Whether the client caches payloads by hash, announced in its HELLO message
+        self.tags: frozenset[str] = frozenset()  # Reported by the client in its HELLO message
+        self.hostname = ""
+        self.heartbeat = False  # Whether the client answers PING messages, announced in its HELLO message
+        self.batch = False  # Whether the client runs BATCH messages, announced in its HELLO message
+        self.rtt: Optional[float] = None  # Smoothed round trip time of the heartbeats in seconds
+        self.connected_at = time.monotonic()
+        self.last_received = self.connected_at  # When the last data was received from the client
+        self.__incoming_files: dict[int, Incoming] = {}
+        host, port = addr
+        self.server = server_instance
+        self.client_address_str = f"{host}:{port}"
+        self.traffic = TrafficCounters()
+        self.__registered = False  # Whether the connection is known to be a client rather than a data connection
+        self.__log_prefix = f"CLIENT {self.client_address_str} "
+        self.__command_output = CommandOutput(self.server, self.client_address_str)
+
+    async def run(self):
+        received = asyncio.ensure_future(self.receive_message())
+        await asyncio.wait((received,), timeout=config.HELLO_TIMEOUT)
+        if not received.done():  # No HELLO message, e.g. a client that predates it
+            self.__register()
+        while self.__connected:
+            try:
+                receive, received = received or self.receive_message(), None
+                message = await receive
+                if not self.__registered and not message.is_type(MessageType.HELLO):
+                    self.__register()
+                if message.is_type(MessageType.DISCONNECT):
+                    raise OSError("RECEIVED DISCONNECT")
+
+                if message.is_type(MessageType.ECHO):
+                    self.__command_output.on_echo(message)
+                elif message.is_type(MessageType.FILE_UPLOAD):
+                    self.server.on_debug("Receiving file...")
+                    filename = message.decode()
+                    if await self.receive_file(filename, message.request_id):
+                        self.server.on_info(f"Received file '{filename}'", prefix=self.__log_prefix)
+                elif message.is_type(MessageType.DIRECTORY_UPLOAD):
+                    dirname = message.decode()
+                    if await self.receive_directory(dirname, message.request_id):
+                        self.server.on_info(f"Received directory '{dirname}'", prefix=self.__log_prefix)
+                elif message.get_type() in FILE_BODY_TYPES:
+                    if file_path := await self.receive_file_message(message):
+                        kind = "directory" if file_path.is_dir() else "file"
+                        self.server.on_info(f"Received {kind} '{file_path.name}'", prefix=self.__log_prefix)
+                elif message.is_type(MessageType.FILE_SYNC):
+                    self.server.on_debug("Receiving file delta...")
+                    await self.receive_file_sync(message)
+                elif message.is_type(MessageType.FILE_SIGNATURE):
+                    if not self.pending_replies.resolve(message):
+                        self.server.on_debug(f"Unexpected signature for request #{message.request_id}",
+                                             prefix=self.__log_prefix)
+                elif message.is_type(MessageType.PAYLOAD_STATUS):
+                    if not self.pending_replies.resolve(message):
+                        self.server.on_debug(f"Unexpected payload status for request #{message.request_id}",
+                                             prefix=self.__log_prefix)
+                elif message.is_type(MessageType.ERROR):
+                    if not self.pending_replies.resolve(message):  # Errors answering a request fail the request
+                        self.__command_output.on_error(message)
+                elif message.is_type(MessageType.PONG):
+                    self.server.heartbeats.on_pong(self, message)
+                elif message.is_type(MessageType.HELLO):
+                    await self.__handshake(message)
+                elif message.is_type(MessageType.OUTPUT):
+                    self.__command_output.on_output(message)
+                elif message.is_type(MessageType.EXIT):
+                    self.__command_output.on_exit(message)
+                elif message.is_type(MessageType.BATCH_RESULT):
+                    self.__command_output.on_batch_result(message)
+                else:
+                    self.server.on_debug(f"Unknown message {message.get_type()}", prefix=self.__log_prefix)
+            except (MessageTypeError, FileWriteError) as e:
+                self.server.on_error(e, prefix=self.__log_prefix)
+            except OSError as e:
+                self.server.on_debug(f"DISCONNECTED => {e}", prefix=self.__log_prefix)
+                self.__close_and_remove_client()
+                if self.__registered:
+                    self.server.on_disconnect(self.client_address_str)
+        if received:  # Closed before the first message arrived
+            received.cancel()
+
+    def close(self):
+        """
+        Closes the connection. Safe to call from any thread, the transport is closed on the event loop.
+        If the connection is already closed, the method returns immediately.
+        """
+        if not self.__connected:
+            return
+
+        self.__connected = False
+        self.__outbound.close()
+        try:
+            self.__loop.call_soon_threadsafe(self.__writer.close)
+        except RuntimeError:  # The event loop has already been closed
+            pass
+
+    def abort(self):
+        """
+        Closes the connection and discards the unsent data instead of waiting for the client to read it, e.g. a
+        stalled or unresponsive client.
+        """
+        self.close()
+        with contextlib.suppress(RuntimeError):
+            self.__loop.call_soon_threadsafe(self.__writer.transport.abort)
+
+    def is_connected(self):
+        return self.__connected
+
+    @property
+    def transferring(self) -> bool:
+        """
+        :return: Whether a transfer holds the connection (see exclusive), messages posted meanwhile stay queued.
+        """
+        return self.__exclusive_depth > 0
+
+    def get_address(self):
+        return self.__address
+
+    def send_message(self, message: Message, timeout: Optional[float] = None):
+        """
+        Sends a message to the client from any thread other than the event loop's.
+        The call blocks until the message has been flushed to the transport, which gives callers the same
+        backpressure and error semantics as BaseClientThread.send_message. Messages posted before (see post_message)
+        are written first, unless the connection is held for a transfer.
+
+        :param message: The message object to be sent.
+        :param timeout: Optional number of seconds after which the send is aborted, including the wait for other
+            senders, e.g. a transfer holding the connection. The connection is closed when the timeout expires during
+            the send.
+        :raises:
+            TimeoutError: If the message could not be flushed within the timeout.
+            OSError: If an error occurs while sending data over the connection.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self.__send_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"Sending message timed out after {timeout}s, the connection is busy")
+
+        try:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:  # Nothing was sent, the connection is still usable
+                raise TimeoutError(f"Sending message timed out after {timeout}s, the connection is busy")
+
+            try:
+                future = asyncio.run_coroutine_threadsafe(self.__send_message(message), self.__loop)
+            except RuntimeError:
+                raise OSError("Event loop is not running")
+
+            try:
+                future.result(remaining)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                self.abort()
+                raise TimeoutError(f"Sending message timed out after {timeout}s")
+        finally:
+            self.__send_lock.release()
+
+    async def __send_message(self, message: Message):
+        message = self.compression.encode(message)
+        header, payload = message.to_buffers(self.protocol_version, self.request_ids)
+        flushed = 0
+        while not self.__exclusive_depth and (frame := self.__outbound.pop()):  # Posted messages are written first
+            self.__writer.writelines(frame[:2])
+            flushed += len(frame[0]) + len(frame[1])
+            self.traffic.sent(frame[2], len(frame[0]) + len(frame[1]))
+        self.__writer.writelines((header, payload))
+        self.traffic.sent(message, len(header) + len(payload))
+        try:
+            await self.__writer.drain()
+        finally:
+            self.__outbound.written(flushed)
+
+    def post_message(self, message: Message) -> bool:
+        """
+        Queues a message on the outbound queue of the connection without blocking, it is written by the event loop
+        in the order it was posted (see BaseClientThread.post_message).
+        :param message: The message object to be sent.
+        :return: False if the message was not queued because the connection is congested.
+        :raises OSError: If the connection is closed, or if it has been congested for longer than
+            config.OUTBOUND_STALL_TIMEOUT, in which case it is closed.
+        """
+        if not self.__connected:
+            raise OSError("Connection closed")
+        if self.__outbound.stalled_for() > config.OUTBOUND_STALL_TIMEOUT:
+            self.abort()
+            raise OSError(f"Dropped after being congested for more than {config.OUTBOUND_STALL_TIMEOUT}s")
+        if self.__outbound.congested:
+            return False
+
+        message = self.compression.encode(message)
+        header, payload = message.to_buffers(self.protocol_version, self.request_ids)
+        if not self.__outbound.put((header, payload, message)):
+            return False
+        try:
+            self.__loop.call_soon_threadsafe(self.__drain_outbound)
+        except RuntimeError:
+            raise OSError("Event loop is not running")
+        return True
+
+    @property
+    def outbound_bytes(self) -> int:
+        """
+        :return: The number of bytes posted to the connection that have not been written yet.
+        """
+        return self.__outbound.size
+
+    def __drain_outbound(self):
+        """
+        Starts writing the outbound queue on the event loop, unless it is already being written or the connection is
+        held for a transfer.
+        """
+        if self.__draining or self.__exclusive_depth or not self.__connected:
+            return
+
+        self.__draining = True
+        self.__loop.create_task(self.__write_outbound())
+
+    async def __write_outbound(self):
+        """
+        Writes the queued frames. While the connection is congested, every write has to drain within what is left of
+        config.OUTBOUND_STALL_TIMEOUT, otherwise the connection is dropped.
+        """
+        try:
+            while not self.__exclusive_depth and (frame := self.__outbound.pop()):
+                self.__writer.writelines(frame[:2])
+                self.traffic.sent(frame[2], len(frame[0]) + len(frame[1]))
+                if stalled_for := self.__outbound.stalled_for():
+                    await asyncio.wait_for(self.__writer.drain(), config.OUTBOUND_STALL_TIMEOUT - stalled_for)
+                else:
+                    await self.__writer.drain()
+                self.__outbound.written(len(frame[0]) + len(frame[1]))
+        except (OSError, asyncio.TimeoutError) as e:
+            self.server.on_debug(f"Dropping congested connection: {e!r}", prefix=self.__log_prefix)
+            self.abort()
+        finally:
+            self.__draining = False
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Holds the connection for a transfer whose messages must not be interleaved with other messages, e.g. a file
+        transfer to a protocol v1 peer. Messages posted meanwhile stay queued until the transfer is complete, other
+        threads sending messages wait for it. The connection can be held again by the holding thread.
+        """
+        with self.__send_lock:
+            self.__exclusive_depth += 1
+            try:
+                yield
+            finally:
+                self.__exclusive_depth -= 1
+        if self.__connected:
+            with contextlib.suppress(RuntimeError):
+                self.__loop.call_soon_threadsafe(self.__drain_outbound)
+
+    async def receive_message(self):
+        """
+        Receives a message from the connection using the same framing as BaseClientThread.receive_message.
+        :returns: A Message object containing the data received from the connection.
+        :raises: OSError: If the connection is closed or if the received frame is invalid.
+        """
+        try:
+            data_size = await self.__reader.readexactly(4)
+            if not (data_size_as_int := int.from_bytes(data_size, byteorder='little')):
+                raise OSError("Received null bytes for message size")
+
+            if data_size_as_int > self.max_message_size:
+                raise OSError(f"Message size {data_size_as_int} exceeds the maximum of {self.max_message_size} bytes")
+
+            data = await self.__reader.readexactly(data_size_as_int)
+            message = Message.from_bytes(data)
+            self.traffic.received(message, data_size_as_int + 4)
+            self.last_received = time.monotonic()
+            if message.compressed and not message.is_type(MessageType.FILE):
+                message = message.with_data(self.compression.decompress(message.data, self.max_message_size))
+            return message
+        except asyncio.IncompleteReadError:
+            raise OSError("Connection closed by peer")
+        except ValueError as error:  # The stream can not be resynchronized after a frame that can not be decoded
+            raise OSError(f"Received malformed frame: {error}")
+
+    def send_file(self, source_path: str, destination_path: str = "", request_id: Optional[int] = None,
+                  stripes: Optional[int] = None) -> Optional[float]:
+        """
+        Sends a file to the client, in the transfer mode given by `file_transfer_mode` (see BaseClientThread.send_file).
+        :param source_path: The path to the file to be sent.
+        :param destination_path: The path where the file should be saved on the client.
+        :param request_id: Optional ID of the request the file is sent for, the stream it is sent on with protocol v2.
+        :param stripes: Optional number of stripes the file is sent in, regardless of the transfer mode and file size.
+        :return: The aggregate throughput of a striped transfer in bytes per second, None for the other modes.
+        :raises:
+            FileNotFoundError: When a file with the given path does not exist.
+            FileReadError: When an error occurs while reading the file.
+            TimeoutError: When the receiver of a delta transfer does not answer within FILE_SYNC_TIMEOUT.
+            OSError: When the data connections of a striped transfer fail.
+        """
+        filepath = Path(source_path)
+        if not filepath.exists():
+            raise FileNotFoundError(f"{filepath} does not exist")
+
+        if not filepath.is_file():
+            raise FileNotFoundError(f"{filepath} is not a file")
+
+        filename_with_destination = os.path.join(destination_path, filepath.name).encode()
+        if request_id is not None and self.protocol_version >= PROTOCOL_V2:
+            if self.striping and (count := stripe_count(filepath.stat().st_size, stripes, self.file_transfer_mode)):
+                return send_file_striped(self.send_message, self.open_stripes, filepath, filename_with_destination,
+                                         request_id, count)
+            if self.file_transfer_mode == "delta":
+                send_file_delta(self.send_message, self.pending_replies, filepath, filename_with_destination,
+                                request_id)
+            else:
+                self.__send_file(filepath, filename_with_destination, request_id)
+            return None
+
+        with self.exclusive():  # Other messages must not be interleaved with the file transfer
+            self.__send_file(filepath, filename_with_destination, request_id)
+        return None
+
+    def open_stripes(self, transfer: StripeTransfer):
+        """
+        Expects the data connections of a striped transfer, which the client opens (see BaseClientThread.open_stripes).
+        """
+        self.server.stripes.open(transfer)
+
+    def __send_file(self, filepath: Path, filename_with_destination: bytes, request_id: Optional[int]):
+        self.send_message(Message(MessageType.FILE_UPLOAD, filename_with_destination, request_id=request_id))
+        try:
+            with open(filepath, 'rb') as file:
+                compress = self.compression.enabled and Compression.is_compressible(
+                    file.read(config.COMPRESSION_SAMPLE_SIZE))
+                if self.file_transfer_mode != "chunked" and self.file_stream and not compress:
+                    file_size = os.fstat(file.fileno()).st_size
+                    with self.exclusive():  # The raw body is not framed, nothing may be sent until it is complete
+                        self.send_message(Message(MessageType.FILE_STREAM, FILE_SIZE.pack(file_size),
+                                                  request_id=request_id))
+                        asyncio.run_coroutine_threadsafe(self.__send_file_body(file, file_size), self.__loop).result()
+                    return
+
+                file.seek(0)
+                compressor = self.compression.compressor() if compress else None
+                while chunk := file.read(config.FILE_CHUNK_SIZE):
+                    if compressor and (compressed_chunk := compressor.compress(chunk)) is not None:
+                        self.send_message(Message(MessageType.FILE, compressed_chunk, compressed=True,
+                                                  request_id=request_id))
+                    else:
+                        self.send_message(Message(MessageType.FILE, chunk, request_id=request_id))
+                self.send_message(Message(MessageType.END_OF_FILE, request_id=request_id))
+        except OSError:
+            raise FileReadError(f"Failed to read file {filepath}")
+
+    def send_directory(self, source_path: str, destination_path: str = "", request_id: Optional[int] = None):
+        """
+        Sends a directory tree to the client as a streamed tar archive (see BaseClientThread.send_directory).
+        :param source_path: The path to the directory to be sent.
+        :param destination_path: The path where the directory should be saved on the client.
+        :param request_id: Optional ID of the request the directory is sent for, the stream it is sent on with v2.
+        :raises:
+            FileNotFoundError: When a directory with the given path does not exist.
+            FileReadError: When an error occurs while reading the directory.
+        """
+        dirpath = Path(source_path)
+        if not dirpath.is_dir():
+            raise FileNotFoundError(f"{dirpath} is not a directory")
+
+        dirname_with_destination = os.path.join(destination_path, dirpath.name).encode()
+        if request_id is not None and self.protocol_version >= PROTOCOL_V2:
+            self.__send_directory(dirpath, dirname_with_destination, request_id)
+            return
+
+        with self.exclusive():  # Other messages must not be interleaved with the transfer
+            self.__send_directory(dirpath, dirname_with_destination, request_id)
+
+    def __send_directory(self, dirpath: Path, dirname_with_destination: bytes, request_id: Optional[int]):
+        self.send_message(Message(MessageType.DIRECTORY_UPLOAD, dirname_with_destination, request_id=request_id))
+        compressor = self.compression.compressor() if self.compression.enabled else None
+
+        def send_chunk(chunk: bytes):
+            if compressor and (compressed_chunk := compressor.compress(chunk)) is not None:
+                self.send_message(Message(MessageType.FILE, compressed_chunk, compressed=True, request_id=request_id))
+            else:
+                self.send_message(Message(MessageType.FILE, chunk, request_id=request_id))
+
+        try:
+            with ChunkWriter(send_chunk) as writer:
+                write_directory_archive(dirpath, writer)
+        except (OSError, tarfile.TarError):
+            raise FileReadError(f"Failed to read directory {dirpath}")
+        self.send_message(Message(MessageType.END_OF_FILE, request_id=request_id))
+
+    async def __send_file_body(self, file, file_size: int):
+        """
+        Sends the raw file body using the event loop's sendfile support.
+        :raises OSError: If the file could not be sent completely.
+        """
+        if file_size and await self.__loop.sendfile(self.__writer.transport, file, 0, file_size) != file_size:
+            self.__writer.close()
+            raise OSError("File was truncated while being sent")
+        self.traffic.body_sent(file_size)
+
+    async def receive_file(self, filename: str, request_id: Optional[int] = None) -> bool:
+        """
+        Receives a file from the client and saves it in the client's download directory.
+        Files sent on a stream of a protocol v2 connection are received by receive_file_message instead, while other
+        messages are processed (see BaseClientThread.receive_file).
+        :param filename: The name of the file to be saved.
+        :param request_id: The request ID of the FILE_UPLOAD message.
+        :return: Whether the file has been received completely.
+        :raises:
+            MessageTypeError: When the next message is not of type MessageType.FILE.
+            FileWriteError: When an error occurs while writing the file.
+            OSError: If an error occurs while receiving data.
+        """
+        incoming = IncomingFile(self.__save_path() / filename, self.compression.decompressor(), self.max_message_size,
+                                batched=False)  # Its writes run on the shared worker threads
+        return await self.__receive(incoming, request_id)
+
+    async def receive_directory(self, dirname: str, request_id: Optional[int] = None) -> bool:
+        """
+        Receives a directory sent as a streamed tar archive and extracts it in the client's download directory.
+        Streams are used as for receive_file.
+        :param dirname: The name of the directory to be saved.
+        :param request_id: The request ID of the DIRECTORY_UPLOAD message.
+        :return: Whether the directory has been received completely.
+        :raises:
+            MessageTypeError: When the next message is not of type MessageType.FILE.
+            FileWriteError: When an error occurs while extracting the directory.
+            OSError: If an error occurs while receiving data.
+        """
+        incoming = IncomingDirectory(self.__save_path() / dirname, self.compression.decompressor(),
+                                     self.max_message_size)
+        return await self.__receive(incoming, request_id)
+
+    async def receive_file_sync(self, message: Message):
+        """
+        Starts receiving a delta transfer (see BaseClientThread.receive_file_sync). The temporary file is opened and
+        the receiver's version of the file is hashed by a worker thread, so the event loop keeps serving other
+        connections. The blocks and the unchanged data copied from the receiver's version are written by worker
+        threads as well (see __receive_file_body).
+        :param message: The FILE_SYNC message.
+        :raises:
+            MessageTypeError: When the FILE_SYNC message is malformed.
+            FileWriteError: When the file can not be written.
+            OSError: If an error occurs while sending the answer.
+        """
+        try:
+            request = json.loads(message.decode())
+            file_path = self.__save_path() / request["path"]
+            file_size, block_size = int(request["size"]), int(request["block_size"])
+        except (ValueError, KeyError, TypeError) as error:
+            await self.__reply(Message(MessageType.ERROR, b"Malformed FILE_SYNC message",
+                                       request_id=message.request_id))
+            raise MessageTypeError(f"Received malformed FILE_SYNC message: {error}")
+
+        def open_delta_file() -> DeltaFile:
+            os.makedirs(file_path.parent, exist_ok=True)
+            return DeltaFile(file_path, file_size, block_size)
+
+        try:
+            incoming = await self.__loop.run_in_executor(None, open_delta_file)
+        except (OSError, FileWriteError) as error:
+            await self.__reply(Message(MessageType.ERROR, str(error).encode(), request_id=message.request_id))
+            raise FileWriteError(f"Failed to start delta transfer of {file_path}: {error}")
+
+        try:
+            signature = await self.__loop.run_in_executor(None, incoming.signature)
+        except OSError as error:
+            self.__abort(incoming)
+            await self.__reply(Message(MessageType.ERROR, str(error).encode(), request_id=message.request_id))
+            raise FileWriteError(f"Failed to start delta transfer of {file_path}: {error}")
+
+        self.__incoming_files[message.request_id] = incoming
+        await self.__reply(Message(MessageType.FILE_SIGNATURE, signature, request_id=message.request_id))
+
+    async def __reply(self, message: Message):
+        """
+        Sends a message from the event loop through send_message, on a worker thread, so that it waits for sends of
+        other threads that hold the connection, e.g. a sendfile body.
+        """
+        await self.__loop.run_in_executor(None, self.send_message, message)
+
+    def __save_path(self) -> Path:
+        save_path = config.DOWNLOAD_DIR / f"{self.__address[0]}:{self.__address[1]}"
+        if not save_path.exists():
+            os.makedirs(save_path, exist_ok=True)
+        return save_path
+
+    async def __receive(self, incoming: Incoming, request_id: Optional[int]) -> bool:
+        """
+        Receives the body of a file transfer, right away or on its stream.
+        :return: Whether the transfer is complete.
+        """
+        if request_id is not None and self.protocol_version >= PROTOCOL_V2:
+            self.__incoming_files[request_id] = incoming
+            return False
+
+        try:
+            while not await self.__receive_file_body(incoming, await self.receive_message()):
+                pass
+        except BaseException:
+            self.__abort(incoming)
+            raise
+        await self.__loop.run_in_executor(None, incoming.finish)  # Waits for the disk writes, and syncs
+        return True
+
+    async def receive_file_message(self, message: Message) -> Optional[Path]:
+        """
+        Passes a FILE, FILE_STREAM or END_OF_FILE message to the file that is being received on its stream.
+        :return: The path of the file if the message completed it, otherwise None.
+        :raises:
+            MessageTypeError: When no file is being received on the stream of the message, or the message is
+                malformed, which aborts the transfer.
+            FileWriteError: When the message completed a file that could not be written.
+            OSError: If an error occurs while receiving data.
+        """
+        if not (incoming := self.__incoming_files.get(message.request_id)):
+            raise MessageTypeError(f"Received {message.get_type()} for unknown stream {message.request_id}")
+
+        try:
+            if not await self.__receive_file_body(incoming, message):
+                return None
+        except MessageTypeError:
+            del self.__incoming_files[message.request_id]  # The rest of the transfer is refused as an unknown stream
+            self.__abort(incoming)
+            raise
+
+        del self.__incoming_files[message.request_id]
+        await self.__loop.run_in_executor(None, incoming.finish)
+        return incoming.file_path
+
+    async def __receive_file_body(self, incoming: Incoming, message: Message) -> bool:
+        """
+        Writes a message of a file transfer to the incoming file. The writes run on a worker thread, as they wait for
+        the disks, e.g. for a free buffer of the pool of the disk writers, or for the extraction of a directory.
+        :return: Whether the message completed the transfer.
+        """
+        if message.is_type(MessageType.END_OF_FILE):
+            if message.data:  # The digests of the stripes of a striped transfer
+                await self.__loop.run_in_executor(None, incoming.write_chunk, message)
+            return True
+
+        if message.is_type(MessageType.FILE_STRIPES):
+            self.__receive_stripes(incoming, message)
+            return False
+
+        if message.is_type(MessageType.FILE_STREAM):
+            remaining = stream_size(message)
+            incoming.preallocate(remaining)
+            try:
+                while remaining:
+                    chunk = await self.__reader.readexactly(min(remaining, config.FILE_CHUNK_SIZE))
+                    self.traffic.body_received(len(chunk))
+                    self.last_received = time.monotonic()
+                    await self.__loop.run_in_executor(None, incoming.write, chunk)
+                    remaining -= len(chunk)
+            except asyncio.IncompleteReadError:
+                raise OSError("Connection closed while receiving data")
+            return True
+
+        await self.__loop.run_in_executor(None, incoming.write_chunk, message)
+        return False
+
+    def __abort(self, incoming: Incoming):
+        """
+        Aborts an incoming transfer on a worker thread, as it waits for the data received so far to be written or
+        extracted.
+        """
+        self.__loop.run_in_executor(None, incoming.abort)
+
+    def __receive_stripes(self, incoming: Incoming, message: Message):
+        """
+        Starts receiving the stripes of a striped transfer (see BaseClientThread).
+        :raises MessageTypeError: If the transfer is not striped on a stream, or the announcement is malformed.
+        """
+        if not isinstance(incoming, IncomingFile) or self.__incoming_files.get(message.request_id) is not incoming:
+            raise MessageTypeError("Received FILE_STRIPES outside of a file transfer on a stream")
+
+        striped = StripedFile(incoming, message)
+        self.__incoming_files[message.request_id] = striped
+        self.open_stripes(striped)
+
+    async def __serve_stripe(self, token: Any, index: Any):
+        """
+        Hands the connection over to the striped transfer it is a data connection of. The stripe is transferred with
+        blocking I/O on a thread of its own, over a duplicate of the socket that outlives the transport.
+        :raises OSError: Once the stripe has been transferred, which ends the connection.
+        """
+        transport_socket = self.__writer.get_extra_info("socket")
+        sock = socket.socket(transport_socket.family, transport_socket.type, transport_socket.proto,
+                             os.dup(transport_socket.fileno()))
+        self.__writer.transport.pause_reading()  # The client sends nothing before the answer to its HELLO message
+        sock.setblocking(True)
+        done = self.__loop.create_future()
+
+        def serve():
+            try:
+                self.server.stripes.attach(token, index, sock)
+            except OSError as error:
+                self.server.on_debug(f"Data connection refused: {error}", prefix=self.__log_prefix)
+            finally:
+                sock.close()
+                with contextlib.suppress(RuntimeError):
+                    self.__loop.call_soon_threadsafe(done.set_result, None)
+
+        threading.Thread(target=serve, name="stripe", daemon=True).start()
+        await done
+        raise OSError("Data connection closed")
+
+    async def __handshake(self, message: Message):
+        """
+        Answers the HELLO message of the client with the capabilities chosen for this connection
+        (see RCEServerThread).
+        :param message: The HELLO message carrying the client's capabilities as JSON.
+        """
+        try:
+            capabilities = hello_capabilities(message)
+        except ValueError:
+            self.server.on_error("Received malformed HELLO message", prefix=self.__log_prefix)
+            return
+
+        if "stripe" in capabilities:  # A data connection of a striped transfer rather than a client
+            await self.__serve_stripe(capabilities["stripe"], capabilities.get("index"))
+
+        algorithm = Compression.negotiate(capabilities.get("compression", []))
+        version = negotiate_protocol(capabilities.get("protocol", []))
+        heartbeats = self.server.heartbeats
+        heartbeat = bool(capabilities.get("heartbeat")) and heartbeats.enabled
+        await self.__send_message(Message(MessageType.HELLO, json.dumps({
+            "compression": algorithm,
+            "protocol": version,
+            "heartbeat": {"interval": heartbeats.interval, "timeout": heartbeats.timeout} if heartbeat else None,
+            "stripes": self.server.striping,
+            "file_stream": True,
+            "request_ids": True,
+        }).encode()))
+        self.compression = Compression(algorithm)
+        self.protocol_version = version
+        self.payload_cache = bool(capabilities.get("payload_cache"))
+        self.tags = frozenset(str(tag) for tag in capabilities.get("tags", []))
+        self.hostname = str(capabilities.get("hostname", ""))
+        self.heartbeat = heartbeat
+        self.batch = bool(capabilities.get("batch"))
+        self.striping = bool(capabilities.get("stripes")) and self.server.striping
+        self.file_stream = bool(capabilities.get("file_stream"))
+        self.request_ids = bool(capabilities.get("request_ids"))
+        if self.__registered:
+            self.server.clients.update(self)
+        else:
+            self.__register()
+        self.server.on_debug(f"Negotiated compression: {algorithm}, protocol: v{version}", prefix=self.__log_prefix)
+
+    def __register(self):
+        """
+        Registers the connection as a client once it is known not to be a data connection of a striped transfer
+        (see RCEServerThread).
+        """
+        if not self.server.is_running():  # The registry has been cleared already
+            self.close()
+            return
+
+        self.__registered = True
+        traffic = self.server.metrics.track(self.client_address_str)
+        traffic.add(self.traffic)  # The messages exchanged before
+        self.traffic = traffic
+        self.server.clients.add(self)
+        self.server.on_connect(self.client_address_str)
+
+    def __close_and_remove_client(self):
+        """
+        Closes the connection and removes it from the client registry.
+        """
+        self.close()
+        for incoming in self.__incoming_files.values():
+            self.__abort(incoming)
+        self.__incoming_files.clear()
+        self.pending_replies.fail_all(OSError("Connection closed"))
+        self.server.clients.remove(self)
+        self.server.on_debug("Client connection closed and removed from registry", prefix=self.__log_prefix)
@@ -1,14 +1,32 @@
-import re
+import asyncio
+import itertools
+import json
+import os
+import selectors
 import socket
+import tarfile
 import threading
-from typing import Optional
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
 
 import config
+from src.core.compression import Compression, StreamCompressor
+from src.core.event_bus import EventBus
 from src.core.exception import FileReadError
+from src.core.file_transfer import ChunkWriter, write_directory_archive
 from src.core.logger import Logger
-from src.core.message import Message
+from src.core.message import PROTOCOL_V2, Message, MessageType, PreparedMessage
+from src.core.metrics import MetricsExporter, MetricsObserver, MetricsSnapshot
 from src.core.observer import RCEEventObserver
+from src.core.payload_cache import payload_digest
+from src.core.striped_transfer import HAS_PWRITE, StripeRegistry
+from src.server.client_registry import ClientInfo, ClientRegistry
+from src.server.heartbeat_monitor import HeartbeatMonitor
+from src.server.rce_async_connection import RCEAsyncConnection
 from src.server.rce_server_thread import RCEServerThread
+from src.server.result_set import ResultSet
 
 
 class RCEServer:
@@ -16,16 +34,60 @@ class RCEServer:
     Represents a remote code execution (RCE) server that listens for and handles client connections and messages.
     """
     __socket: socket.socket
+    __waker: tuple[socket.socket, socket.socket]
     __running = False
-    client_synchronize_mutex = threading.Lock()
-    connected_clients = dict[tuple[str, int], RCEServerThread]()
+    Client = Union[RCEServerThread, RCEAsyncConnection]
+
+    def __init__(self, host: str, port: int, debug=False, engine: str = config.SERVER_ENGINE,
+                 metrics_file: Optional[str] = config.METRICS_FILE,
+                 heartbeat_interval: Optional[float] = config.HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = config.HEARTBEAT_TIMEOUT, backlog: int = config.LISTEN_BACKLOG,
+                 reuse_port=False):
+        """
+        :param host: The hostname or IP the server binds to.
+        :param port: The port number the server listens on.
+        :param debug: Whether debug messages are emitted to the observers.
+        :param engine: The connection engine, either "thread" (one thread per client) or "async" (all clients are
+            served by a single asyncio event loop).
+        :param metrics_file: Optional file the metrics are written to in the Prometheus text format while the server
+            is running.
+        :param heartbeat_interval: The number of seconds between two heartbeats of a client, None disables them (see
+            HeartbeatMonitor).
+        :param heartbeat_timeout: The number of seconds after which an unresponsive client is reaped.
+        :param backlog: The length of the queue of connections waiting to be accepted.
+        :param reuse_port: Whether the port is bound with SO_REUSEPORT, so that several servers share it (see
+            ShardedServer).
+        :raises ValueError: If the engine is unknown or the heartbeat timeout is not longer than the interval.
+        """
+        if engine not in config.SERVER_ENGINES:
+            raise ValueError(f"Unknown server engine: {engine}")
 
-    def __init__(self, host: str, port: int, debug=False):
         self.__host = host
         self.__port = port
+        self.__backlog = backlog
+        self.__reuse_port = reuse_port
+        self.engine = engine
         self.connection_thread: Optional[threading.Thread] = None
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__shutdown_event: Optional[asyncio.Event] = None
+        self.__broadcast_executor: Optional[ThreadPoolExecutor] = None
+        self.__transfer_executor: Optional[ThreadPoolExecutor] = None
+        self.__connection_tasks: set[asyncio.Task] = set()
+        self.__request_ids = itertools.count(1)
+        self.__result_sets: dict[int, ResultSet] = {}
+        self.clients = ClientRegistry()
         self.observers: list[RCEEventObserver] = []
+        self.events = EventBus()
         self.observers.append(Logger(self.__class__.__name__, debug))
+        self.metrics = MetricsObserver()
+        self.observers.append(self.metrics)
+        self.__metrics_file = metrics_file
+        self.__metrics_exporter: Optional[MetricsExporter] = None
+        self.heartbeats = HeartbeatMonitor(self, heartbeat_interval, heartbeat_timeout)
+        self.stripes = StripeRegistry()
+        # The data connections of a striped transfer have to reach the process of the transfer, which the kernel does
+        # not guarantee for servers sharing the port
+        self.striping = HAS_PWRITE and not reuse_port
         self.debug = debug
 
     def __init_socket(self):
@@ -34,24 +96,84 @@ class RCEServer:
         """
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.__reuse_port:
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.__socket.bind((self.__host, self.__port))
-        self.__socket.listen(5)
-        self.__socket.settimeout(1)
+        self.__socket.listen(self.__backlog)
+        self.__socket.setblocking(False)
+        self.__waker = socket.socketpair()  # Wakes the connection thread up when the server stops
         self.__running = True
 
     def __connection_thread(self):
         """
         Handles incoming client connections and creates a new RCEServerThread for handling each client connection.
-        New clients are synchronously added to the dictionary of connected clients.
+        The thread sleeps until connections are pending or the server stops, then accepts every pending connection.
+        New clients are added to the client registry before they start.
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.__socket, selectors.EVENT_READ)
+            selector.register(self.__waker[0], selectors.EVENT_READ)
+            while self.__running:
+                for key, _ in selector.select():
+                    if key.fileobj is self.__socket:
+                        self.__accept_pending()
+
+    def __accept_pending(self):
+        """
+        Accepts the connections waiting in the backlog, until it is empty.
         """
         while self.__running:
             try:
                 conn, addr = self.__socket.accept()
-                with self.client_synchronize_mutex:
-                    self.connected_clients[addr] = RCEServerThread(conn, addr, self)
-                    self.connected_clients[addr].start()
-            except socket.timeout:
-                pass
+            except BlockingIOError:
+                return
+            except OSError as e:  # E.g. out of file descriptors, the connections stay in the backlog meanwhile
+                self.on_error(f"Failed to accept a connection: {e}")
+                time.sleep(0.1)
+                return
+
+            conn.setblocking(True)
+            self.heartbeats.enable_keepalive(conn)
+            RCEServerThread(conn, addr, self).start()  # Registers itself once it knows it serves a client
+
+    def __event_loop_thread(self):
+        """
+        Runs the event loop of the async engine, which serves the listening socket and every client connection.
+        """
+        asyncio.run(self.__serve())
+
+    async def __serve(self):
+        """
+        Accepts client connections on the event loop until the server is stopped.
+        """
+        self.__loop = asyncio.get_running_loop()
+        self.__shutdown_event = asyncio.Event()
+        if not self.__running:  # The server was stopped before the event loop came up
+            self.__shutdown_event.set()
+
+        server = await asyncio.start_server(self.__handle_async_connection, sock=self.__socket, backlog=self.__backlog)
+        async with server:
+            await self.__shutdown_event.wait()
+
+        if self.__connection_tasks:  # Let the closed connections run their disconnect handling
+            await asyncio.wait(self.__connection_tasks, timeout=1)
+        self.__loop = None
+
+    async def __handle_async_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Creates a RCEAsyncConnection for a new connection and serves it until it disconnects. The connection adds
+        itself to the client registry once it knows it serves a client.
+        """
+        addr = writer.get_extra_info("peername")[:2]
+        self.heartbeats.enable_keepalive(writer.get_extra_info("socket"))
+        connection = RCEAsyncConnection(reader, writer, addr, self)
+
+        task = asyncio.current_task()
+        self.__connection_tasks.add(task)
+        try:
+            await connection.run()
+        finally:
+            self.__connection_tasks.discard(task)
 
     def start(self):
         """
@@ -63,10 +185,15 @@ class RCEServer:
 
         try:
             self.__init_socket()
-            self.on_info(f"Server started at {self.__host}:{self.__port}")
+            self.on_info(f"Server started at {self.__host}:{self.__port} ({self.engine} engine)")
             self.on_info("Listening for connections...")
-            self.connection_thread = threading.Thread(target=self.__connection_thread)
+            target = self.__event_loop_thread if self.engine == "async" else self.__connection_thread
+            self.connection_thread = threading.Thread(target=target)
             self.connection_thread.start()
+            self.heartbeats.start()
+            if self.__metrics_file:
+                self.__metrics_exporter = MetricsExporter(self.metrics_snapshot, self.__metrics_file)
+                self.__metrics_exporter.start()
             return True
         except ConnectionRefusedError:
             self.on_error(f"Connection to {self.__host}:{self.__port} refused")
@@ -80,36 +207,392 @@ class RCEServer:
             return False
 
         self.__running = False
+        self.heartbeats.stop()
         self.__close_all_clients()
+        if self.__loop and self.__shutdown_event:
+            self.__loop.call_soon_threadsafe(self.__shutdown_event.set)
+        self.__waker[1].send(b"\0")
         if self.connection_thread:
             self.connection_thread.join()
+        if self.__broadcast_executor:
+            self.__broadcast_executor.shutdown()
+            self.__broadcast_executor = None
+        if self.__transfer_executor:
+            self.__transfer_executor.shutdown()
+            self.__transfer_executor = None
         self.__socket.close()
+        for sock in self.__waker:
+            sock.close()
+        self.events.flush(config.OBSERVER_FLUSH_TIMEOUT)
+        if self.__metrics_exporter:
+            self.__metrics_exporter.stop()
+            self.__metrics_exporter = None
         return True
 
-    def broadcast_message(self, message: Message):
+    def broadcast_message(self, message: Message, selector: Optional[str] = None):
         """
-        Synchronously sends a message to all connected clients.
+        Sends a message to all connected clients without blocking.
+        The message is framed (and compressed) once and posted to the outbound queue of every client, whose writer
+        sends it, so a slow or stalled client never blocks the caller. Clients whose queue is congested do not get the
+        message, clients that stay congested for longer than config.OUTBOUND_STALL_TIMEOUT are dropped.
         :param message: A message object representing the message to be sent to all connected clients.
+        :param selector: Optional selector the targeted clients have to match (see ClientRegistry.select).
+        :return: A dictionary mapping the address of every targeted client to None if the message was queued, or to
+            the error that prevented it.
+        :raises ValueError: If the selector is malformed.
+        """
+        message = PreparedMessage.of(message)
+        clients = self.get_clients(selector)
+        report: dict[str, Optional[str]] = {client.client_address_str: None for client in clients}
+        self.__post(clients, message, report)
+        return report
+
+    def fan_out(self, message: Message, selector: Optional[str] = None,
+                timeout: Optional[float] = config.GATHER_TIMEOUT, output_file: Optional[str] = None, notify=False,
+                progress: Optional[Callable[[ResultSet], None]] = None) -> ResultSet:
         """
-        with self.client_synchronize_mutex:
-            for client in self.connected_clients.values():
-                if not client.is_connected():
+        Sends a request (e.g. CMD, EXECUTE or BATCH) to the selected clients and gathers their replies until every
+        client has completed it or the timeout expires. The request is posted like a broadcast and tagged with a new
+        request ID if it has none, the replies are matched to it by that ID. Batches fail right away on clients that
+        did not announce batch support.
+        :param message: The request.
+        :param selector: Optional selector the targeted clients have to match (see ClientRegistry.select).
+        :param timeout: The maximum number of seconds to wait for the replies, None waits until every client replied
+            or disconnected.
+        :param output_file: Optional JSONL file every result is appended to as soon as it is complete.
+        :param notify: Whether the replies are also passed on to the observers, as for other requests.
+        :param progress: Optional callback called with the result set periodically while waiting (see ResultSet.wait).
+        :return: The result set, holding the result of every targeted client.
+        :raises ValueError: If the selector is malformed.
+        :raises OSError: If the output file cannot be opened.
+        """
+        if message.request_id is None:
+            message = Message(message.get_type(), message.data, message.compressed, self.next_request_id())
+        message = PreparedMessage.of(message)
+        clients = self.get_clients(selector)
+        results = ResultSet(message.request_id, message.get_type(), clients, output_file, notify)
+        self.__result_sets[message.request_id] = results  # Registered first, replies may arrive right away
+        try:
+            report: dict[str, Optional[str]] = {}
+            if message.is_type(MessageType.BATCH):
+                report.update((client.client_address_str, "Batches not supported by the client")
+                              for client in clients if not client.batch)
+                clients = [client for client in clients if client.batch]
+            self.__post(clients, message, report)
+            for client_address, error in report.items():
+                results.fail(client_address, error)
+            results.wait(timeout, progress)
+        finally:
+            del self.__result_sets[message.request_id]
+            results.close()
+        return results
+
+    def result_set(self, request_id: Optional[int]) -> Optional[ResultSet]:
+        """
+        :return: The result set gathering the replies to a request that is being fanned out, None if there is none.
+        """
+        return self.__result_sets.get(request_id) if request_id is not None else None
+
+    def inject_payload(self, source: bytes, name: str, timeout: Optional[float] = config.BROADCAST_SEND_TIMEOUT,
+                       selector: Optional[str] = None):
+        """
+        Injects a payload into all connected clients under the given name.
+        Clients that cache payloads are offered the content hash of the source first and only those that miss it are
+        sent the source, which is framed once for all of them. Clients that do not answer the offer within
+        config.PAYLOAD_OFFER_TIMEOUT seconds are reported as failed, clients that do not cache payloads are sent the
+        source right away.
+        :param source: The source of the payload, defining a payload(self) function.
+        :param name: The name the payload is executed by (see EXECUTE).
+        :param timeout: The per-client send timeout in seconds.
+        :param selector: Optional selector the targeted clients have to match (see ClientRegistry.select).
+        :return: A dictionary mapping the address of every targeted client to None if the payload was injected or
+            sent, or to the error that prevented it.
+        :raises ValueError: If the selector is malformed.
+        """
+        digest = payload_digest(source)
+        clients = self.get_clients(selector)
+        report: dict[str, Optional[str]] = {client.client_address_str: None for client in clients}
+        request_id = self.next_request_id()
+        caching = [client for client in clients if client.payload_cache]
+        replies = {client: client.pending_replies.expect(request_id) for client in caching}
+        offer = PreparedMessage(MessageType.PAYLOAD_OFFER, json.dumps({"name": name, "hash": digest}).encode(),
+                                request_id=request_id)
+        offered = set(self.__post(caching, offer, report))
+
+        misses = [client for client in clients if not client.payload_cache]
+        hits = 0
+        deadline = time.monotonic() + config.PAYLOAD_OFFER_TIMEOUT
+        for client, reply in replies.items():
+            try:
+                if client not in offered:
                     continue
+                status = reply.result(max(0.0, deadline - time.monotonic()))
+                if not status.is_type(MessageType.PAYLOAD_STATUS):
+                    report[client.client_address_str] = status.decode()
+                elif json.loads(status.decode()).get("cached"):
+                    hits += 1
+                else:
+                    misses.append(client)
+            except (TimeoutError, OSError, ValueError) as e:
+                report[client.client_address_str] = str(e) or "Timed out while waiting for the payload status"
+            finally:
+                reply.cancel()
+
+        inject = PreparedMessage(MessageType.INJECT, source, request_id=request_id)
+        self.__gather({client: self.__submit(client, inject, timeout) for client in misses}, report)
+        self.on_info(f"Payload '{name}' ({digest[:12]}): {hits} cached, {len(misses)} sent the source")
+        return report
+
+    def push_file(self, filename: str, destination_path: str = "",
+                  timeout: Optional[float] = config.BROADCAST_SEND_TIMEOUT, selector: Optional[str] = None,
+                  stripes: Optional[int] = None):
+        """
+        Sends a file to all connected clients.
+        Every chunk is read from disk once and the same buffer is streamed to all clients concurrently, compressed
+        once per negotiated algorithm, while the next chunk is read. Clients that fail are dropped from the transfer.
+        The transfer is sent on its own stream, so protocol v2 clients keep processing other messages meanwhile.
+        Protocol v1 clients can not tell the messages of the transfer apart from other messages, each of them is sent
+        the file in a transfer of its own, which holds its connection until the file is complete (see
+        BaseClientThread.exclusive).
+        With stripes, the file is sent to every client in a striped transfer of its own instead (see
+        BaseClientThread.send_file), for large files on high-latency links.
+        :param filename: The name of the file to send to the clients
+        :param destination_path: The destination path which the file will be saved client-side
+        :param timeout: The per-client send timeout in seconds for every message of the transfer.
+        :param selector: Optional selector the targeted clients have to match (see ClientRegistry.select).
+        :param stripes: Optional number of data connections the file is sent over to every client.
+        :return: A dictionary mapping the address of every targeted client to None if the file was sent, or to the
+            error that prevented it.
+        :raises:
+            FileNotFoundError: When a file with the given path does not exist.
+            FileReadError: When an error occurs while reading the file.
+            ValueError: If the selector is malformed.
+        """
+        filepath = Path(filename)
+        if not filepath.is_file():
+            raise FileNotFoundError(f"{filepath} is not a file")
+
+        clients = self.get_clients(selector)
+        if stripes:
+            return self.__push_file_striped(filepath, destination_path, clients, stripes)
+
+        report: dict[str, Optional[str]] = {client.client_address_str: None for client in clients}
+        started, size = time.monotonic(), filepath.stat().st_size
+        request_id = self.next_request_id()
+        held = {client: self.__transfer(client.send_file, str(filepath), destination_path, request_id)
+                for client in clients if client.protocol_version < PROTOCOL_V2}
+        clients = [client for client in clients if client not in held]
+        upload = PreparedMessage(MessageType.FILE_UPLOAD, os.path.join(destination_path, filepath.name).encode(),
+                                 request_id=request_id)
+        active = self.__gather({client: self.__submit(client, upload, timeout) for client in clients}, report)
+        compressors: dict[str, StreamCompressor] = {}
+        try:
+            with open(filepath, 'rb') as file:
+                compress = Compression.is_compressible(file.read(config.COMPRESSION_SAMPLE_SIZE))
+                file.seek(0)
+                chunk = file.read(config.FILE_CHUNK_SIZE)
+                while chunk and active:
+                    futures = self.__submit_chunk(active, chunk, compress, compressors, request_id, timeout)
+                    chunk = file.read(config.FILE_CHUNK_SIZE)  # Read ahead while the chunk is being sent
+                    active = self.__gather(futures, report)
+        except OSError:
+            raise FileReadError(f"Failed to read file {filepath}")
+
+        eof = PreparedMessage(MessageType.END_OF_FILE, request_id=request_id)
+        self.__gather({client: self.__submit(client, eof, timeout) for client in active}, report)
+        self.__gather_transfers(held, report)
+        self.metrics.transferred(size, time.monotonic() - started, sum(error is None for error in report.values()))
+        return report
+
+    def __push_file_striped(self, filepath: Path, destination_path: str, clients: list[Client],
+                            stripes: int) -> dict[str, Optional[str]]:
+        """
+        Sends a file to every client in a striped transfer, concurrently on the pool of transfer workers. Clients
+        that do not accept striped transfers get it in one stream.
+        """
+        report: dict[str, Optional[str]] = {client.client_address_str: None for client in clients}
+        started, size = time.monotonic(), filepath.stat().st_size
+        request_id = self.next_request_id()
+        futures = {client: self.__transfer(client.send_file, str(filepath), destination_path, request_id, stripes)
+                   for client in clients}
+        for client, throughput in self.__gather_transfers(futures, report).items():
+            if throughput:
+                self.on_debug(f"Sent {filepath.name} in stripes at {throughput / config.MB:.1f} MB/s",
+                              prefix=f"CLIENT {client.client_address_str} ")
+        succeeded = sum(error is None for error in report.values())
+        elapsed = time.monotonic() - started
+        self.metrics.transferred(size, elapsed, succeeded)
+        self.on_info(f"Sent {filepath.name} to {succeeded} clients in {elapsed:.2f}s, "
+                     f"{size * succeeded / max(elapsed, 1e-9) / config.MB:.1f} MB/s in aggregate")
+        return report
+
+    def push_directory(self, dirname: str, destination_path: str = "",
+                       timeout: Optional[float] = config.BROADCAST_SEND_TIMEOUT, selector: Optional[str] = None):
+        """
+        Sends a directory tree to all connected clients as a tar archive, which is produced once while it is streamed
+        to all clients (see push_file). Nothing is written to disk, the clients extract the archive as it arrives.
+        Protocol v1 clients are each sent the directory in a transfer of their own, as for push_file.
+        :param dirname: The name of the directory to send to the clients
+        :param destination_path: The destination path which the directory will be saved client-side
+        :param timeout: The per-client send timeout in seconds for every message of the transfer.
+        :param selector: Optional selector the targeted clients have to match (see ClientRegistry.select).
+        :return: A dictionary mapping the address of every targeted client to None if the directory was sent, or to
+            the error that prevented it.
+        :raises:
+            FileNotFoundError: When a directory with the given path does not exist.
+            FileReadError: When an error occurs while reading the directory.
+            ValueError: If the selector is malformed.
+        """
+        dirpath = Path(dirname)
+        if not dirpath.is_dir():
+            raise FileNotFoundError(f"{dirpath} is not a directory")
+
+        clients = self.get_clients(selector)
+        report: dict[str, Optional[str]] = {client.client_address_str: None for client in clients}
+        started, size = time.monotonic(), 0
+        request_id = self.next_request_id()
+        held = {client: self.__transfer(client.send_directory, str(dirpath), destination_path, request_id)
+                for client in clients if client.protocol_version < PROTOCOL_V2}
+        clients = [client for client in clients if client not in held]
+        upload = PreparedMessage(MessageType.DIRECTORY_UPLOAD, os.path.join(destination_path, dirpath.name).encode(),
+                                 request_id=request_id)
+        active = self.__gather({client: self.__submit(client, upload, timeout) for client in clients}, report)
+        compressors: dict[str, StreamCompressor] = {}
+
+        def send_chunk(chunk: bytes):
+            nonlocal active, size
+            size += len(chunk)
+            if active:
+                futures = self.__submit_chunk(active, chunk, True, compressors, request_id, timeout)
+                active = self.__gather(futures, report)
+
+        try:
+            with ChunkWriter(send_chunk) as writer:
+                write_directory_archive(dirpath, writer)
+        except (OSError, tarfile.TarError):
+            raise FileReadError(f"Failed to read directory {dirpath}")
 
-                try:
-                    client.send_message(message)
-                except OSError as e:
-                    self.on_error(f"Failed to send message to {client.get_address()}:{e}")
+        eof = PreparedMessage(MessageType.END_OF_FILE, request_id=request_id)
+        self.__gather({client: self.__submit(client, eof, timeout) for client in active}, report)
+        self.__gather_transfers(held, report)
+        self.metrics.transferred(size, time.monotonic() - started, sum(error is None for error in report.values()))
+        return report
+
+    def __submit_chunk(self, clients: list[Client], chunk: bytes, compress: bool,
+                       compressors: dict[str, StreamCompressor], request_id: int,
+                       timeout: Optional[float]) -> dict[Client, Future]:
+        """
+        Schedules the sends of a FILE chunk to the clients of a transfer, the chunk is prepared once per compression
+        algorithm in use.
+        """
+        futures = {}
+        variants = {}
+        for client in clients:
+            algorithm = client.compression.algorithm if compress else None
+            if algorithm not in variants:
+                variants[algorithm] = self.__prepare_chunk(chunk, algorithm, compressors, request_id)
+            if variants[algorithm].compressed:
+                client.compression.account(len(chunk), len(variants[algorithm].data))
+            futures[client] = self.__submit(client, variants[algorithm], timeout)
+        return futures
+
+    @staticmethod
+    def __prepare_chunk(chunk: bytes, algorithm: Optional[str], compressors: dict[str, StreamCompressor],
+                        request_id: int):
+        """
+        Prepares the FILE message of a chunk for the clients using the given compression algorithm. Every algorithm
+        has its own stream compressor, so all clients using it receive the same compressed stream.
+        """
+        if not algorithm:
+            return PreparedMessage(MessageType.FILE, chunk, request_id=request_id)
+
+        if algorithm not in compressors:
+            compressors[algorithm] = Compression(algorithm).compressor()
+        if (compressed := compressors[algorithm].compress(chunk)) is None:
+            return PreparedMessage(MessageType.FILE, chunk, request_id=request_id)
+        return PreparedMessage(MessageType.FILE, compressed, compressed=True, request_id=request_id)
+
+    def __post(self, clients: list[Client], message: Message, report: dict[str, Optional[str]]) -> list[Client]:
+        """
+        Posts a message to the outbound queues of the clients and records the failures in the report.
+        :return: The clients the message was queued for.
+        """
+        queued = []
+        for client in clients:
+            try:
+                if client.post_message(message):
+                    queued.append(client)
+                else:
+                    report[client.client_address_str] = f"Congested, {client.outbound_bytes} bytes queued"
+            except OSError as e:
+                report[client.client_address_str] = str(e)
+                self.on_error(f"Failed to send message to {client.get_address()}:{e}")
+        return queued
+
+    def __submit(self, client: Client, message: Message, timeout: Optional[float]) -> Future:
+        """
+        Schedules a send on the bounded pool of broadcast workers.
+        """
+        return self.__run(client.send_message, message, timeout)
+
+    def __run(self, function: Callable, *args) -> Future:
+        """
+        Runs a function on the bounded pool of broadcast workers.
+        """
+        if not self.__broadcast_executor:
+            self.__broadcast_executor = ThreadPoolExecutor(max_workers=config.BROADCAST_WORKERS,
+                                                           thread_name_prefix="broadcast")
+        return self.__broadcast_executor.submit(function, *args)
+
+    def __transfer(self, function: Callable, *args) -> Future:
+        """
+        Runs a transfer on the bounded pool of transfer workers. It holds its worker until it is complete, so it must
+        not take one of the broadcast workers which send the chunks of the streamed transfers.
+        """
+        if not self.__transfer_executor:
+            self.__transfer_executor = ThreadPoolExecutor(max_workers=config.TRANSFER_WORKERS,
+                                                          thread_name_prefix="transfer")
+        return self.__transfer_executor.submit(function, *args)
+
+    def __gather(self, futures: dict[Client, Future], report: dict[str, Optional[str]]) -> list[Client]:
+        """
+        Waits for the scheduled sends and records the failures in the report.
+        :return: The clients whose send succeeded.
+        """
+        succeeded = []
+        for client, future in futures.items():
+            try:
+                future.result()
+                succeeded.append(client)
+            except OSError as e:
+                report[client.client_address_str] = str(e)
+                self.on_error(f"Failed to send message to {client.get_address()}:{e}")
+        return succeeded
+
+    def __gather_transfers(self, futures: dict[Client, Future], report: dict[str, Optional[str]]) -> dict[Client, Any]:
+        """
+        Waits for the transfers run on the transfer workers and records the failures in the report.
+        :return: The results of the transfers that succeeded.
+        """
+        results = {}
+        for client, future in futures.items():
+            try:
+                results[client] = future.result()
+            except (OSError, FileReadError) as e:
+                report[client.client_address_str] = str(e)
+                self.on_error(f"Failed to send file to {client.get_address()}:{e}")
+        return results
 
     def send_message_to_client(self, client_address: str, message: Message):
         """
-        Sends a message to a specific client.
+        Sends a message to a specific client without blocking, the message is posted to the client's outbound queue.
         :param client_address: String representation of the client's address
         :param message: A message object representing the message to be sent to the client
         """
         try:
-            if client := self.__get_client_from_address(client_address):
-                client.send_message(message)
+            if (client := self.__get_client_from_address(client_address)) and not client.post_message(message):
+                self.on_error(f"Failed to send message to {client_address}: congested, "
+                              f"{client.outbound_bytes} bytes queued")
         except OSError as e:
             self.on_error(f"Failed to send message to {client_address}: {e}")
 
@@ -122,44 +605,88 @@ class RCEServer:
         """
         try:
             if client := self.__get_client_from_address(client_address):
-                client.send_file(filename, destination_path)
+                if throughput := client.send_file(filename, destination_path, self.next_request_id()):
+                    self.on_info(f"Sent {filename} in stripes at {throughput / config.MB:.1f} MB/s",
+                                 prefix=f"CLIENT {client_address} ")
         except (FileNotFoundError, FileReadError) as e:
             self.on_error(e)
         except OSError as e:
             self.on_error(f"Failed to send file to {client_address}: {e}")
 
+    def send_directory_to_client(self, client_address: str, dirname: str, destination_path: str = ""):
+        """
+        Sends a directory tree to a specific client.
+        :param client_address: String representation of the client's address
+        :param dirname: The name of the directory to send to the client
+        :param destination_path: The destination path which the directory will be saved client-side
+        """
+        try:
+            if client := self.__get_client_from_address(client_address):
+                client.send_directory(dirname, destination_path, self.next_request_id())
+        except (FileNotFoundError, FileReadError) as e:
+            self.on_error(e)
+        except OSError as e:
+            self.on_error(f"Failed to send directory to {client_address}: {e}")
+
     def __get_client_from_address(self, client_address: str):
         """
         Returns a client with the given address
-        :param client_address: The address of the client (as IPV4)
+        :param client_address: The address of the client as "host:port"
         :return: The client thread corresponding to the client address
         """
-        if not re.match(config.IPV4_PATTERN, client_address):
-            self.on_error(f"Invalid client address: {client_address}")
+        if not (client := self.clients.find(client_address)) or not client.is_connected():
+            self.on_error(f"Client '{client_address}' not found")
             return
+        return client
 
-        host, port = client_address.split(":")
-        client_addr = (host, int(port))
-        with self.client_synchronize_mutex:
-            if not (client := self.connected_clients.get(client_addr)) or not client.is_connected():
-                self.on_error(f"Client '{client_addr}' not found")
-                return
-            return client
+    def next_request_id(self) -> int:
+        """
+        :return: A new request ID, used to tag a request and tell its results apart from those of other requests.
+            IDs wrap around after 2^32 - 1 and are never 0, which marks frames that belong to no stream.
+        """
+        return (next(self.__request_ids) - 1) % 0xFFFFFFFF + 1
+
+    def get_clients(self, selector: Optional[str] = None):
+        """
+        Returns a snapshot of the connected clients.
+        :param selector: Optional selector the clients have to match (see ClientRegistry.select), e.g. "tag=web".
+        :return: A list of the client threads/connections that are still connected.
+        :raises ValueError: If the selector is malformed.
+        """
+        clients = self.clients.select(selector) if selector else self.clients.all()
+        return [client for client in clients if client.is_connected()]
+
+    def client_infos(self, selector: Optional[str] = None) -> list[ClientInfo]:
+        """
+        :param selector: Optional selector the clients have to match (see ClientRegistry.select).
+        :return: A copy of the state of the connected clients, which can be pickled.
+        :raises ValueError: If the selector is malformed.
+        """
+        return [ClientInfo.of(client) for client in self.get_clients(selector)]
+
+    def metrics_snapshot(self) -> MetricsSnapshot:
+        """
+        :return: A copy of the current metrics of the server, including the clients reaped by the heartbeat monitor.
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot.reaped = self.heartbeats.reaped
+        if self.__metrics_exporter and self.__metrics_exporter.error:
+            snapshot.export_error = str(self.__metrics_exporter.error)
+        return snapshot
 
     def __close_all_clients(self):
         """
-        Synchronously closes all connected clients and clears the connected clients dictionary.
+        Closes all connected clients and clears the client registry.
         """
-        with self.client_synchronize_mutex:
-            if len(self.connected_clients) == 0:
-                return
+        clients = self.clients.clear()
+        if len(clients) == 0:
+            return
 
-            for client in self.connected_clients.values():
-                if not client.is_connected():
-                    continue
-                client.close()
-            self.connected_clients.clear()
-            self.on_debug("All clients disconnected")
+        for client in clients:
+            if not client.is_connected():
+                continue
+            client.close()
+        self.on_debug("All clients disconnected")
 
     def is_running(self) -> bool:
         return self.__running
@@ -177,28 +704,23 @@ class RCEServer:
         self.observers.append(observer)
 
     def on_connect(self, client_address: str):
-        for observer in self.observers:
-            observer.on_connect(client_address)
+        self.events.publish(self.observers, "on_connect", client_address)
 
     def on_disconnect(self, client_address: str):
-        for observer in self.observers:
-            observer.on_disconnect(client_address)
+        self.events.publish(self.observers, "on_disconnect", client_address)
 
     def on_message(self, sender: str, message: Message):
-        for observer in self.observers:
-            observer.on_message(sender, message.data.decode())
+        # The payload may be a view of a receive buffer that is reused, so the observers get a copy of it
+        self.events.publish(self.observers, "on_message", sender, bytes(message.data))
 
     def on_info(self, message: str, prefix=""):
-        for observer in self.observers:
-            observer.on_info(message, prefix)
+        self.events.publish(self.observers, "on_info", message, prefix)
 
     def on_debug(self, message: str, prefix=""):
         if not self.debug:
             return
 
-        for observer in self.observers:
-            observer.on_debug(message, prefix)
+        self.events.publish(self.observers, "on_debug", message, prefix)
 
     def on_error(self, error: str, prefix=""):
-        for observer in self.observers:
-            observer.on_error(error, prefix)
+        self.events.publish(self.observers, "on_error", error, prefix)
@@ -1,10 +1,17 @@
+import json
 import socket
+import time
 import typing
-from typing import Any
+from typing import Any, Optional
 
+import config
 from src.core.base_client import BaseClientThread
+from src.core.compression import Compression
 from src.core.exception import FileWriteError, MessageTypeError
-from src.core.message import MessageType
+from src.core.file_transfer import FILE_BODY_TYPES
+from src.core.message import Message, MessageType, hello_capabilities, negotiate_protocol
+from src.core.striped_transfer import StripeTransfer
+from src.server.command_output import CommandOutput
 
 if typing.TYPE_CHECKING:
     from src.server.rce_server import RCEServer
@@ -21,26 +28,68 @@ class RCEServerThread(BaseClientThread):
         self.init(client_socket, addr)
         host, port = addr
         self.server = server_instance
+        self.payload_cache = False  # Whether the client caches payloads by hash, announced in its HELLO message
+        self.tags: frozenset[str] = frozenset()  # Reported by the client in its HELLO message
+        self.hostname = ""
+        self.heartbeat = False  # Whether the client answers PING messages, announced in its HELLO message
+        self.batch = False  # Whether the client runs BATCH messages, announced in its HELLO message
+        self.rtt: Optional[float] = None  # Smoothed round trip time of the heartbeats in seconds
+        self.connected_at = time.monotonic()
         self.client_address_str = f"{host}:{port}"
+        self.__registered = False  # Whether the connection is known to be a client rather than a data connection
         self.__log_prefix = f"CLIENT {self.client_address_str} "
+        self.__command_output = CommandOutput(self.server, self.client_address_str)
 
     def run(self):
-        self.server.on_connect(self.client_address_str)
+        if not self.wait_readable(config.HELLO_TIMEOUT):  # No HELLO message, e.g. a client that predates it
+            self.__register()
         while self.is_connected():
             try:
                 message = self.receive_message()
+                if not self.__registered and not message.is_type(MessageType.HELLO):
+                    self.__register()
                 if message.is_type(MessageType.DISCONNECT):
                     raise OSError("RECEIVED DISCONNECT")
 
                 if message.is_type(MessageType.ECHO):
-                    self.server.on_message(self.client_address_str, message)
+                    self.__command_output.on_echo(message)
                 elif message.is_type(MessageType.FILE_UPLOAD):  # TODO: Handle file upload action
                     self.server.on_debug("Receiving file...")
-                    filename = message.data.decode()
-                    self.receive_file(filename)
-                    self.server.on_info(f"Received file '{filename}'", prefix=self.__log_prefix)
+                    filename = message.decode()
+                    if self.receive_file(filename, request_id=message.request_id):
+                        self.server.on_info(f"Received file '{filename}'", prefix=self.__log_prefix)
+                elif message.is_type(MessageType.DIRECTORY_UPLOAD):
+                    dirname = message.decode()
+                    if self.receive_directory(dirname, request_id=message.request_id):
+                        self.server.on_info(f"Received directory '{dirname}'", prefix=self.__log_prefix)
+                elif message.get_type() in FILE_BODY_TYPES:
+                    if file_path := self.receive_file_message(message):
+                        kind = "directory" if file_path.is_dir() else "file"
+                        self.server.on_info(f"Received {kind} '{file_path.name}'", prefix=self.__log_prefix)
+                elif message.is_type(MessageType.FILE_SYNC):
+                    self.server.on_debug("Receiving file delta...")
+                    self.receive_file_sync(message)
+                elif message.is_type(MessageType.FILE_SIGNATURE):
+                    if not self.pending_replies.resolve(message):
+                        self.server.on_debug(f"Unexpected signature for request #{message.request_id}",
+                                             prefix=self.__log_prefix)
+                elif message.is_type(MessageType.PAYLOAD_STATUS):
+                    if not self.pending_replies.resolve(message):
+                        self.server.on_debug(f"Unexpected payload status for request #{message.request_id}",
+                                             prefix=self.__log_prefix)
                 elif message.is_type(MessageType.ERROR):
-                    self.server.on_error(message.data.decode(), prefix=self.__log_prefix)
+                    if not self.pending_replies.resolve(message):  # Errors answering a request fail the request
+                        self.__command_output.on_error(message)
+                elif message.is_type(MessageType.PONG):
+                    self.server.heartbeats.on_pong(self, message)
+                elif message.is_type(MessageType.HELLO):
+                    self.__handshake(message)
+                elif message.is_type(MessageType.OUTPUT):
+                    self.__command_output.on_output(message)
+                elif message.is_type(MessageType.EXIT):
+                    self.__command_output.on_exit(message)
+                elif message.is_type(MessageType.BATCH_RESULT):
+                    self.__command_output.on_batch_result(message)
                 else:
                     self.server.on_debug(f"Unknown message {message.get_type()}", prefix=self.__log_prefix)
             except (MessageTypeError, FileWriteError) as e:
@@ -48,15 +97,85 @@ class RCEServerThread(BaseClientThread):
             except OSError as e:
                 self.server.on_debug(f"DISCONNECTED => {e}", prefix=self.__log_prefix)
                 self.__close_and_remove_client()
-                self.server.on_disconnect(self.client_address_str)
+                if self.__registered:
+                    self.server.on_disconnect(self.client_address_str)
+
+    def __handshake(self, message: Message):
+        """
+        Answers the HELLO message of the client with the capabilities chosen for this connection.
+        The compression and protocol version are only switched once the answer has been sent, so the client can decode
+        everything after it. A HELLO message announcing a stripe turns the connection into a data connection of a
+        striped transfer instead, which is never registered as a client.
+        :param message: The HELLO message carrying the client's capabilities as JSON.
+        :raises OSError: Once the stripe of a data connection has been transferred, which ends the connection.
+        """
+        try:
+            capabilities = hello_capabilities(message)
+        except ValueError:
+            self.server.on_error("Received malformed HELLO message", prefix=self.__log_prefix)
+            return
+
+        if "stripe" in capabilities:  # A data connection of a striped transfer rather than a client
+            self.serve_stripe(self.server.stripes, capabilities["stripe"], capabilities.get("index"))
+            raise OSError("Data connection closed")
+
+        algorithm = Compression.negotiate(capabilities.get("compression", []))
+        version = negotiate_protocol(capabilities.get("protocol", []))
+        heartbeats = self.server.heartbeats
+        heartbeat = bool(capabilities.get("heartbeat")) and heartbeats.enabled
+        self.send_message(Message(MessageType.HELLO, json.dumps({
+            "compression": algorithm,
+            "protocol": version,
+            "heartbeat": {"interval": heartbeats.interval, "timeout": heartbeats.timeout} if heartbeat else None,
+            "stripes": self.server.striping,
+            "file_stream": True,
+            "request_ids": True,
+        }).encode()))
+        self.compression = Compression(algorithm)
+        self.protocol_version = version
+        self.payload_cache = bool(capabilities.get("payload_cache"))
+        self.tags = frozenset(str(tag) for tag in capabilities.get("tags", []))
+        self.hostname = str(capabilities.get("hostname", ""))
+        self.heartbeat = heartbeat
+        self.batch = bool(capabilities.get("batch"))
+        self.striping = bool(capabilities.get("stripes")) and self.server.striping
+        self.file_stream = bool(capabilities.get("file_stream"))
+        self.request_ids = bool(capabilities.get("request_ids"))
+        if self.__registered:
+            self.server.clients.update(self)
+        else:
+            self.__register()
+        self.server.on_debug(f"Negotiated compression: {algorithm}, protocol: v{version}", prefix=self.__log_prefix)
+
+    def __register(self):
+        """
+        Registers the connection as a client once it is known not to be a data connection of a striped transfer, starts
+        tracking its traffic and reports it to the observers.
+        """
+        if not self.server.is_running():  # The registry has been cleared already
+            self.close()
+            return
+
+        self.__registered = True
+        traffic = self.server.metrics.track(self.client_address_str)
+        traffic.add(self.traffic)  # The messages exchanged before
+        self.traffic = traffic
+        self.server.clients.add(self)
+        self.server.on_connect(self.client_address_str)
+
+    def open_stripes(self, transfer: StripeTransfer):
+        """
+        Expects the data connections of a striped transfer, which the client opens (see BaseClientThread.open_stripes).
+        """
+        self.server.stripes.open(transfer)
 
     def __close_and_remove_client(self):
         """
-        Closes the client socket and synchronously removes it from the connected clients dictionary.
+        Closes the client socket and removes it from the client registry.
         This should only be called from within the listener thread when the client disconnects from the server.
         """
         self.close()
-        with self.server.client_synchronize_mutex:
-            if self in self.server.connected_clients.values():
-                del self.server.connected_clients[self.get_address()]
-        self.server.on_debug("Client thread closed and removed from dictionary", prefix=self.__log_prefix)
+        self.abort_file_transfers()
+        self.pending_replies.fail_all(OSError("Connection closed"))
+        self.server.clients.remove(self)
+        self.server.on_debug("Client thread closed and removed from registry", prefix=self.__log_prefix)
@@ -0,0 +1,291 @@
+import json
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import config
+from src.core.command_batch import CommandResult
+from src.core.message import OUTPUT_STDERR, OUTPUT_STDOUT, MessageType
+
+RESULT_PENDING = "pending"
+RESULT_DONE = "done"
+RESULT_FAILED = "failed"
+RESULT_TIMEOUT = "timeout"
+
+
+class ClientResult:
+    """
+    The result of a request on one client. It is complete once the client has sent its final reply: the EXIT message
+    of a command, the BATCH_RESULT message of a batch, the ECHO message carrying the output of a payload (or of a "cd"
+    command) or an ERROR message.
+    A result is done if the request succeeded, failed if the client reported an error, exited with a non-zero status,
+    failed a command of a batch or could not be sent the request, and timed out if it was not complete when the
+    gathering ended.
+    """
+
+    def __init__(self, client_address: str, hostname: str = ""):
+        self.client_address = client_address
+        self.hostname = hostname
+        self.state = RESULT_PENDING
+        self.status: Optional[int] = None  # The exit status of a command
+        self.truncated = False
+        self.error: Optional[str] = None
+        self.latency: Optional[float] = None  # Seconds from sending the request to the final reply
+        self.commands: Optional[list[CommandResult]] = None  # The results of the commands of a batch that ran
+        self.skipped = 0  # The number of commands of a batch that were skipped
+        self.__stdout: list[str] = []
+        self.__stderr: list[str] = []
+
+    @property
+    def stdout(self) -> str:
+        return "".join(self.__stdout)
+
+    @property
+    def stderr(self) -> str:
+        return "".join(self.__stderr)
+
+    def append(self, stream: int, text: str):
+        (self.__stderr if stream == OUTPUT_STDERR else self.__stdout).append(text)
+
+    def to_json(self) -> dict[str, Any]:
+        result = {
+            "client": self.client_address,
+            "hostname": self.hostname,
+            "state": self.state,
+            "status": self.status,
+            "truncated": self.truncated,
+            "latency": self.latency,
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+            "error": self.error,
+        }
+        if self.commands is not None:
+            result["commands"] = [command.to_json() for command in self.commands]
+            result["skipped"] = self.skipped
+        return result
+
+
+class ResultSet:
+    """
+    Gathers the replies of the clients a request was fanned out to (see RCEServer.fan_out), matched by request ID.
+    Replies arrive on the connections of the clients, every result is written to the output file as a JSON line as
+    soon as it is complete, and the timed out ones when the gathering ends.
+    """
+
+    def __init__(self, request_id: int, message_type: MessageType, clients: list[Any],
+                 output_file: Optional[str] = None, notify=False):
+        """
+        :param request_id: The request ID the replies are tagged with.
+        :param message_type: The type of the request.
+        :param clients: The clients the request is sent to.
+        :param output_file: Optional JSONL file the results are appended to.
+        :param notify: Whether the replies are also passed on to the server's observers, as for other requests.
+        :raises OSError: If the output file cannot be opened.
+        """
+        self.request_id = request_id
+        self.message_type = message_type
+        self.notify = notify
+        self.started_at = time.monotonic()
+        self.results = {client.client_address_str: ClientResult(client.client_address_str, client.hostname)
+                        for client in clients}
+        self.completed: list[ClientResult] = []  # In the order the results completed in
+        self.__clients = {client.client_address_str: client for client in clients}
+        self.__pending = len(self.results)
+        self.__condition = threading.Condition()
+        self.__file = open(output_file, "a", encoding="utf-8") if output_file else None
+
+    @property
+    def pending(self) -> int:
+        return self.__pending
+
+    @property
+    def done(self) -> int:
+        return sum(result.state == RESULT_DONE for result in self.completed)
+
+    @property
+    def failed(self) -> int:
+        return sum(result.state == RESULT_FAILED for result in self.completed)
+
+    @property
+    def timed_out(self) -> list[str]:
+        """
+        :return: The addresses of the clients that did not complete the request in time.
+        """
+        return [result.client_address for result in self.completed if result.state == RESULT_TIMEOUT]
+
+    def output(self, client_address: str, stream: int, text: str):
+        """
+        Appends the output a client has sent so far.
+        :param client_address: The address of the client.
+        :param stream: The stream the output was read from, OUTPUT_STDOUT or OUTPUT_STDERR.
+        :param text: The decoded output.
+        """
+        if (result := self.results.get(client_address)) and result.state == RESULT_PENDING:
+            result.append(stream, text)
+
+    def finish(self, client_address: str, status: Optional[int] = None, truncated=False, output: str = ""):
+        """
+        Completes the result of a client with its final reply. A non-zero exit status fails the result.
+        :param client_address: The address of the client.
+        :param status: The exit status of a command.
+        :param truncated: Whether the output of the command was truncated.
+        :param output: The output carried by the final reply itself.
+        """
+        with self.__condition:
+            if not (result := self.__pending_result(client_address)):
+                return
+            result.status = status
+            result.truncated = truncated
+            if output:
+                result.append(OUTPUT_STDOUT, output)
+            self.__complete(result, RESULT_DONE if not status else RESULT_FAILED)
+
+    def finish_batch(self, client_address: str, commands: list[CommandResult], skipped: int):
+        """
+        Completes the result of a client with the results of the commands of a batch. A failed command fails the
+        result.
+        :param client_address: The address of the client.
+        :param commands: The results of the commands that ran.
+        :param skipped: The number of commands that were skipped.
+        """
+        with self.__condition:
+            if not (result := self.__pending_result(client_address)):
+                return
+            result.commands = commands
+            result.skipped = skipped
+            result.truncated = any(command.truncated for command in commands)
+            self.__complete(result, RESULT_FAILED if skipped or any(command.failed for command in commands)
+                            else RESULT_DONE)
+
+    def fail(self, client_address: str, error: str):
+        """
+        Completes the result of a client with an error.
+        """
+        with self.__condition:
+            if result := self.__pending_result(client_address):
+                result.error = error
+                self.__complete(result, RESULT_FAILED)
+
+    def wait(self, timeout: Optional[float] = config.GATHER_TIMEOUT,
+             progress: Optional[Callable[["ResultSet"], None]] = None) -> bool:
+        """
+        Waits until every client has completed the request. Clients that disconnect meanwhile fail.
+        :param timeout: The maximum number of seconds to wait, measured from the start of the request.
+        :param progress: Optional callback called with the result set every config.GATHER_PROGRESS_INTERVAL seconds
+            while waiting, and once more at the end.
+        :return: Whether every client completed the request within the timeout.
+        """
+        deadline = self.started_at + timeout if timeout is not None else None
+        while True:
+            with self.__condition:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if not self.__pending or (remaining is not None and remaining <= 0):
+                    break
+                interval = config.GATHER_PROGRESS_INTERVAL
+                self.__condition.wait_for(lambda: not self.__pending,
+                                          min(interval, remaining) if remaining is not None else interval)
+
+            for address, result in list(self.results.items()):
+                if result.state == RESULT_PENDING and not self.__clients[address].is_connected():
+                    self.fail(address, "Disconnected")
+            if progress and self.__pending:
+                progress(self)
+
+        if progress:
+            progress(self)
+        return not self.__pending
+
+    def close(self):
+        """
+        Ends the gathering: the results that are still pending time out, and the output file is closed.
+        """
+        with self.__condition:
+            for result in self.results.values():
+                if result.state == RESULT_PENDING:
+                    self.__complete(result, RESULT_TIMEOUT)
+            if self.__file:
+                self.__file.close()
+                self.__file = None
+
+    def __pending_result(self, client_address: str) -> Optional[ClientResult]:
+        result = self.results.get(client_address)
+        return result if result and result.state == RESULT_PENDING else None
+
+    def __complete(self, result: ClientResult, state: str):
+        """
+        Records a completed result and writes it to the output file, the condition must be held.
+        """
+        result.state = state
+        if state != RESULT_TIMEOUT:
+            result.latency = time.monotonic() - self.started_at
+        self.completed.append(result)
+        self.__pending -= 1
+        if self.__file:
+            self.__file.write(json.dumps({"request_id": self.request_id, **result.to_json()}) + "\n")
+            self.__file.flush()
+        self.__condition.notify_all()
+
+
+class ShardedResultSet:
+    """
+    Merges the results of a request that the shards of a sharded server fanned out to their clients (see
+    ShardedServer.fan_out), with the read API of ResultSet. The shards report the results they have completed and the
+    number still pending as they gather them. The output file is written here, so that the lines of the shards never
+    interleave.
+    """
+
+    def __init__(self, request_id: int, message_type: MessageType, shards: int, output_file: Optional[str] = None):
+        """
+        :param request_id: The request ID the replies are tagged with.
+        :param message_type: The type of the request.
+        :param shards: The number of shards the request was fanned out by.
+        :param output_file: Optional JSONL file the results are appended to.
+        :raises OSError: If the output file cannot be opened.
+        """
+        self.request_id = request_id
+        self.message_type = message_type
+        self.started_at = time.monotonic()
+        self.results: dict[str, ClientResult] = {}  # Only holds the completed results until the gathering ended
+        self.completed: list[ClientResult] = []
+        self.__pending = [0] * shards
+        self.__lock = threading.Lock()
+        self.__file = open(output_file, "a", encoding="utf-8") if output_file else None
+
+    @property
+    def pending(self) -> int:
+        return sum(self.__pending)
+
+    @property
+    def done(self) -> int:
+        return sum(result.state == RESULT_DONE for result in self.completed)
+
+    @property
+    def failed(self) -> int:
+        return sum(result.state == RESULT_FAILED for result in self.completed)
+
+    @property
+    def timed_out(self) -> list[str]:
+        return [result.client_address for result in self.completed if result.state == RESULT_TIMEOUT]
+
+    def update(self, shard: int, pending: int, completed: list[ClientResult]):
+        """
+        Merges the progress reported by a shard.
+        :param shard: The index of the shard.
+        :param pending: The number of its clients that have not completed the request yet.
+        :param completed: The results its clients completed since its previous report.
+        """
+        with self.__lock:
+            self.__pending[shard] = pending
+            for result in completed:
+                self.results[result.client_address] = result
+                self.completed.append(result)
+                if self.__file:
+                    self.__file.write(json.dumps({"request_id": self.request_id, **result.to_json()}) + "\n")
+            if self.__file:
+                self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            if self.__file:
+                self.__file.close()
+                self.__file = None
@@ -0,0 +1,424 @@
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
+import signal
+import socket
+import threading
+from concurrent.futures import Future
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Optional
+
+import config
+from src.core.logger import Logger
+from src.core.message import Message
+from src.core.metrics import MetricsExporter, MetricsSnapshot
+from src.server.client_registry import ClientInfo
+from src.server.rce_server import RCEServer
+from src.server.result_set import ClientResult, ShardedResultSet
+
+# Methods of RCEServer the control plane may call on the shards
+SHARD_CALLS = frozenset(("client_infos", "metrics_snapshot", "broadcast_message", "inject_payload", "push_file",
+                         "push_directory", "fan_out", "stop"))
+# Maximum number of seconds to wait for a shard to start listening, and for a stopped shard process to exit
+SHARD_START_TIMEOUT = 30.0
+SHARD_STOP_TIMEOUT = 10.0
+
+
+def run_shard(index: int, conn: Connection, options: dict[str, Any]):
+    """
+    Entry point of a shard process: runs an RCEServer on the shared port and serves the calls of the control plane
+    until it is stopped or the control plane is gone.
+    Calls are (call ID, method, args, kwargs) tuples, every call runs on a thread of its own, so that a long call (e.g.
+    a fan out) does not hold up the others. Replies are (call ID, kind, value) tuples, the kind is "result", "error"
+    (the value is the exception) or "progress" (the progress of a fan out). The shard announces that it is listening,
+    or the error that prevented it, with a reply whose call ID is None.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Interrupts are handled by the control plane, which stops the shards
+    send_lock = threading.Lock()
+
+    def reply(call_id: Optional[int], kind: str, value: Any):
+        with send_lock:
+            conn.send((call_id, kind, value))
+
+    def fan_out(call_id: int, *args, **kwargs):
+        """
+        Fans out a request and reports the results as they complete: (pending, completed since the last report).
+        """
+        reported = 0
+
+        def progress(results):
+            nonlocal reported
+            completed = results.completed[reported:]
+            reported += len(completed)
+            reply(call_id, "progress", (results.pending, completed))
+
+        results = server.fan_out(*args, **kwargs, progress=progress)
+        return 0, results.completed[reported:]  # Also the results that timed out when the gathering ended
+
+    def call(call_id: int, method: str, args: tuple, kwargs: dict):
+        try:
+            if method not in SHARD_CALLS:
+                raise ValueError(f"Unknown shard call: {method}")
+            if method == "fan_out":
+                result = fan_out(call_id, *args, **kwargs)
+            else:
+                result = getattr(server, method)(*args, **kwargs)
+            reply(call_id, "result", result)
+        except Exception as e:
+            reply(call_id, "error", e)
+
+    try:
+        server = RCEServer(reuse_port=True, **options)
+        if not server.start():
+            raise OSError(f"Shard {index} failed to start")
+    except (OSError, ValueError) as e:
+        reply(None, "error", e)
+        return
+    reply(None, "ready", None)
+
+    while True:
+        try:
+            call_id, method, args, kwargs = conn.recv()
+        except (EOFError, OSError):  # The control plane is gone
+            server.stop()
+            return
+
+        if method == "stop":
+            call(call_id, method, args, kwargs)
+            return
+        threading.Thread(target=call, args=(call_id, method, args, kwargs), daemon=True,
+                         name=f"shard-{index}-call-{call_id}").start()
+
+
+class ShardConnection:
+    """
+    The control plane's end of the pipe to a shard process. Calls are sent over the pipe, a reader thread matches the
+    replies to them by call ID and completes their futures.
+    """
+
+    def __init__(self, index: int, process: multiprocessing.Process, conn: Connection):
+        self.index = index
+        self.process = process
+        self.ready: Future = Future()  # Completed once the shard is listening
+        self.__conn = conn
+        self.__lock = threading.Lock()
+        self.__call_ids = itertools.count(1)
+        self.__calls: dict[int, tuple[Future, Optional[Callable[[Any], None]]]] = {}
+        self.__closed = False
+        self.__reader = threading.Thread(target=self.__read, daemon=True, name=f"shard-{index}-reader")
+        self.__reader.start()
+
+    def call(self, method: str, *args, on_progress: Optional[Callable[[Any], None]] = None, **kwargs) -> Future:
+        """
+        Calls a method of the shard's server.
+        :param method: The name of the method, one of SHARD_CALLS.
+        :param on_progress: Optional callback called on the reader thread with the progress the call reports.
+        :return: A future completed with the result of the call, or with its exception.
+        :raises ConnectionError: If the shard is not running.
+        """
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise ConnectionError(f"Shard {self.index} is not running")
+            call_id = next(self.__call_ids)
+            self.__calls[call_id] = (future, on_progress)
+            self.__conn.send((call_id, method, args, kwargs))
+        return future
+
+    def close(self):
+        self.__conn.close()
+        self.__reader.join()
+
+    def __read(self):
+        while True:
+            try:
+                call_id, kind, value = self.__conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if call_id is None:
+                if kind == "ready":
+                    self.ready.set_result(None)
+                else:
+                    self.ready.set_exception(value)
+            elif kind == "progress":
+                if (on_progress := self.__calls[call_id][1]) is not None:
+                    on_progress(value)
+            else:
+                with self.__lock:
+                    future, _ = self.__calls.pop(call_id)
+                if kind == "result":
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+        with self.__lock:
+            self.__closed = True
+            calls, self.__calls = self.__calls, {}
+        error = ConnectionError(f"Shard {self.index} exited")
+        if not self.ready.done():
+            self.ready.set_exception(error)
+        for future, _ in calls.values():
+            future.set_exception(error)
+
+
+class ShardedServer:
+    """
+    Runs several RCEServer processes, the shards, on the same port: each of them listens on a socket of its own bound
+    with SO_REUSEPORT and the kernel spreads the incoming connections over them, so that connection handling and
+    message processing scale over the cores instead of sharing one GIL.
+    This process is the control plane and serves no clients itself: it relays the operations of the ServerCLI to the
+    shards over pipes and merges the client lists, reports, results and metrics they reply with. Shards that exit are
+    left out. Request IDs of fan outs are allocated here, the shards tag the results with them.
+    """
+
+    def __init__(self, host: str, port: int, shards: int = config.SERVER_SHARDS, debug=False,
+                 engine: str = config.SERVER_ENGINE, metrics_file: Optional[str] = config.METRICS_FILE,
+                 heartbeat_interval: Optional[float] = config.HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = config.HEARTBEAT_TIMEOUT, backlog: int = config.LISTEN_BACKLOG):
+        """
+        :param host: The hostname or IP the shards bind to.
+        :param port: The port number the shards listen on, it cannot be 0.
+        :param shards: The number of shard processes.
+        :param metrics_file: Optional file the merged metrics of the shards are written to in the Prometheus text
+            format while the server is running.
+        See RCEServer for the other parameters, which apply to every shard.
+        :raises ValueError: If the platform lacks SO_REUSEPORT, or the port, number of shards, engine or heartbeat
+            timeout are invalid.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("Sharding requires SO_REUSEPORT, which this platform does not support")
+        if shards < 1 or port == 0:
+            raise ValueError("A sharded server needs at least one shard and a fixed port")
+        if engine not in config.SERVER_ENGINES:
+            raise ValueError(f"Unknown server engine: {engine}")
+        if heartbeat_interval is not None and heartbeat_timeout <= heartbeat_interval:
+            raise ValueError(f"The heartbeat timeout ({heartbeat_timeout}s) must be longer than the interval "
+                             f"({heartbeat_interval}s)")
+
+        self.__host = host
+        self.__port = port
+        self.__shard_count = shards
+        self.__options = {"host": host, "port": port, "debug": debug, "engine": engine, "metrics_file": None,
+                          "heartbeat_interval": heartbeat_interval, "heartbeat_timeout": heartbeat_timeout,
+                          "backlog": backlog}
+        self.engine = engine
+        self.shards: list[ShardConnection] = []
+        self.__running = False
+        self.__request_ids = itertools.count(1)
+        self.__metrics_file = metrics_file
+        self.__metrics_exporter: Optional[MetricsExporter] = None
+        self.logger = Logger(self.__class__.__name__, debug)
+
+    def start(self):
+        """
+        Starts the shard processes and waits until all of them are listening.
+        :return: Whether every shard started, if one failed the others are stopped.
+        """
+        if self.__running:
+            return False
+
+        context = multiprocessing.get_context("spawn")  # Forking a process that runs threads is unsafe
+        for index in range(self.__shard_count):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=run_shard, args=(index, child_conn, self.__options), daemon=True,
+                                      name=f"rce-shard-{index}")
+            process.start()
+            child_conn.close()
+            self.shards.append(ShardConnection(index, process, parent_conn))
+
+        try:
+            for shard in self.shards:
+                shard.ready.result(SHARD_START_TIMEOUT)
+        except (OSError, ValueError, concurrent.futures.TimeoutError) as e:
+            self.logger.on_error(f"Failed to start the shards: {e}")
+            self.__stop_shards()
+            return False
+
+        self.__running = True
+        self.logger.on_info(f"Server started at {self.__host}:{self.__port} ({self.__shard_count} shards, "
+                            f"{self.engine} engine)")
+        if self.__metrics_file:
+            self.__metrics_exporter = MetricsExporter(self.metrics_snapshot, self.__metrics_file)
+            self.__metrics_exporter.start()
+        return True
+
+    def stop(self):
+        """
+        Stops the shards, which close their client connections, and waits for their processes to exit.
+        """
+        if not self.__running:
+            return False
+
+        self.__running = False
+        self.__stop_shards()
+        if self.__metrics_exporter:
+            self.__metrics_exporter.stop()
+            self.__metrics_exporter = None
+        return True
+
+    def __stop_shards(self):
+        self.__call_all("stop")
+        for shard in self.shards:
+            shard.process.join(SHARD_STOP_TIMEOUT)
+            if shard.process.is_alive():
+                self.logger.on_error(f"Shard {shard.index} did not stop, terminating it")
+                shard.process.terminate()
+                shard.process.join()
+            shard.close()
+        self.shards = []
+
+    def client_infos(self, selector: Optional[str] = None) -> list[ClientInfo]:
+        """
+        :param selector: Optional selector the clients have to match (see ClientRegistry.select).
+        :return: The connected clients of all shards, ordered by address.
+        :raises ValueError: If the selector is malformed.
+        """
+        infos = []
+        for shard, shard_infos in self.__call_all("client_infos", selector):
+            for info in shard_infos:
+                info.shard = shard.index
+            infos.extend(shard_infos)
+        return sorted(infos, key=lambda info: info.client_address_str)
+
+    def metrics_snapshot(self) -> MetricsSnapshot:
+        """
+        :return: The metrics of all shards, summed up.
+        """
+        snapshot = MetricsSnapshot()
+        for _, shard_snapshot in self.__call_all("metrics_snapshot"):
+            snapshot.add(shard_snapshot)
+        if self.__metrics_exporter and self.__metrics_exporter.error:
+            snapshot.export_error = str(self.__metrics_exporter.error)
+        return snapshot
+
+    def broadcast_message(self, message: Message, selector: Optional[str] = None) -> dict[str, Optional[str]]:
+        """
+        See RCEServer.broadcast_message, the reports of the shards are merged.
+        """
+        return self.__merge_reports("broadcast_message", self.__portable(message), selector)
+
+    def inject_payload(self, source: bytes, name: str, timeout: Optional[float] = config.BROADCAST_SEND_TIMEOUT,
+                       selector: Optional[str] = None) -> dict[str, Optional[str]]:
+        """
+        See RCEServer.inject_payload, the reports of the shards are merged.
+        """
+        return self.__merge_reports("inject_payload", source, name, timeout, selector)
+
+    def push_file(self, filename: str, destination_path: str = "",
+                  timeout: Optional[float] = config.BROADCAST_SEND_TIMEOUT, selector: Optional[str] = None,
+                  stripes: Optional[int] = None) -> dict[str, Optional[str]]:
+        """
+        See RCEServer.push_file, every shard reads the file and streams it to its own clients. Shards share the port,
+        so they do not accept striped transfers: with stripes, every client gets the file in a stream of its own.
+        """
+        return self.__merge_reports("push_file", filename, destination_path, timeout, selector, stripes)
+
+    def push_directory(self, dirname: str, destination_path: str = "",
+                       timeout: Optional[float] = config.BROADCAST_SEND_TIMEOUT,
+                       selector: Optional[str] = None) -> dict[str, Optional[str]]:
+        """
+        See RCEServer.push_directory, every shard archives the directory and streams it to its own clients.
+        """
+        return self.__merge_reports("push_directory", dirname, destination_path, timeout, selector)
+
+    def fan_out(self, message: Message, selector: Optional[str] = None,
+                timeout: Optional[float] = config.GATHER_TIMEOUT, output_file: Optional[str] = None, notify=False,
+                progress: Optional[Callable[[ShardedResultSet], None]] = None) -> ShardedResultSet:
+        """
+        See RCEServer.fan_out: every shard fans the request out to its own clients and reports their results as they
+        complete, which are merged into one result set. The results of a shard that exits meanwhile are lost.
+        :raises ValueError: If the selector is malformed.
+        :raises OSError: If the output file cannot be opened.
+        """
+        if message.request_id is None:
+            message = Message(message.get_type(), message.data, message.compressed, self.next_request_id())
+        results = ShardedResultSet(message.request_id, message.get_type(), len(self.shards), output_file)
+        try:
+            futures = {}
+            for shard in self.shards:
+                on_progress = functools.partial(self.__update_results, results, shard.index)
+                try:
+                    futures[shard.call("fan_out", self.__portable(message), selector, timeout, None, notify,
+                                       on_progress=on_progress)] = shard
+                except ConnectionError as e:
+                    self.logger.on_error(e)
+
+            pending = set(futures)
+            while pending:
+                _, pending = concurrent.futures.wait(pending, config.GATHER_PROGRESS_INTERVAL)
+                if progress and pending:
+                    progress(results)
+
+            for future, shard in futures.items():
+                try:
+                    self.__update_results(results, shard.index, future.result())
+                except ConnectionError as e:
+                    self.logger.on_error(e)
+                    results.update(shard.index, 0, [])
+            if progress:
+                progress(results)
+        finally:
+            results.close()
+        return results
+
+    @staticmethod
+    def __update_results(results: ShardedResultSet, shard: int, progress: tuple[int, list[ClientResult]]):
+        results.update(shard, *progress)
+
+    def __merge_reports(self, method: str, *args) -> dict[str, Optional[str]]:
+        report = {}
+        for _, shard_report in self.__call_all(method, *args):
+            report.update(shard_report)
+        return report
+
+    def __call_all(self, method: str, *args, **kwargs):
+        """
+        Calls a method on every running shard and waits for their results. Shards that have exited are skipped.
+        :return: The (shard, result) pairs, in the order of the shards.
+        :raises Exception: The first exception raised by the call on a shard, e.g. ValueError for a malformed selector.
+        """
+        futures = []
+        for shard in self.shards:
+            try:
+                futures.append((shard, shard.call(method, *args, **kwargs)))
+            except ConnectionError as e:
+                self.logger.on_error(e)
+
+        results, error = [], None
+        for shard, future in futures:
+            try:
+                results.append((shard, future.result()))
+            except ConnectionError as e:
+                self.logger.on_error(e)
+            except Exception as e:
+                error = error or e
+        if error:
+            raise error
+        return results
+
+    @staticmethod
+    def __portable(message: Message) -> Message:
+        """
+        :return: The message with its payload copied into bytes, so that it can be pickled.
+        """
+        return Message(message.get_type(), bytes(message.data), message.compressed, message.request_id)
+
+    def next_request_id(self) -> int:
+        """
+        See RCEServer.next_request_id, the IDs are shared by all shards.
+        """
+        return (next(self.__request_ids) - 1) % 0xFFFFFFFF + 1
+
+    def is_running(self) -> bool:
+        return self.__running
+
+    def get_host(self):
+        return self.__host
+
+    def get_port(self):
+        return self.__port
+
+    def get_address(self):
+        return self.__host, self.__port
@@ -0,0 +1,123 @@
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config  # noqa: E402
+from src.client.rce_client import RCEClient  # noqa: E402
+from src.core.message import Message, MessageType  # noqa: E402
+from src.core.observer import RCEEventObserver  # noqa: E402
+from src.server.rce_server import RCEServer  # noqa: E402
+
+
+class Recorder(RCEEventObserver):
+    """
+    Records the events of a server, so that tests can wait for them.
+    """
+
+    def __init__(self):
+        self.connected: list[str] = []
+        self.messages: list[str] = []
+        self.infos: list[str] = []
+        self.errors: list[str] = []
+
+    def on_connect(self, client_address: str):
+        self.connected.append(client_address)
+
+    def on_disconnect(self, client_address: str):
+        pass
+
+    def on_message(self, sender: str, message: bytes):
+        self.messages.append(bytes(message).decode(errors="replace"))
+
+    def on_info(self, message: str, prefix=""):
+        self.infos.append(str(message))
+
+    def on_debug(self, message: str, prefix=""):
+        pass
+
+    def on_error(self, error: str, prefix=""):
+        self.errors.append(str(error))
+
+
+def wait_for(predicate: Callable[[], bool], timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met in time")
+        time.sleep(0.02)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(autouse=True)
+def download_dir(tmp_path, monkeypatch) -> Path:
+    monkeypatch.setattr(config, "DOWNLOAD_DIR", tmp_path / "Downloads")
+    return config.DOWNLOAD_DIR
+
+
+@pytest.fixture
+def recorder() -> Recorder:
+    return Recorder()
+
+
+@pytest.fixture(params=config.SERVER_ENGINES)
+def server(request, recorder):
+    server = RCEServer("127.0.0.1", free_port(), engine=request.param)
+    server.add_observer(recorder)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def connect(server):
+    """
+    Connects clients to the server, each call returns a client once both sides have completed the handshake.
+    """
+    clients = []
+
+    def connect_client() -> RCEClient:
+        known = {connection.client_address_str for connection in server.get_clients()}
+        client = RCEClient(server.get_host(), server.get_port())
+        client.daemon = True
+        clients.append(client)
+        client.start()
+        wait_for(lambda: any(connection.client_address_str not in known and connection.batch
+                             for connection in server.get_clients()))
+        wait_for(lambda: client.request_ids)  # The client has processed the answer to its HELLO message
+        return client
+
+    yield connect_client
+    for client in clients:
+        client.close()
+
+
+@pytest.fixture
+def client(connect) -> RCEClient:
+    return connect()
+
+
+@pytest.fixture
+def connection(server, client):
+    """
+    The server side of the connection of the client.
+    """
+    return server.get_clients()[0]
+
+
+def sync(server: RCEServer, recorder: Recorder, token: str):
+    """
+    Waits until the clients have processed everything the server sent before.
+    """
+    server.broadcast_message(Message(MessageType.ECHO, token.encode()))
+    wait_for(lambda: token in recorder.messages)
@@ -0,0 +1,88 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from conftest import sync, wait_for
+from src.core.message import (FRAME_HEADER, FRAME_LENGTH, PROTOCOL_V2, REQUEST_ID_FLAG, VERSIONED_FLAG, Message,
+                              MessageType)
+
+
+def hold(connection, release: threading.Event) -> threading.Thread:
+    """
+    Holds the connection on another thread until the event is set.
+    """
+    held = threading.Event()
+
+    def run():
+        with connection.exclusive():
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    held.wait()
+    return thread
+
+
+@pytest.mark.parametrize("peer", ["server", "client"])
+def test_send_timeout_covers_waiting_for_the_connection(server, client, connection, recorder, peer):
+    sender = connection if peer == "server" else client
+    release = threading.Event()
+    holder = hold(sender, release)
+    try:
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            sender.send_message(Message(MessageType.ECHO, b"blocked"), timeout=0.2)
+        assert time.monotonic() - started < 2
+    finally:
+        release.set()
+        holder.join()
+
+    assert sender.is_connected()  # Nothing was sent, the connection is still usable
+    sender.send_message(Message(MessageType.ECHO, b"released"), timeout=5)
+    sync(server, recorder, "after release")
+
+
+def test_working_directory_is_per_client(server, client, connection, recorder, tmp_path):
+    (tmp_path / "work").mkdir()
+    process_directory = os.getcwd()
+    server.send_message_to_client(connection.client_address_str, Message(MessageType.CMD, f"cd {tmp_path}".encode()))
+    wait_for(lambda: client.cwd == tmp_path.resolve())
+    server.send_message_to_client(connection.client_address_str, Message(MessageType.CMD, b"cd work"))
+    wait_for(lambda: client.cwd == (tmp_path / "work").resolve())
+    server.send_message_to_client(connection.client_address_str, Message(MessageType.CMD, b"pwd"))
+    wait_for(lambda: any(str((tmp_path / "work").resolve()) in message for message in recorder.messages))
+    assert os.getcwd() == process_directory
+
+    server.send_message_to_client(connection.client_address_str, Message(MessageType.CMD, b"cd missing"))
+    wait_for(lambda: any("does not exist" in error for error in recorder.errors + recorder.messages))
+    assert client.cwd == (tmp_path / "work").resolve()
+
+
+@pytest.mark.parametrize("frame", [
+    bytes([VERSIONED_FLAG | PROTOCOL_V2]),  # Truncated v2 header
+    bytes([VERSIONED_FLAG | PROTOCOL_V2, MessageType.ECHO.value, 0, 0]),
+    bytes([31]) + b"unknown type",
+    bytes([REQUEST_ID_FLAG | MessageType.ECHO.value]),  # Truncated request ID of a v1 frame
+    bytes([REQUEST_ID_FLAG | MessageType.ECHO.value, 1, 2, 3]),
+])
+def test_malformed_frame_drops_the_client(server, frame):
+    with socket.create_connection((server.get_host(), server.get_port())) as sock:  # A client that sends no HELLO
+        wait_for(lambda: len(server.get_clients()) == 1)
+        connection = server.get_clients()[0]
+        sock.sendall(FRAME_LENGTH.pack(len(frame)) + frame)
+        wait_for(lambda: not connection.is_connected() and not server.clients.all())
+
+
+@pytest.mark.parametrize("capabilities", [b"[]", b'"client"', b"5", b"\xff", b'{"tags": 5}', b'{"compression": 5}',
+                                          b'{"protocol": "2"}', b'{"protocol": [[2]]}', b'{"tags": null}'])
+def test_malformed_hello(server, recorder, capabilities):
+    with socket.create_connection((server.get_host(), server.get_port())) as sock:
+        for message_type, data in ((MessageType.HELLO, capabilities), (MessageType.ECHO, b"still connected")):
+            sock.sendall(FRAME_HEADER.pack(len(data) + 1, message_type.value) + data)
+        wait_for(lambda: "still connected" in recorder.messages)
+        assert any("malformed HELLO" in error for error in recorder.errors)
+        assert [connection.is_connected() for connection in server.get_clients()] == [True]
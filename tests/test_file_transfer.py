@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
+import config
+from conftest import sync, wait_for
+from src.core.file_transfer import DeltaFile, IncomingDirectory, delta_block_size
+from src.core.message import BLOCK_OFFSET, FRAME_LENGTH, PROTOCOL_V1, PROTOCOL_V2, Message, MessageType
+
+FILE_SIZE = config.FILE_CHUNK_SIZE + 12345  # Spans several chunks
+
+
+def wait_for_file(path: Path, data: bytes):
+    wait_for(lambda: path.is_file() and path.stat().st_size == len(data) and path.read_bytes() == data)
+
+
+def make_tree(root: Path) -> Path:
+    for index in range(40):
+        directory = root / f"d{index % 4}" / "sub"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"f{index}").write_bytes(os.urandom(index * 97) if index % 2 else b"text " * index * 50)
+    (root / "large").write_bytes(os.urandom(FILE_SIZE))
+    return root
+
+
+def assert_same_tree(source: Path, copy: Path):
+    for path in source.rglob("*"):
+        if path.is_file():
+            assert (copy / path.relative_to(source)).read_bytes() == path.read_bytes(), path
+
+
+@pytest.fixture
+def random_file(tmp_path) -> Path:
+    path = tmp_path / "random.bin"
+    path.write_bytes(os.urandom(FILE_SIZE))
+    return path
+
+
+@pytest.fixture
+def text_file(tmp_path) -> Path:
+    path = tmp_path / "text.log"
+    path.write_bytes(b"".join(b"log line %d\n" % index for index in range(400000)))
+    return path
+
+
+@pytest.mark.parametrize("mode", config.FILE_TRANSFER_MODES)
+def test_send_file_to_client(server, connection, mode, random_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "FILE_STRIPE_MIN_SIZE", config.MB)
+    connection.file_transfer_mode = mode
+    server.send_file_to_client(connection.client_address_str, str(random_file), str(tmp_path / "received"))
+    wait_for_file(tmp_path / "received" / random_file.name, random_file.read_bytes())
+
+
+@pytest.mark.parametrize("mode", config.FILE_TRANSFER_MODES)
+def test_send_compressible_file_to_client(server, connection, mode, text_file, tmp_path):
+    connection.file_transfer_mode = mode
+    server.send_file_to_client(connection.client_address_str, str(text_file), str(tmp_path / "received"))
+    wait_for_file(tmp_path / "received" / text_file.name, text_file.read_bytes())
+
+
+@pytest.mark.parametrize("mode", config.FILE_TRANSFER_MODES)
+def test_download_file_from_client(server, client, connection, recorder, mode, random_file, download_dir,
+                                   monkeypatch):
+    monkeypatch.setattr(config, "FILE_STRIPE_MIN_SIZE", config.MB)
+    client.file_transfer_mode = mode
+    server.send_message_to_client(connection.client_address_str, Message(
+        MessageType.FILE_DOWNLOAD, str(random_file).encode(), request_id=server.next_request_id()))
+    wait_for(lambda: any(f"Received file '{random_file.name}'" in info for info in recorder.infos))
+    assert (download_dir / connection.client_address_str / random_file.name).read_bytes() == random_file.read_bytes()
+
+
+def test_delta_transfer_of_changed_file(server, connection, random_file, tmp_path):
+    connection.file_transfer_mode = "delta"
+    destination = tmp_path / "received" / random_file.name
+    server.send_file_to_client(connection.client_address_str, str(random_file), str(destination.parent))
+    wait_for_file(destination, random_file.read_bytes())
+
+    data = bytearray(random_file.read_bytes())
+    data[config.MB:config.MB + 10] = b"x" * 10
+    random_file.write_bytes(bytes(data) + b"tail")
+    server.send_file_to_client(connection.client_address_str, str(random_file), str(destination.parent))
+    wait_for_file(destination, random_file.read_bytes())
+
+
+def test_push_file(server, connection, random_file, text_file, tmp_path):
+    for path in (random_file, text_file):
+        report = server.push_file(str(path), str(tmp_path / "pushed"))
+        assert report == {connection.client_address_str: None}
+        wait_for_file(tmp_path / "pushed" / path.name, path.read_bytes())
+
+
+def test_push_file_striped(server, connection, recorder, random_file, tmp_path):
+    report = server.push_file(str(random_file), str(tmp_path / "pushed"), stripes=3)
+    assert report == {connection.client_address_str: None}
+    wait_for_file(tmp_path / "pushed" / random_file.name, random_file.read_bytes())
+    sync(server, recorder, "after stripes")
+    # The data connections are neither registered nor reported as clients
+    assert server.get_clients() == [connection]
+    assert recorder.connected == [connection.client_address_str]
+    assert server.metrics.connects == 1 and server.metrics.disconnects == 0
+    assert server.metrics.traffic().received_messages[MessageType.HELLO.value] == 1  # Only the client's
+
+
+def test_push_directory(server, connection, recorder, tmp_path):
+    source = make_tree(tmp_path / "tree")
+    report = server.push_directory(str(source), str(tmp_path / "pushed"))
+    assert report == {connection.client_address_str: None}
+    sync(server, recorder, "after push")
+    assert_same_tree(source, tmp_path / "pushed" / "tree")
+
+
+def test_send_directory_to_client(server, connection, recorder, tmp_path):
+    source = make_tree(tmp_path / "tree")
+    server.send_directory_to_client(connection.client_address_str, str(source), str(tmp_path / "received"))
+    sync(server, recorder, "after send")
+    assert_same_tree(source, tmp_path / "received" / "tree")
+
+
+def test_download_directory_from_client(server, connection, recorder, tmp_path, download_dir):
+    source = make_tree(tmp_path / "tree")
+    server.send_message_to_client(connection.client_address_str, Message(
+        MessageType.FILE_DOWNLOAD, str(source).encode(), request_id=server.next_request_id()))
+    wait_for(lambda: any("Received directory" in info for info in recorder.infos))
+    assert_same_tree(source, download_dir / connection.client_address_str / "tree")
+
+
+def test_file_stream_negotiated(client, connection):
+    assert connection.file_stream and client.file_stream
+
+
+@pytest.mark.parametrize("mode", ["sendfile", "delta", "striped"])
+def test_no_file_stream_to_peers_without_support(server, connection, mode, random_file, tmp_path):
+    sent = []
+    send_message = connection.send_message
+
+    def record(message, timeout=None):
+        sent.append(message.get_type())
+        return send_message(message, timeout)
+
+    connection.send_message = record
+    connection.file_stream = False
+    connection.file_transfer_mode = mode
+    connection.send_file(str(random_file), str(tmp_path / "received"))  # Off a stream, delta and striped fall back
+    wait_for_file(tmp_path / "received" / random_file.name, random_file.read_bytes())
+    assert MessageType.FILE in sent and MessageType.FILE_STREAM not in sent
+
+
+def test_malformed_file_stream(server, client, connection, recorder, random_file, tmp_path):
+    client.send_message(Message(MessageType.FILE_UPLOAD, b"malformed.bin", request_id=7))
+    client.send_message(Message(MessageType.FILE_STREAM, b"\x01\x02\x03", request_id=7))
+    wait_for(lambda: any("malformed FILE_STREAM" in error for error in recorder.errors))
+    client.send_message(Message(MessageType.END_OF_FILE, request_id=7))
+    wait_for(lambda: any("unknown stream 7" in error for error in recorder.errors))
+
+    # The connection keeps working in both directions
+    sync(server, recorder, "after malformed stream")
+    server.send_file_to_client(connection.client_address_str, str(random_file), str(tmp_path / "received"))
+    wait_for_file(tmp_path / "received" / random_file.name, random_file.read_bytes())
+    assert connection in server.get_clients()
+
+
+@pytest.mark.parametrize("file_size", [0, 1 << 30, 100 << 30, 10 << 40])
+def test_delta_blocks_fit_in_a_frame(file_size):
+    block = bytes(delta_block_size(file_size))
+    message = Message(MessageType.FILE_BLOCK, BLOCK_OFFSET.pack(0) + block, request_id=1)
+    for version in (PROTOCOL_V1, PROTOCOL_V2):
+        assert message.frame_size(version) - FRAME_LENGTH.size <= config.MAX_MESSAGE_SIZE
+
+
+def test_malformed_file_block(server, client, connection, recorder, random_file, tmp_path):
+    client.send_message(Message(MessageType.FILE_SYNC, json.dumps({
+        "path": "delta.bin", "size": 10, "block_size": config.DELTA_BLOCK_SIZE}).encode(), request_id=11))
+    client.send_message(Message(MessageType.FILE_BLOCK, b"\x00\x01", request_id=11))
+    wait_for(lambda: any("malformed FILE_BLOCK" in error for error in recorder.errors))
+    client.send_message(Message(MessageType.END_OF_FILE, request_id=11))
+    wait_for(lambda: any("unknown stream 11" in error for error in recorder.errors))
+
+    sync(server, recorder, "after malformed block")
+    connection.file_transfer_mode = "delta"
+    server.send_file_to_client(connection.client_address_str, str(random_file), str(tmp_path / "received"))
+    wait_for_file(tmp_path / "received" / random_file.name, random_file.read_bytes())
+
+
+def test_more_concurrent_uploads_than_disk_write_buffers(server, client, connection, recorder, download_dir):
+    uploads = range(1, config.DISK_WRITE_BUFFERS + 9)
+    chunk = os.urandom(config.DISK_WRITE_BUFFER_SIZE * 3 // 2)  # Leaves a partly filled buffer behind
+    for request_id in uploads:
+        client.send_message(Message(MessageType.FILE_UPLOAD, f"upload{request_id}".encode(), request_id=request_id))
+    for request_id in uploads:
+        client.send_message(Message(MessageType.FILE, chunk, request_id=request_id))
+    client.send_message(Message(MessageType.ECHO, b"uploads open"))
+    wait_for(lambda: "uploads open" in recorder.messages)  # The server still serves the connection
+
+    for request_id in uploads:
+        client.send_message(Message(MessageType.END_OF_FILE, request_id=request_id))
+    wait_for(lambda: sum("Received file 'upload" in info for info in recorder.infos) == len(uploads))
+    for request_id in uploads:
+        assert (download_dir / connection.client_address_str / f"upload{request_id}").read_bytes() == chunk
+
+
+def test_stalled_extraction_only_stalls_its_connection(server, connect, recorder, monkeypatch):
+    extracting = threading.Event()
+    read = IncomingDirectory.read
+    monkeypatch.setattr(IncomingDirectory, "read", lambda incoming, size=-1: extracting.wait() and read(incoming, size))
+    uploader, other = connect(), connect()
+    try:
+        uploader.send_message(Message(MessageType.DIRECTORY_UPLOAD, b"stalled", request_id=1))
+        for _ in range(config.DIRECTORY_EXTRACT_QUEUE_SIZE):  # Fills the queue of the extractor
+            uploader.send_message(Message(MessageType.FILE, bytes(1024), request_id=1))
+        uploader.send_message(Message(MessageType.ECHO, b"queue full"))
+        wait_for(lambda: "queue full" in recorder.messages)
+
+        uploader.close()  # Aborting the transfer waits for the extractor
+        wait_for(lambda: len(server.get_clients()) == 1)
+        other.send_message(Message(MessageType.ECHO, b"other client"))
+        wait_for(lambda: "other client" in recorder.messages)
+    finally:
+        extracting.set()
+
+
+def test_stalled_delta_copy_only_stalls_its_connection(server, connect, recorder, monkeypatch, download_dir):
+    started, copying = threading.Event(), threading.Event()
+    copy_basis = DeltaFile._DeltaFile__copy_basis
+
+    def stalled_copy_basis(delta, end):
+        started.set()
+        copying.wait()
+        copy_basis(delta, end)
+
+    monkeypatch.setattr(DeltaFile, "_DeltaFile__copy_basis", stalled_copy_basis)
+    uploader = connect()
+    basis = download_dir / server.get_clients()[0].client_address_str / "delta.bin"
+    basis.parent.mkdir(parents=True)
+    basis.write_bytes(bytes(4 * config.DELTA_BLOCK_SIZE))
+    other = connect()
+    try:
+        uploader.send_message(Message(MessageType.FILE_SYNC, json.dumps({
+            "path": "delta.bin", "size": 4 * config.DELTA_BLOCK_SIZE, "block_size": config.DELTA_BLOCK_SIZE}).encode(),
+            request_id=3))
+        block = BLOCK_OFFSET.pack(3 * config.DELTA_BLOCK_SIZE) + b"x" * config.DELTA_BLOCK_SIZE
+        uploader.send_message(Message(MessageType.FILE_BLOCK, block, request_id=3))  # Copies the blocks before it
+        wait_for(started.is_set)
+        other.send_message(Message(MessageType.ECHO, b"other client"))
+        wait_for(lambda: "other client" in recorder.messages)
+
+        copying.set()
+        uploader.send_message(Message(MessageType.END_OF_FILE, request_id=3))
+        wait_for(lambda: basis.read_bytes()[-config.DELTA_BLOCK_SIZE:] == b"x" * config.DELTA_BLOCK_SIZE)
+        assert basis.stat().st_size == 4 * config.DELTA_BLOCK_SIZE
+    finally:
+        copying.set()
@@ -0,0 +1,128 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import config
+from src.core.base_client import BaseClientThread
+from src.core.message import FRAME_HEADER, FRAME_LENGTH, PROTOCOL_V1, PROTOCOL_V2, Message, MessageType
+
+
+class Peer(BaseClientThread):
+    """
+    One end of a connection, driven by the test instead of a thread.
+    """
+
+    def run(self):
+        pass
+
+
+@pytest.fixture
+def pair():
+    """
+    A connected peer and the raw socket of the other end.
+    """
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        remote = socket.create_connection(listener.getsockname())
+        sock, addr = listener.accept()
+    peer = Peer()
+    peer.init(sock, addr)
+    yield peer, remote
+    peer.close()
+    remote.close()
+
+
+def frame(message_type: MessageType, data: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(data) + 1, message_type.value) + data
+
+
+def receive(peer: Peer, count: int) -> list[tuple[MessageType, bytes]]:
+    messages = []
+    for _ in range(count):
+        message = peer.receive_message()
+        messages.append((message.get_type(), bytes(message.data)))  # The payload is only valid until the next call
+    return messages
+
+
+def test_receive_frames_split_across_reads(pair):
+    peer, remote = pair
+    data = frame(MessageType.ECHO, b"split") + frame(MessageType.OUTPUT, b"across reads")
+    for index in range(len(data)):
+        remote.sendall(data[index:index + 1])
+        time.sleep(0.001)
+    assert receive(peer, 2) == [(MessageType.ECHO, b"split"), (MessageType.OUTPUT, b"across reads")]
+
+
+def test_receive_burst_of_frames(pair):
+    peer, remote = pair
+    payloads = [b"message %d" % index for index in range(2000)]
+    remote.sendall(b"".join(frame(MessageType.ECHO, payload) for payload in payloads))
+    assert receive(peer, len(payloads)) == [(MessageType.ECHO, payload) for payload in payloads]
+
+
+def test_receive_frame_larger_than_the_buffer(pair):
+    peer, remote = pair
+    large = bytes(range(256)) * (3 * config.RECEIVE_BUFFER_SIZE // 256 + 1)
+    remote.sendall(frame(MessageType.FILE, large) + frame(MessageType.ECHO, b"after"))
+    assert receive(peer, 2) == [(MessageType.FILE, large), (MessageType.ECHO, b"after")]
+
+
+@pytest.mark.parametrize("size", [0, config.MAX_MESSAGE_SIZE + 1])
+def test_receive_rejects_invalid_frame_sizes(pair, size):
+    peer, remote = pair
+    remote.sendall(FRAME_LENGTH.pack(size) + b"\x01" * 16)
+    with pytest.raises(OSError):
+        peer.receive_message()
+
+
+def test_receive_reports_closed_connection(pair):
+    peer, remote = pair
+    remote.sendall(frame(MessageType.ECHO, b"last")[:-2])
+    remote.close()
+    with pytest.raises(OSError, match="while receiving"):
+        peer.receive_message()
+
+
+def read_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk, "Connection closed"
+        data += chunk
+    return bytes(data)
+
+
+def send_all(peer: Peer, messages: list[Message]):
+    """
+    Sends the messages on another thread, so that the test can read messages larger than the socket buffers.
+    """
+    def run():
+        with peer.corked():
+            for message in messages:
+                peer.send_message(message)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+@pytest.mark.parametrize("version", [PROTOCOL_V1, PROTOCOL_V2])
+@pytest.mark.parametrize("size", [0, 100, 5 * config.MB])
+def test_send_writes_the_frame(pair, version, size):
+    peer, remote = pair
+    peer.protocol_version = version
+    message = Message(MessageType.FILE, bytes(range(256)) * (size // 256), request_id=5)
+    header, payload = message.to_buffers(version, peer.request_ids)
+    sender = send_all(peer, [message])
+    assert read_exactly(remote, len(header) + len(payload)) == bytes(header) + bytes(payload)
+    sender.join()
+
+
+def test_send_burst_of_messages(pair):
+    peer, remote = pair
+    messages = [Message(MessageType.ECHO, b"message %d" % index) for index in range(2000)]
+    expected = b"".join(frame(MessageType.ECHO, bytes(message.data)) for message in messages)
+    sender = send_all(peer, messages)
+    assert read_exactly(remote, len(expected)) == expected
+    sender.join()
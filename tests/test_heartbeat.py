@@ -0,0 +1,21 @@
+import pytest
+
+from conftest import sync, wait_for
+from src.core.message import HEARTBEAT_TIME, Message, MessageType
+
+
+@pytest.mark.parametrize("payload", [b"", b"\x01\x02\x03", bytes(HEARTBEAT_TIME.size + 1)])
+def test_malformed_pong(server, client, connection, recorder, payload):
+    client.send_message(Message(MessageType.PONG, payload))
+    wait_for(lambda: any("malformed PONG" in error for error in recorder.errors))
+    assert connection.rtt is None
+
+    # The connection handler survived and the client is still served
+    sync(server, recorder, "after malformed pong")
+    assert connection in server.get_clients()
+
+
+def test_pong_updates_rtt(server, client, connection, recorder):
+    server.heartbeats.beat()
+    wait_for(lambda: connection.rtt is not None)
+    assert 0 <= connection.rtt < 5
@@ -0,0 +1,55 @@
+import pytest
+
+from src.core.message import (FRAME_HEADER, PROTOCOL_V1, PROTOCOL_V2, REQUEST_ID_FLAG, VERSIONED_FLAG, Message,
+                              MessageType, PreparedMessage)
+
+
+def frame(message: Message, version: int, tagged=True) -> bytes:
+    header, payload = message.to_buffers(version, tagged)
+    assert len(header) + len(payload) == message.frame_size(version, tagged)
+    buffer = bytearray(message.frame_size(version, tagged))
+    assert message.pack_into(buffer, 0, version, tagged) == len(buffer)
+    assert bytes(buffer) == header + payload
+    return bytes(buffer)
+
+
+@pytest.mark.parametrize("prepared", [False, True])
+@pytest.mark.parametrize("version, tagged", [(PROTOCOL_V1, True), (PROTOCOL_V1, False), (PROTOCOL_V2, True),
+                                             (PROTOCOL_V2, False)])
+def test_round_trip(prepared, version, tagged):
+    message = Message(MessageType.OUTPUT, b"\x01output", request_id=42)
+    if prepared:
+        message = PreparedMessage.of(message)
+    decoded = Message.from_bytes(frame(message, version, tagged)[4:])
+    assert decoded.get_type() is MessageType.OUTPUT
+    assert bytes(decoded.data) == b"\x01output"
+    # v2 frames always carry the stream, v1 frames only to peers that announced request ID support
+    assert decoded.request_id == (42 if tagged or version >= PROTOCOL_V2 else None)
+
+
+def test_untagged_v1_frame_has_no_request_id_flag():
+    data = frame(Message(MessageType.ECHO, b"hello", request_id=7), PROTOCOL_V1, tagged=False)
+    assert data == FRAME_HEADER.pack(6, MessageType.ECHO.value) + b"hello"
+    assert not data[4] & REQUEST_ID_FLAG
+
+
+@pytest.mark.parametrize("message_type", list(MessageType))
+@pytest.mark.parametrize("version", [PROTOCOL_V1, PROTOCOL_V2])
+def test_every_message_type_round_trips(message_type, version):
+    message = Message(message_type, b"payload", compressed=True, request_id=9)
+    decoded = Message.from_bytes(frame(message, version)[4:])
+    assert (decoded.get_type(), decoded.compressed, decoded.request_id) == (message_type, True, 9)
+
+
+@pytest.mark.parametrize("size", range(1, 6))
+def test_truncated_v2_frame(size):
+    data = (bytes([VERSIONED_FLAG | PROTOCOL_V2, MessageType.ECHO.value]) + bytes(4))[:size]
+    with pytest.raises(OSError, match="malformed"):
+        Message.from_bytes(data)
+
+
+@pytest.mark.parametrize("size", range(1, 5))
+def test_truncated_tagged_v1_frame(size):
+    data = (bytes([REQUEST_ID_FLAG | MessageType.ECHO.value]) + bytes(4))[:size]
+    with pytest.raises(OSError, match="malformed"):
+        Message.from_bytes(data)
@@ -0,0 +1,27 @@
+import pytest
+
+from src.core.message import Message, MessageType
+from src.core.metrics import MetricsSnapshot, TrafficCounters
+
+
+@pytest.mark.parametrize("message_type", list(MessageType))
+def test_every_message_type_is_counted(message_type):
+    snapshot = MetricsSnapshot()
+    snapshot.traffic.sent(Message(message_type, b"x"), 10)
+    snapshot.traffic.received(Message(message_type, b"x"), 12)
+    traffic = snapshot.traffic
+    assert traffic.sent_messages[message_type.value] == traffic.received_messages[message_type.value] == 1
+
+    merged = MetricsSnapshot()
+    merged.add(snapshot)
+    exported = merged.to_prometheus()
+    assert f'rce_bytes_total{{direction="sent",type="{message_type.name}"}} 10' in exported
+    assert f'rce_bytes_total{{direction="received",type="{message_type.name}"}} 12' in exported
+
+
+def test_round_trip_latency():
+    latency = MetricsSnapshot().latency
+    counters = TrafficCounters(latency)
+    counters.sent(Message(MessageType.BATCH, b"{}", request_id=5), 20)
+    counters.received(Message(MessageType.BATCH_RESULT, b"{}", request_id=5), 20)
+    assert latency[MessageType.BATCH].count == 1
@@ -0,0 +1,26 @@
+from src.core.message import Message, MessageType
+from src.core.outbound_queue import OutboundQueue
+
+
+def frame(size: int):
+    message = Message(MessageType.ECHO, bytes(size))
+    return (*message.to_buffers(), message)
+
+
+def test_congestion():
+    queue = OutboundQueue(high_water=100, low_water=40)
+    assert queue.put(frame(95))
+    assert queue.congested and not queue.put(frame(1))
+    header, payload, _ = queue.pop()
+    queue.written(len(header) + len(payload))
+    assert queue.size == 0 and not queue.congested
+    assert queue.put(frame(1))
+
+
+def test_written_after_close():
+    queue = OutboundQueue(high_water=100, low_water=40)
+    queue.put(frame(50))
+    header, payload, _ = queue.pop()  # Being written while the connection is closed
+    queue.close()
+    queue.written(len(header) + len(payload))
+    assert queue.size == 0 and not queue.congested
@@ -0,0 +1,141 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import config
+from conftest import sync, wait_for
+from src.core.message import FRAME_HEADER, PROTOCOL_V1, Message, MessageType
+from test_file_transfer import FILE_SIZE, assert_same_tree, make_tree, wait_for_file
+
+
+@pytest.fixture
+def client(connect, monkeypatch):
+    """
+    A client that only speaks protocol v1.
+    """
+    monkeypatch.setattr(config, "PROTOCOL_VERSIONS", (1,))
+    return connect()
+
+
+@pytest.fixture
+def connection(server, client):
+    connection = server.get_clients()[0]
+    assert connection.protocol_version == client.protocol_version == PROTOCOL_V1
+    return connection
+
+
+class Broadcaster(threading.Thread):
+    """
+    Broadcasts ECHO messages and runs commands until it is stopped.
+    """
+
+    def __init__(self, server, address: str):
+        super().__init__(daemon=True)
+        self.server = server
+        self.address = address
+        self.sent: list[str] = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            token = f"broadcast {len(self.sent)}"
+            self.server.broadcast_message(Message(MessageType.ECHO, token.encode()))
+            self.server.send_message_to_client(self.address, Message(MessageType.CMD, b"true"))
+            self.sent.append(token)
+            time.sleep(0.002)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+@pytest.fixture
+def broadcaster(server, connection):
+    broadcaster = Broadcaster(server, connection.client_address_str)
+    broadcaster.start()
+    yield broadcaster
+    broadcaster.stop()
+
+
+def assert_broadcasts_received(recorder, broadcaster: Broadcaster):
+    broadcaster.stop()
+    wait_for(lambda: broadcaster.sent[-1] in recorder.messages)
+    assert [message for message in recorder.messages if message.startswith("broadcast")] == broadcaster.sent
+
+
+@pytest.mark.parametrize("chunks", [1, 3])
+def test_push_file_while_broadcasting(server, connection, recorder, broadcaster, tmp_path, chunks):
+    path = tmp_path / "random.bin"
+    path.write_bytes(os.urandom(chunks * config.FILE_CHUNK_SIZE + 12345))
+    for destination in ("first", "second"):
+        assert server.push_file(str(path), str(tmp_path / destination)) == {connection.client_address_str: None}
+        wait_for_file(tmp_path / destination / path.name, path.read_bytes())
+    assert_broadcasts_received(recorder, broadcaster)
+    assert not [error for error in recorder.errors if "expected FILE" in error]
+
+
+def test_push_directory_while_broadcasting(server, connection, recorder, broadcaster, tmp_path):
+    source = make_tree(tmp_path / "tree")
+    assert server.push_directory(str(source), str(tmp_path / "pushed")) == {connection.client_address_str: None}
+    sync(server, recorder, "after push")
+    assert_same_tree(source, tmp_path / "pushed" / "tree")
+    assert_broadcasts_received(recorder, broadcaster)
+
+
+@pytest.mark.parametrize("mode", config.FILE_TRANSFER_MODES)
+def test_send_file_while_broadcasting(server, connection, recorder, broadcaster, mode, tmp_path):
+    path = tmp_path / "random.bin"
+    path.write_bytes(os.urandom(FILE_SIZE))
+    connection.file_transfer_mode = mode
+    server.send_file_to_client(connection.client_address_str, str(path), str(tmp_path / "received"))
+    wait_for_file(tmp_path / "received" / path.name, path.read_bytes())
+    assert_broadcasts_received(recorder, broadcaster)
+
+
+def test_held_push_does_not_starve_streamed_push(server, connection, connect, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "BROADCAST_WORKERS", 1)
+    monkeypatch.setattr(config, "PROTOCOL_VERSIONS", (1, 2))
+    connect()
+    streamed = next(client for client in server.get_clients() if client is not connection)
+    assert streamed.protocol_version > PROTOCOL_V1
+    release = threading.Event()
+    send_file = connection.send_file
+
+    def stalled_send_file(*args):
+        release.wait()
+        return send_file(*args)
+
+    monkeypatch.setattr(connection, "send_file", stalled_send_file)
+    path = tmp_path / "random.bin"
+    path.write_bytes(os.urandom(FILE_SIZE))
+    reports = []
+    pusher = threading.Thread(target=lambda: reports.append(server.push_file(str(path), str(tmp_path / "pushed"))),
+                              daemon=True)
+    pusher.start()
+    try:
+        # The streamed push completes while the transfer to the v1 client holds its worker
+        wait_for_file(tmp_path / "pushed" / path.name, path.read_bytes())
+    finally:
+        release.set()
+    pusher.join()
+    assert reports == [{connection.client_address_str: None, streamed.client_address_str: None}]
+
+
+def test_no_request_ids_to_peers_without_support(server, recorder):
+    with socket.create_connection((server.get_host(), server.get_port())) as sock:  # A client that sends no HELLO
+        wait_for(lambda: len(server.get_clients()) == 1)
+        connection = server.get_clients()[0]
+        assert not connection.request_ids
+        connection.send_message(Message(MessageType.ECHO, b"hello", request_id=3))
+        sock.settimeout(5)
+        data = b""
+        while len(data) < FRAME_HEADER.size + 5:
+            data += sock.recv(64)
+    assert data == FRAME_HEADER.pack(6, MessageType.ECHO.value) + b"hello"
+
+
+def test_request_ids_negotiated(client, connection):
+    assert connection.request_ids and client.request_ids